@@ -0,0 +1,482 @@
+#!/usr/bin/env python3
+"""Measures how quickly the bot's event callbacks handle a large synthetic stream of
+events.
+
+Events are fed through `Callbacks` by an `EventDispatcher`, as they would be by the
+sync loop, using a fake client that pretends to send events with a configurable
+latency. Throughput, handling latency and peak memory usage are reported, and can be
+saved as JSON and compared against a previous run:
+
+    python -m benchmarks.bench_callbacks --events 20000 --output baseline.json
+    python -m benchmarks.bench_callbacks --events 20000 --compare baseline.json
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from nio import (
+    Event,
+    InviteMemberEvent,
+    JoinResponse,
+    MatrixRoom,
+    MegolmEvent,
+    RoomGetEventResponse,
+    RoomMessageText,
+    RoomSendResponse,
+    UnknownEvent,
+)
+
+from my_project_name import message_responses
+from my_project_name.callbacks import Callbacks
+from my_project_name.chat_functions import set_own_event_index
+from my_project_name.dispatcher import EventDispatcher
+from my_project_name.own_events import OwnEventIndex
+from my_project_name.storage import Storage
+
+BOT_USER_ID = "@bot:example.org"
+COMMAND_PREFIX = "!c "
+
+# The default share of each kind of event in the stream
+DEFAULT_MIX = {
+    "message": 0.5,
+    "command": 0.3,
+    "reaction": 0.1,
+    "invite": 0.05,
+    "megolm": 0.05,
+}
+
+# A synthetic event, along with the kind of event it is and the room it is in
+StreamItem = Tuple[str, MatrixRoom, Event]
+
+
+class FakeClient:
+    def __init__(self, send_latency: float = 0.0):
+        """A stand-in for `nio.AsyncClient` that answers requests without a homeserver.
+
+        A real class is used rather than a Mock, as Mocks record every call made to
+        them, which would dominate the time and memory being measured.
+
+        Args:
+            send_latency: The number of seconds each request takes to complete.
+        """
+        self.user = BOT_USER_ID
+        self.user_id = BOT_USER_ID
+        self.send_latency = send_latency
+        self.requests = 0
+
+    async def _request(self) -> None:
+        self.requests += 1
+        await asyncio.sleep(self.send_latency)
+
+    async def room_send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        tx_id: Optional[str] = None,
+        ignore_unverified_devices: bool = False,
+    ) -> RoomSendResponse:
+        await self._request()
+        return RoomSendResponse(f"$sent{self.requests}", room_id)
+
+    async def room_get_event(self, room_id: str, event_id: str) -> RoomGetEventResponse:
+        await self._request()
+
+        # Pretend that every event that is reacted to was sent by the bot
+        response = RoomGetEventResponse()
+        response.event = SimpleNamespace(event_id=event_id, sender=BOT_USER_ID)
+        return response
+
+    async def join(self, room_id: str) -> JoinResponse:
+        await self._request()
+        return JoinResponse(room_id)
+
+
+def make_room(room_id: str, member_count: int) -> MatrixRoom:
+    room = MatrixRoom(room_id, BOT_USER_ID)
+    room.add_member(BOT_USER_ID, "bot", None)
+    for i in range(member_count - 1):
+        room.add_member(f"@user{i}:example.org", f"user {i}", None)
+    return room
+
+
+def make_stream(
+    count: int,
+    room_count: int = 100,
+    mix: Optional[Dict[str, float]] = None,
+    seed: int = 0,
+) -> List[StreamItem]:
+    """Generate a reproducible stream of synthetic events.
+
+    Args:
+        count: The number of events to generate.
+
+        room_count: The number of rooms to spread the events across. A quarter of
+            the rooms are DMs, in which every message is treated as a command.
+
+        mix: The share of each kind of event in the stream. See `DEFAULT_MIX`.
+
+        seed: The seed for the random number generator.
+
+    Returns:
+        A list of (kind, room, event) tuples.
+    """
+    rng = random.Random(seed)
+    mix = mix or DEFAULT_MIX
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+
+    dm_rooms = [make_room(f"!dm{i}:example.org", 2) for i in range(room_count // 4)]
+    group_rooms = [
+        make_room(f"!group{i}:example.org", 10)
+        for i in range(room_count - len(dm_rooms))
+    ]
+    all_rooms = dm_rooms + group_rooms
+
+    # Reactions are to a limited set of events, so that some are found in the bot's
+    # own event index, as they would be in a real room
+    reacted_to_ids = [f"$target{i}" for i in range(100)]
+
+    commands = ["echo hello", "help", "help commands", "react", "not_a_command"]
+    messages = ["hello world", "just chatting", "**markdown** and `code`"]
+
+    stream: List[StreamItem] = []
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        source: Dict[str, Any] = {
+            "event_id": f"$event{i}",
+            "sender": f"@user{i % 9}:example.org",
+            "origin_server_ts": i,
+        }
+
+        event: Event
+        if kind == "message":
+            room = rng.choice(group_rooms)
+            source["type"] = "m.room.message"
+            source["content"] = {"msgtype": "m.text", "body": rng.choice(messages)}
+            event = RoomMessageText.from_dict(source)
+        elif kind == "command":
+            room = rng.choice(all_rooms)
+            body = rng.choice(commands)
+            if room.member_count > 2:
+                body = COMMAND_PREFIX + body
+            source["type"] = "m.room.message"
+            source["content"] = {"msgtype": "m.text", "body": body}
+            event = RoomMessageText.from_dict(source)
+        elif kind == "reaction":
+            room = rng.choice(all_rooms)
+            source["type"] = "m.reaction"
+            source["content"] = {
+                "m.relates_to": {
+                    "rel_type": "m.annotation",
+                    "event_id": rng.choice(reacted_to_ids),
+                    "key": "👍",
+                }
+            }
+            event = UnknownEvent.from_dict(source)
+        elif kind == "invite":
+            room = make_room(f"!invite{i}:example.org", 1)
+            source["type"] = "m.room.member"
+            source["state_key"] = BOT_USER_ID
+            source["content"] = {"membership": "invite"}
+            event = InviteMemberEvent.from_dict(source)
+        elif kind == "megolm":
+            room = rng.choice(all_rooms)
+            source["type"] = "m.room.encrypted"
+            source["content"] = {
+                "algorithm": "m.megolm.v1.aes-sha2",
+                "sender_key": "sender_key",
+                "ciphertext": "ciphertext",
+                "session_id": "session_id",
+                "device_id": "DEVICEID",
+            }
+            event = MegolmEvent.from_dict(source)
+        else:
+            raise ValueError(f"Unknown event kind '{kind}'")
+
+        stream.append((kind, room, event))
+
+    return stream
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Get a percentile of some sorted values, using the nearest-rank method"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, int(round(fraction * len(sorted_values))) - 1)
+    return sorted_values[index]
+
+
+def summarise_latencies(latencies: List[float]) -> Dict[str, float]:
+    latencies = sorted(latencies)
+    return {
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": latencies[-1] * 1000 if latencies else 0.0,
+    }
+
+
+async def run_stream(
+    stream: List[StreamItem], send_latency: float, max_workers: int
+) -> Dict[str, Any]:
+    """Handle a stream of events with a fresh set of callbacks.
+
+    Args:
+        stream: The events to handle. See `make_stream`.
+
+        send_latency: The number of seconds each request to the fake client takes.
+
+        max_workers: The maximum number of events to handle at once.
+
+    Returns:
+        The time taken to handle the stream, and the latency of each event by kind.
+    """
+    client = FakeClient(send_latency)
+    store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+    config = SimpleNamespace(command_prefix=COMMAND_PREFIX, user_id=BOT_USER_ID)
+
+    own_events = OwnEventIndex(store)
+    set_own_event_index(own_events)
+    callbacks = Callbacks(client, store, config, own_events=own_events)
+
+    handlers: Dict[str, Callable[[MatrixRoom, Any], Awaitable[None]]] = {
+        "message": callbacks.message,
+        "command": callbacks.message,
+        "reaction": callbacks.unknown,
+        "invite": callbacks.invite_event_filtered_callback,
+        "megolm": callbacks.decryption_failure,
+    }
+
+    latencies: Dict[str, List[float]] = defaultdict(list)
+
+    def timed(kind: str) -> Callable[[MatrixRoom, Any], Awaitable[None]]:
+        handler = handlers[kind]
+
+        async def run_handler(room: MatrixRoom, event: Any) -> None:
+            start = time.perf_counter()
+            try:
+                await handler(room, event)
+            finally:
+                latencies[kind].append(time.perf_counter() - start)
+
+        return run_handler
+
+    timed_handlers = {kind: timed(kind) for kind in handlers}
+
+    # Every event is queued up front, so no room's queue may be allowed to overflow
+    dispatcher = EventDispatcher(max_workers=max_workers, max_queue_size=len(stream))
+
+    try:
+        start = time.perf_counter()
+        for kind, room, event in stream:
+            dispatcher.dispatch(timed_handlers[kind], room, event)
+        await dispatcher.join()
+        seconds = time.perf_counter() - start
+    finally:
+        set_own_event_index(None)
+        await store.close()
+
+    return {"seconds": seconds, "latencies": latencies, "requests": client.requests}
+
+
+def run_benchmark(
+    events: int = 10000,
+    rooms: int = 100,
+    send_latency: float = 0.0,
+    max_workers: int = 8,
+    seed: int = 0,
+    measure_memory: bool = True,
+) -> Dict[str, Any]:
+    """Run the benchmark and collect its results.
+
+    Throughput and latency are measured first. As tracing memory allocations slows
+    everything down, the stream is then handled a second time to measure peak memory.
+
+    Args:
+        events: The number of events to handle.
+
+        rooms: The number of rooms to spread the events across.
+
+        send_latency: The number of seconds each request to the fake client takes.
+
+        max_workers: The maximum number of events to handle at once.
+
+        seed: The seed used to generate the stream of events.
+
+        measure_memory: Whether to measure peak memory usage.
+
+    Returns:
+        The benchmark's parameters and results, suitable for saving as JSON.
+    """
+    # Make sure the triggers are compiled before timing starts, as they would be in
+    # main
+    message_responses.triggers.compile()
+
+    stream = make_stream(events, rooms, seed=seed)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        run = loop.run_until_complete(run_stream(stream, send_latency, max_workers))
+
+        peak_memory = None
+        if measure_memory:
+            tracemalloc.start()
+            try:
+                loop.run_until_complete(run_stream(stream, send_latency, max_workers))
+                _, peak_memory = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+    finally:
+        loop.close()
+
+    all_latencies = [
+        latency for latencies in run["latencies"].values() for latency in latencies
+    ]
+    return {
+        "timestamp": time.time(),
+        "python": platform.python_version(),
+        "parameters": {
+            "events": events,
+            "rooms": rooms,
+            "send_latency": send_latency,
+            "max_workers": max_workers,
+            "seed": seed,
+        },
+        "results": {
+            "seconds": run["seconds"],
+            "events_per_second": events / run["seconds"] if run["seconds"] else 0.0,
+            "requests": run["requests"],
+            "latency": summarise_latencies(all_latencies),
+            "latency_by_kind": {
+                kind: summarise_latencies(latencies)
+                for kind, latencies in sorted(run["latencies"].items())
+            },
+            "peak_memory_bytes": peak_memory,
+        },
+    }
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], max_regression: float
+) -> List[str]:
+    """Compare the results of two runs.
+
+    Args:
+        baseline: The results of a previous run.
+
+        current: The results of this run.
+
+        max_regression: The fraction by which a result may get worse before it is
+            considered a regression.
+
+    Returns:
+        A description of each result that regressed.
+    """
+    before = baseline["results"]
+    after = current["results"]
+
+    # (name, value before, value after, whether higher is better)
+    checks = [
+        ("events/sec", before["events_per_second"], after["events_per_second"], True),
+        ("p50 latency", before["latency"]["p50_ms"], after["latency"]["p50_ms"], False),
+        ("p99 latency", before["latency"]["p99_ms"], after["latency"]["p99_ms"], False),
+    ]
+    if before.get("peak_memory_bytes") and after.get("peak_memory_bytes"):
+        checks.append(
+            (
+                "peak memory",
+                before["peak_memory_bytes"],
+                after["peak_memory_bytes"],
+                False,
+            )
+        )
+
+    regressions = []
+    for name, old, new, higher_is_better in checks:
+        if not old:
+            continue
+        change = (new - old) / old
+        print(f"{name}: {old:.2f} -> {new:.2f} ({change:+.1%})")
+
+        worse_by = -change if higher_is_better else change
+        if worse_by > max_regression:
+            regressions.append(f"{name} is {worse_by:.1%} worse")
+
+    return regressions
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, default=10000)
+    parser.add_argument("--rooms", type=int, default=100)
+    parser.add_argument(
+        "--send-latency",
+        type=float,
+        default=0.0,
+        help="seconds each request to the fake homeserver takes",
+    )
+    parser.add_argument("--max-workers", type=int, default=8)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--no-memory", action="store_true", help="skip measuring peak memory"
+    )
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument(
+        "--compare", help="compare the results to those saved in this JSON file"
+    )
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        default=0.1,
+        help="fail if a result is worse than the compared run by more than this "
+        "fraction",
+    )
+    args = parser.parse_args(argv)
+
+    # Only the cost of making logging calls should be measured, not that of writing
+    # them out
+    logging.basicConfig(level=logging.CRITICAL)
+
+    result = run_benchmark(
+        events=args.events,
+        rooms=args.rooms,
+        send_latency=args.send_latency,
+        max_workers=args.max_workers,
+        seed=args.seed,
+        measure_memory=not args.no_memory,
+    )
+    print(json.dumps(result["results"], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+        if baseline["parameters"] != result["parameters"]:
+            print("Warning: the compared run used different parameters")
+
+        regressions = compare(baseline, result, args.max_regression)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,460 @@
+"""A small stand-in for a Matrix homeserver, for load testing the bot without a
+network.
+
+Only the parts of the client-server API that the bot uses are implemented. Rooms and
+their timelines are scripted by calling methods such as `add_room` and `send_message`,
+and each sync hands the bot whatever has been scripted since its previous sync.
+Latency, rate limiting and dropped connections can be injected at any time.
+"""
+
+import asyncio
+import json
+import logging
+import random
+import time
+from collections import Counter, defaultdict
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Requests made to these endpoints may be rejected with M_LIMIT_EXCEEDED. See
+# `FakeHomeserver.rate_limit_rate`
+RATE_LIMITED_ENDPOINTS = {"send", "join"}
+
+
+class FakeHomeserver:
+    def __init__(
+        self,
+        user_id: str = "@bot:localhost",
+        latency: float = 0.0,
+        rate_limit_rate: float = 0.0,
+        disconnect_rate: float = 0.0,
+        max_poll: float = 30.0,
+        seed: int = 0,
+    ):
+        """A fake homeserver for a single bot account.
+
+        The fault injection options may be changed while the homeserver is running.
+
+        Args:
+            user_id: The user ID of the bot's account. Any password is accepted.
+
+            latency: The number of seconds to wait before answering each request.
+
+            rate_limit_rate: The fraction of send and join requests to reject with a
+                429 M_LIMIT_EXCEEDED error.
+
+            disconnect_rate: The fraction of requests to answer by dropping the
+                connection.
+
+            max_poll: The longest a sync request is held open for while waiting for
+                new events, in seconds, regardless of the timeout requested.
+
+            seed: The seed used to decide which requests fail.
+        """
+        self.user_id = user_id
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.disconnect_rate = disconnect_rate
+        self.max_poll = max_poll
+        self.retry_after_ms = 100
+
+        self.host = "127.0.0.1"
+        self.port = 0
+
+        # Statistics about the requests made to the homeserver
+        self.requests: Counter = Counter()
+        self.rate_limited = 0
+        self.disconnects = 0
+
+        # Every event sent by the bot, as (time received, room ID, type, content)
+        self.sent_events: List[Tuple[float, str, str, Dict[str, Any]]] = []
+
+        # Called with each event sent by the bot, as (room ID, type, content)
+        self.on_send: Optional[Callable[[str, str, Dict[str, Any]], None]] = None
+
+        # The times at which each outage ended, and at which the first successful sync
+        # after each outage arrived
+        self.outages_ended: List[float] = []
+        self.reconnected: List[float] = []
+
+        self._rng = random.Random(seed)
+        self._runner: Optional[web.AppRunner] = None
+        self._down = False
+
+        # Room ID -> the user IDs of the room's members, other than the bot
+        self._members: Dict[str, List[str]] = {}
+        self._joined: Set[str] = set()
+        self._invited: Dict[str, str] = {}
+
+        # Events waiting to be delivered in the next sync, by room ID
+        self._pending: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+
+        # Rooms whose state the bot has not yet received
+        self._new_rooms: Set[str] = set()
+        self._new_invites: Set[str] = set()
+
+        self._events: Dict[str, Dict[str, Any]] = {}
+        self._event_count = 0
+        self._batch = 0
+        self._wakeup = asyncio.Event()
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.host}:{self.port}"
+
+    @property
+    def joined_rooms(self) -> FrozenSet[str]:
+        """The IDs of the rooms that the bot has joined"""
+        return frozenset(self._joined)
+
+    def _make_app(self) -> web.Application:
+        app = web.Application()
+        prefix = "/_matrix/client/{version}"
+        app.router.add_get("/_matrix/client/versions", self._versions)
+        app.router.add_post(prefix + "/login", self._login)
+        app.router.add_post(prefix + "/user/{user_id}/filter", self._filter)
+        app.router.add_get(prefix + "/sync", self._sync)
+        app.router.add_post(prefix + "/keys/upload", self._keys_upload)
+        app.router.add_post(prefix + "/keys/query", self._keys_query)
+        app.router.add_post(prefix + "/keys/claim", self._keys_claim)
+        app.router.add_put(prefix + "/sendToDevice/{type}/{txn_id}", self._empty)
+        app.router.add_put(prefix + "/rooms/{room_id}/send/{type}/{txn_id}", self._send)
+        app.router.add_post(prefix + "/join/{room_id}", self._join)
+        app.router.add_post(prefix + "/rooms/{room_id}/join", self._join)
+        app.router.add_get(prefix + "/rooms/{room_id}/event/{event_id}", self._event)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> None:
+        """Start listening for requests.
+
+        Args:
+            host: The address to listen on.
+
+            port: The port to listen on. If 0, a free port is picked. Once started,
+                the homeserver keeps the same port, including after an outage.
+        """
+        self.host = host
+        self._runner = web.AppRunner(
+            self._make_app(), access_log=None, shutdown_timeout=0.1
+        )
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, host, port or self.port)
+        await site.start()
+
+        if not self.port:
+            self.port = self._runner.addresses[0][1]
+        self._down = False
+
+    async def stop(self) -> None:
+        """Stop listening for requests, dropping any that are in progress"""
+        self._down = True
+        self._wakeup.set()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def outage(self, seconds: float) -> None:
+        """Become unreachable for a while, as if the homeserver had restarted.
+
+        Args:
+            seconds: How long the outage lasts.
+        """
+        await self.stop()
+        await asyncio.sleep(seconds)
+        await self.start(self.host, self.port)
+        self.outages_ended.append(time.perf_counter())
+
+    def add_room(self, room_id: str, member_count: int = 2) -> None:
+        """Add a room that the bot is joined to.
+
+        Args:
+            room_id: The ID of the room.
+
+            member_count: The number of members of the room, including the bot.
+        """
+        self._members[room_id] = [
+            f"@user{i}:localhost" for i in range(max(0, member_count - 1))
+        ]
+        self._joined.add(room_id)
+        self._new_rooms.add(room_id)
+        self._wakeup.set()
+
+    def invite(self, room_id: str, sender: str, member_count: int = 2) -> None:
+        """Invite the bot to a room. Once the bot joins, the room is added as if by
+        `add_room`.
+
+        Args:
+            room_id: The ID of the room.
+
+            sender: The user ID of the user sending the invite.
+
+            member_count: The number of members the room will have once joined.
+        """
+        self._members[room_id] = [
+            f"@user{i}:localhost" for i in range(max(0, member_count - 1))
+        ]
+        self._invited[room_id] = sender
+        self._new_invites.add(room_id)
+        self._wakeup.set()
+
+    def send_event(
+        self,
+        room_id: str,
+        sender: str,
+        event_type: str,
+        content: Dict[str, Any],
+        state_key: Optional[str] = None,
+    ) -> str:
+        """Add an event to a room's timeline, to be delivered in the next sync.
+
+        Args:
+            room_id: The ID of the room.
+
+            sender: The user ID of the event's sender.
+
+            event_type: The type of the event.
+
+            content: The content of the event.
+
+            state_key: The state key of the event, if it is a state event.
+
+        Returns:
+            The ID of the new event.
+        """
+        event = self._make_event(room_id, sender, event_type, content, state_key)
+        self._pending[room_id].append(event)
+        self._wakeup.set()
+        return event["event_id"]
+
+    def send_message(self, room_id: str, sender: str, body: str) -> str:
+        """Add a text message to a room's timeline. See `send_event`"""
+        return self.send_event(
+            room_id, sender, "m.room.message", {"msgtype": "m.text", "body": body}
+        )
+
+    def _make_event(
+        self,
+        room_id: str,
+        sender: str,
+        event_type: str,
+        content: Dict[str, Any],
+        state_key: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        self._event_count += 1
+        event = {
+            "event_id": f"$event{self._event_count}",
+            "room_id": room_id,
+            "sender": sender,
+            "type": event_type,
+            "content": content,
+            "origin_server_ts": int(time.time() * 1000),
+            "unsigned": {},
+        }
+        if state_key is not None:
+            event["state_key"] = state_key
+        self._events[event["event_id"]] = event
+        return event
+
+    def _room_state(self, room_id: str) -> List[Dict[str, Any]]:
+        members = self._members[room_id]
+        state = [
+            self._make_event(
+                room_id,
+                members[0] if members else self.user_id,
+                "m.room.create",
+                {},
+                "",
+            )
+        ]
+        for user_id in [self.user_id] + members:
+            state.append(
+                self._make_event(
+                    room_id, user_id, "m.room.member", {"membership": "join"}, user_id
+                )
+            )
+        return state
+
+    async def _fault(self, request: web.Request, endpoint: str) -> None:
+        """Apply latency and injected faults to a request, raising a response to send
+        instead if the request should fail
+        """
+        self.requests[endpoint] += 1
+
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+        if self._down or self._rng.random() < self.disconnect_rate:
+            self.disconnects += 1
+            if request.transport is not None:
+                request.transport.close()
+            raise web.HTTPServiceUnavailable()
+
+        if (
+            endpoint in RATE_LIMITED_ENDPOINTS
+            and self._rng.random() < self.rate_limit_rate
+        ):
+            self.rate_limited += 1
+            raise web.HTTPTooManyRequests(
+                text=json.dumps(
+                    {
+                        "errcode": "M_LIMIT_EXCEEDED",
+                        "error": "Too many requests",
+                        "retry_after_ms": self.retry_after_ms,
+                    }
+                ),
+                content_type="application/json",
+            )
+
+    async def _versions(self, request: web.Request) -> web.Response:
+        return web.json_response({"versions": ["r0.6.1", "v1.1", "v1.2", "v1.3"]})
+
+    async def _login(self, request: web.Request) -> web.Response:
+        await self._fault(request, "login")
+        body = await request.json()
+        return web.json_response(
+            {
+                "user_id": self.user_id,
+                "access_token": "fake_access_token",
+                "device_id": body.get("device_id") or "FAKEDEVICE",
+            }
+        )
+
+    async def _filter(self, request: web.Request) -> web.Response:
+        await self._fault(request, "filter")
+        return web.json_response({"filter_id": "1"})
+
+    async def _keys_upload(self, request: web.Request) -> web.Response:
+        await self._fault(request, "keys_upload")
+        return web.json_response({"one_time_key_counts": {"signed_curve25519": 50}})
+
+    async def _keys_query(self, request: web.Request) -> web.Response:
+        await self._fault(request, "keys_query")
+        return web.json_response({"device_keys": {}, "failures": {}})
+
+    async def _keys_claim(self, request: web.Request) -> web.Response:
+        await self._fault(request, "keys_claim")
+        return web.json_response({"one_time_keys": {}, "failures": {}})
+
+    async def _empty(self, request: web.Request) -> web.Response:
+        await self._fault(request, "to_device")
+        return web.json_response({})
+
+    async def _sync(self, request: web.Request) -> web.Response:
+        await self._fault(request, "sync")
+
+        # A sync without a token is an initial sync, which receives the state of
+        # every room
+        if "since" not in request.query:
+            self._new_rooms |= self._joined
+            self._new_invites |= set(self._invited)
+
+        timeout = min(int(request.query.get("timeout", 0)) / 1000, self.max_poll)
+        if timeout and not self._has_updates():
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        if self._down:
+            # The homeserver went down while the request was waiting
+            self.disconnects += 1
+            if request.transport is not None:
+                request.transport.close()
+            raise web.HTTPServiceUnavailable()
+
+        if self.outages_ended and len(self.reconnected) < len(self.outages_ended):
+            self.reconnected.append(time.perf_counter())
+
+        return web.json_response(self._next_batch())
+
+    def _has_updates(self) -> bool:
+        return bool(self._new_rooms or self._new_invites or any(self._pending.values()))
+
+    def _next_batch(self) -> Dict[str, Any]:
+        join: Dict[str, Any] = {}
+        for room_id in self._joined:
+            state = self._room_state(room_id) if room_id in self._new_rooms else []
+            timeline = self._pending.pop(room_id, [])
+            if not state and not timeline:
+                continue
+
+            join[room_id] = {
+                "state": {"events": state},
+                "timeline": {"events": timeline, "limited": False},
+                "ephemeral": {"events": []},
+                "account_data": {"events": []},
+            }
+        self._new_rooms.clear()
+
+        invite: Dict[str, Any] = {}
+        for room_id in self._new_invites:
+            sender = self._invited.get(room_id)
+            if sender is None:
+                continue
+            invite[room_id] = {
+                "invite_state": {
+                    "events": [
+                        {
+                            "type": "m.room.member",
+                            "sender": sender,
+                            "state_key": self.user_id,
+                            "content": {"membership": "invite"},
+                        }
+                    ]
+                }
+            }
+        self._new_invites.clear()
+
+        self._batch += 1
+        return {
+            "next_batch": f"s{self._batch}",
+            "rooms": {"join": join, "invite": invite, "leave": {}},
+            "to_device": {"events": []},
+            "presence": {"events": []},
+            "account_data": {"events": []},
+            "device_lists": {"changed": [], "left": []},
+            "device_one_time_keys_count": {"signed_curve25519": 50},
+        }
+
+    async def _send(self, request: web.Request) -> web.Response:
+        await self._fault(request, "send")
+        room_id = request.match_info["room_id"]
+        event_type = request.match_info["type"]
+        content = await request.json()
+
+        event = self._make_event(room_id, self.user_id, event_type, content)
+        self.sent_events.append((time.perf_counter(), room_id, event_type, content))
+        if self.on_send is not None:
+            self.on_send(room_id, event_type, content)
+
+        return web.json_response({"event_id": event["event_id"]})
+
+    async def _join(self, request: web.Request) -> web.Response:
+        await self._fault(request, "join")
+        room_id = request.match_info["room_id"]
+        if room_id not in self._invited and room_id not in self._joined:
+            return web.json_response(
+                {"errcode": "M_FORBIDDEN", "error": "You are not invited to this room"},
+                status=403,
+            )
+
+        if room_id not in self._joined:
+            del self._invited[room_id]
+            self._joined.add(room_id)
+            self._new_rooms.add(room_id)
+            self._wakeup.set()
+
+        return web.json_response({"room_id": room_id})
+
+    async def _event(self, request: web.Request) -> web.Response:
+        await self._fault(request, "event")
+        event = self._events.get(request.match_info["event_id"])
+        if event is None:
+            return web.json_response(
+                {"errcode": "M_NOT_FOUND", "error": "Event not found"}, status=404
+            )
+        return web.json_response(event)
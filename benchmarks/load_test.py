@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""Runs the bot's real `main()` loop against a local fake homeserver, to see how it
+copes with load and with an unreliable connection.
+
+Each scenario scripts some rooms and events on a `FakeHomeserver`, waits for the bot
+to respond, and reports throughput, response latency and reconnect behaviour:
+
+    python -m benchmarks.load_test many_rooms message_flood --output results.json
+
+The bot is asked to `echo` a unique token in each message, so that every response can
+be matched to the message that caused it.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+import yaml
+
+from benchmarks.bench_callbacks import summarise_latencies
+from benchmarks.fake_homeserver import FakeHomeserver
+from my_project_name import main as bot_main
+
+BOT_USER_ID = "@bot:localhost"
+COMMAND_PREFIX = "!c"
+
+
+class LoadTest:
+    def __init__(self, homeserver: FakeHomeserver, timeout: float = 120):
+        """Sends messages for the bot to echo, and records how long each response
+        takes to arrive.
+
+        Args:
+            homeserver: The homeserver that the bot is connected to.
+
+            timeout: The longest to wait for responses, in seconds.
+        """
+        self.homeserver = homeserver
+        self.timeout = timeout
+
+        # Token -> the time the message containing it was sent
+        self.sent: Dict[str, float] = {}
+
+        # Token -> the number of seconds the bot took to respond to it
+        self.latencies: Dict[str, float] = {}
+
+        homeserver.on_send = self._on_send
+
+    def _on_send(self, room_id: str, event_type: str, content: Dict[str, Any]) -> None:
+        token = content.get("body", "")
+        sent_at = self.sent.get(token)
+        if sent_at is not None and token not in self.latencies:
+            self.latencies[token] = time.perf_counter() - sent_at
+
+    def send_command(self, room_id: str, token: str, in_dm: bool = False) -> None:
+        """Send a message asking the bot to echo a token.
+
+        Args:
+            room_id: The room to send the message to.
+
+            token: A unique token for the bot to echo.
+
+            in_dm: Whether the room is a DM, in which commands need no prefix.
+        """
+        body = f"echo {token}" if in_dm else f"{COMMAND_PREFIX} echo {token}"
+        self.sent[token] = time.perf_counter()
+        self.homeserver.send_message(room_id, "@user0:localhost", body)
+
+    async def wait_for_responses(self) -> bool:
+        """Wait until the bot has responded to every message sent so far.
+
+        Returns:
+            Whether every response arrived before the timeout.
+        """
+        deadline = time.perf_counter() + self.timeout
+        while len(self.latencies) < len(self.sent):
+            if time.perf_counter() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    async def wait_until(self, condition: Callable[[], bool]) -> bool:
+        deadline = time.perf_counter() + self.timeout
+        while not condition():
+            if time.perf_counter() > deadline:
+                return False
+            await asyncio.sleep(0.05)
+        return True
+
+    def results(self, seconds: float) -> Dict[str, Any]:
+        homeserver = self.homeserver
+        return {
+            "seconds": seconds,
+            "messages": len(self.sent),
+            "responses": len(self.latencies),
+            "missing_responses": len(self.sent) - len(self.latencies),
+            "responses_per_second": len(self.latencies) / seconds if seconds else 0.0,
+            "latency": summarise_latencies(list(self.latencies.values())),
+            "requests": dict(homeserver.requests),
+            "rate_limited": homeserver.rate_limited,
+            "disconnects": homeserver.disconnects,
+            "reconnect_delays": [
+                reconnected - ended
+                for ended, reconnected in zip(
+                    homeserver.outages_ended, homeserver.reconnected
+                )
+            ],
+        }
+
+
+async def many_rooms(test: LoadTest, rooms: int = 2000) -> None:
+    """The bot is invited to thousands of DMs, then receives a command in each"""
+    for i in range(rooms):
+        test.homeserver.invite(f"!room{i}:localhost", "@user0:localhost")
+
+    await test.wait_until(lambda: len(test.homeserver.joined_rooms) >= rooms)
+
+    for i in range(rooms):
+        test.send_command(f"!room{i}:localhost", f"r{i}", in_dm=True)
+    await test.wait_for_responses()
+
+
+async def message_flood(
+    test: LoadTest, rooms: int = 20, messages: int = 2000, burst: int = 200
+) -> None:
+    """Bursts of commands arrive in a handful of busy group rooms"""
+    for i in range(rooms):
+        test.homeserver.add_room(f"!room{i}:localhost", member_count=10)
+
+    for i in range(messages):
+        test.send_command(f"!room{i % rooms}:localhost", f"m{i}")
+        if i % burst == burst - 1:
+            await asyncio.sleep(0.1)
+    await test.wait_for_responses()
+
+
+async def reconnect_storm(
+    test: LoadTest, outages: int = 5, outage_seconds: float = 1.0
+) -> None:
+    """The homeserver keeps going down, with messages arriving in between"""
+    test.homeserver.add_room("!room:localhost", member_count=10)
+
+    for outage in range(outages):
+        for i in range(20):
+            test.send_command("!room:localhost", f"o{outage}.{i}")
+        await test.wait_for_responses()
+        await test.homeserver.outage(outage_seconds)
+
+    test.send_command("!room:localhost", "after")
+    await test.wait_for_responses()
+
+
+async def rate_limited(test: LoadTest, rooms: int = 10, messages: int = 500) -> None:
+    """A fifth of the bot's sends are rejected with M_LIMIT_EXCEEDED"""
+    test.homeserver.rate_limit_rate = 0.2
+    for i in range(rooms):
+        test.homeserver.add_room(f"!room{i}:localhost", member_count=10)
+
+    for i in range(messages):
+        test.send_command(f"!room{i % rooms}:localhost", f"l{i}")
+    await test.wait_for_responses()
+
+
+# A scenario, and the config options it needs on top of the defaults in
+# `write_config`
+SCENARIOS: Dict[str, Any] = {
+    "many_rooms": (many_rooms, {}),
+    "message_flood": (message_flood, {}),
+    "reconnect_storm": (
+        reconnect_storm,
+        {"reconnect": {"initial_delay": 0.2, "max_delay": 2}},
+    ),
+    "rate_limited": (
+        rate_limited,
+        {
+            "send_rate_limit": {
+                "enabled": True,
+                "global_rate": 1000,
+                "global_burst": 1000,
+                "room_rate": 1000,
+                "room_burst": 1000,
+            }
+        },
+    ),
+}
+
+
+def write_config(directory: str, homeserver_url: str, overrides: Dict[str, Any]) -> str:
+    """Write a config file for a bot that connects to the fake homeserver.
+
+    Args:
+        directory: The directory to write the config file and the bot's storage to.
+
+        homeserver_url: The URL of the fake homeserver.
+
+        overrides: Top-level config sections to replace.
+
+    Returns:
+        The path of the config file.
+    """
+    config = {
+        "command_prefix": COMMAND_PREFIX,
+        "matrix": {
+            "user_id": BOT_USER_ID,
+            "user_password": "password",
+            "homeserver_url": homeserver_url,
+            "device_id": "LOADTEST",
+            "device_name": "load-test",
+        },
+        "storage": {
+            "database": "sqlite://" + os.path.join(directory, "bot.db"),
+            "store_path": os.path.join(directory, "store"),
+        },
+        # Rate limiting would otherwise be what limits throughput
+        "send_rate_limit": {"enabled": False},
+        "command_rate_limit": {"enabled": False},
+        "logging": {
+            "level": "ERROR",
+            "file_logging": {"enabled": False},
+            "console_logging": {"enabled": False},
+        },
+    }
+    config.update(overrides)
+
+    path = os.path.join(directory, "config.yaml")
+    with open(path, "w") as f:
+        yaml.safe_dump(config, f)
+    return path
+
+
+async def run_scenario(
+    scenario: Callable[..., Awaitable[None]],
+    config_overrides: Dict[str, Any],
+    latency: float = 0.0,
+    timeout: float = 120,
+) -> Dict[str, Any]:
+    """Run the bot against a fresh fake homeserver for the duration of a scenario.
+
+    Args:
+        scenario: The scenario to run.
+
+        config_overrides: Config sections to use instead of the defaults.
+
+        latency: The number of seconds the homeserver takes to answer each request.
+
+        timeout: The longest to wait for the bot to respond, in seconds.
+
+    Returns:
+        The results of the scenario.
+    """
+    homeserver = FakeHomeserver(BOT_USER_ID, latency=latency)
+    await homeserver.start()
+    test = LoadTest(homeserver, timeout)
+
+    with tempfile.TemporaryDirectory() as directory:
+        config_path = write_config(directory, homeserver.url, config_overrides)
+        bot = asyncio.ensure_future(bot_main.main(config_path))
+        try:
+            # Wait for the bot to log in and start syncing
+            await test.wait_until(lambda: homeserver.requests["sync"] > 0 or bot.done())
+            if bot.done():
+                # The bot exited early. Raise its exception, if any
+                bot.result()
+                raise RuntimeError("The bot exited before it started syncing")
+
+            start = time.perf_counter()
+            await scenario(test)
+            results = test.results(time.perf_counter() - start)
+        finally:
+            bot.cancel()
+            try:
+                await bot
+            except asyncio.CancelledError:
+                pass
+            await homeserver.stop()
+
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        default=None,
+        metavar="scenario",
+        help=f"the scenarios to run, from {', '.join(SCENARIOS)}. Defaults to all of "
+        "them",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="seconds the homeserver takes to answer each request",
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    # Checked here rather than with `choices`, as argparse checks the empty default
+    # against the choices too on older Pythons
+    unknown = [name for name in args.scenarios or () if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(unknown)}")
+    scenarios = args.scenarios or list(SCENARIOS)
+
+    logging.basicConfig(level=logging.ERROR)
+
+    results = {}
+    for name in scenarios:
+        scenario, config_overrides = SCENARIOS[name]
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            results[name] = loop.run_until_complete(
+                run_scenario(scenario, config_overrides, args.latency, args.timeout)
+            )
+        finally:
+            loop.close()
+        print(name, json.dumps(results[name], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"timestamp": time.time(), "latency": args.latency, "results": results},
+                f,
+                indent=2,
+            )
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
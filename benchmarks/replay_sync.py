@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""Replays sync responses captured from a running bot through the bot's callbacks,
+to benchmark changes against real traffic.
+
+Capture traffic by enabling `sync.capture` in the bot's config, then replay it:
+
+    python -m benchmarks.replay_sync sync_capture.jsonl.gz --output results.json
+
+Nothing is sent to a homeserver. Events that the bot would have sent are recorded
+instead, and counted in the results.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from nio import (
+    AsyncClient,
+    AsyncClientConfig,
+    JoinResponse,
+    RoomGetEventError,
+    RoomGetEventResponse,
+    RoomSendResponse,
+    SyncResponse,
+)
+
+from my_project_name import message_responses
+from my_project_name.callbacks import Callbacks
+from my_project_name.chat_functions import set_outbound_queue, set_own_event_index
+from my_project_name.config import Config
+from my_project_name.dispatcher import EventDispatcher
+from my_project_name.own_events import OwnEventIndex
+from my_project_name.storage import Storage
+from my_project_name.sync_capture import read_capture, replay_capture
+
+
+class ReplayClient(AsyncClient):
+    def __init__(self, user_id: str):
+        """A client that records the requests the bot makes instead of sending them.
+
+        Events received in replayed syncs are remembered, so that the bot can look
+        them up as it would on the homeserver.
+
+        Args:
+            user_id: The user ID of the bot that the traffic was captured from.
+        """
+        super().__init__(
+            "https://replay.invalid",
+            user_id,
+            config=AsyncClientConfig(encryption_enabled=False),
+        )
+        self.user_id = user_id
+
+        # Each event the bot sent, as (room ID, type, content)
+        self.sent: List[Any] = []
+        self.joined: List[str] = []
+        self.timeline_events = 0
+
+        self._events: Dict[str, Dict[str, Any]] = {}
+
+    async def receive_response(self, response: Any) -> None:
+        if isinstance(response, SyncResponse):
+            for room in response.rooms.join.values():
+                for event in room.timeline.events:
+                    self._events[event.event_id] = event.source
+                    self.timeline_events += 1
+
+        await super().receive_response(response)
+
+    async def room_send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        tx_id: Optional[str] = None,
+        ignore_unverified_devices: bool = False,
+    ) -> RoomSendResponse:
+        self.sent.append((room_id, message_type, content))
+        return RoomSendResponse(f"$replay{len(self.sent)}", room_id)
+
+    async def room_get_event(self, room_id: str, event_id: str) -> Any:
+        source = self._events.get(event_id)
+        if source is None:
+            return RoomGetEventError("Event not found in capture", "M_NOT_FOUND")
+        return RoomGetEventResponse.from_dict(source)
+
+    async def join(self, room_id: str) -> JoinResponse:
+        self.joined.append(room_id)
+        return JoinResponse(room_id)
+
+
+def captured_user_id(filepath: str) -> str:
+    """Get the user ID of the bot that a capture was recorded from"""
+    for kind, _, entry in read_capture(filepath):
+        if kind == "header":
+            return entry["user_id"]
+    raise ValueError(f"{filepath} has no header line")
+
+
+async def replay(
+    filepath: str,
+    config_path: Optional[str] = None,
+    realtime: bool = False,
+    speed: float = 1.0,
+    max_gap: Optional[float] = None,
+) -> Dict[str, Any]:
+    """Replay a capture through a fresh set of callbacks.
+
+    Args:
+        filepath: The path of a capture file written by `SyncCapture`.
+
+        config_path: The path of a bot config file, used to configure the callbacks
+            and dispatcher. If None, the defaults are used.
+
+        realtime: Whether to replay at the speed the traffic was captured at.
+
+        speed: When replaying in real time, how many times faster to replay.
+
+        max_gap: When replaying in real time, the longest to wait between responses.
+
+    Returns:
+        The results of the replay.
+    """
+    user_id = captured_user_id(filepath)
+    client = ReplayClient(user_id)
+    store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+
+    if config_path:
+        config: Any = Config(config_path)
+        dispatcher = EventDispatcher(
+            max_workers=config.dispatch_max_workers,
+            max_queue_size=config.dispatch_max_queue_size,
+            handler_timeout=config.dispatch_handler_timeout,
+        )
+    else:
+        config = SimpleNamespace(command_prefix="!c ", user_id=user_id)
+        dispatcher = EventDispatcher()
+    # The user the traffic was captured for must be the bot, whatever the config says
+    config.user_id = user_id
+
+    set_outbound_queue(None)
+    own_events = OwnEventIndex(store)
+    set_own_event_index(own_events)
+    callbacks = Callbacks(client, store, config, own_events=own_events)
+    for handler, event_class in callbacks.event_handlers():
+        client.add_event_callback(dispatcher.wrap(handler), (event_class,))
+    message_responses.triggers.compile()
+
+    try:
+        start = time.perf_counter()
+        responses = await replay_capture(client, filepath, realtime, speed, max_gap)
+        await dispatcher.join()
+        seconds = time.perf_counter() - start
+    finally:
+        set_own_event_index(None)
+        await store.close()
+        await client.close()
+
+    return {
+        "capture": filepath,
+        "realtime": realtime,
+        "results": {
+            "seconds": seconds,
+            "sync_responses": responses,
+            "timeline_events": client.timeline_events,
+            "events_per_second": client.timeline_events / seconds if seconds else 0.0,
+            "sent_events": dict(
+                Counter(event_type for _, event_type, _ in client.sent)
+            ),
+            "joined_rooms": len(client.joined),
+        },
+    }
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("capture", help="the capture file to replay")
+    parser.add_argument("--config", help="the bot config file to use")
+    parser.add_argument(
+        "--realtime",
+        action="store_true",
+        help="replay at the speed the traffic was captured, rather than as fast as "
+        "possible",
+    )
+    parser.add_argument(
+        "--speed",
+        type=float,
+        default=1.0,
+        help="with --realtime, replay this many times faster than real time",
+    )
+    parser.add_argument(
+        "--max-gap",
+        type=float,
+        default=None,
+        help="with --realtime, never wait longer than this many seconds between "
+        "sync responses",
+    )
+    parser.add_argument("--output", help="save the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    if not args.config:
+        logging.basicConfig(level=logging.CRITICAL)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        result = loop.run_until_complete(
+            replay(args.capture, args.config, args.realtime, args.speed, args.max_gap)
+        )
+    finally:
+        loop.close()
+    print(json.dumps(result["results"], indent=2))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,63 @@
+from typing import Awaitable, Callable, Dict
+
 from nio import AsyncClient, MatrixRoom, RoomMessageText
 
 from my_project_name.chat_functions import react_to_event, send_text_to_room
 from my_project_name.config import Config
 from my_project_name.storage import Storage
 
+# A function that handles a command
+CommandHandler = Callable[["Command"], Awaitable[None]]
+
+# Maps each command name and alias to the method that handles it. Populated by the
+# `command` decorator
+commands: Dict[str, CommandHandler] = {}
+
+HELP_TEXT = (
+    "Hello, I am a bot made with matrix-nio! Use `help commands` to view "
+    "available commands."
+)
+HELP_TOPICS = {
+    "rules": "These are the rules!",
+    "commands": "Available commands: ...",
+}
+UNKNOWN_HELP_TOPIC_TEXT = "Unknown help topic!"
+
+# Responses that never change, and so can be rendered ahead of time
+static_responses = [HELP_TEXT, UNKNOWN_HELP_TOPIC_TEXT, *HELP_TOPICS.values()]
+
+
+def command(name: str, *aliases: str) -> Callable[[CommandHandler], CommandHandler]:
+    """Register a method of `Command` as the handler for a command.
+
+    Args:
+        name: The name of the command, i.e. the first word of the command message.
+
+        aliases: Other names that the command can also be called with.
+    """
+
+    def decorator(func: CommandHandler) -> CommandHandler:
+        for command_name in (name,) + aliases:
+            if command_name in commands:
+                raise ValueError(f"Command '{command_name}' is already registered")
+            commands[command_name] = func
+        return func
+
+    return decorator
+
 
 class Command:
+    __slots__ = (
+        "client",
+        "store",
+        "config",
+        "command",
+        "room",
+        "event",
+        "name",
+        "args",
+    )
+
     def __init__(
         self,
         client: AsyncClient,
@@ -36,24 +88,24 @@ class Command:
         self.command = command
         self.room = room
         self.event = event
-        self.args = self.command.split()[1:]
+
+        # Split the command into its name and arguments
+        words = self.command.split()
+        self.name = words[0] if words else ""
+        self.args = words[1:]
 
     async def process(self):
         """Process the command"""
-        if self.command.startswith("echo"):
-            await self._echo()
-        elif self.command.startswith("react"):
-            await self._react()
-        elif self.command.startswith("help"):
-            await self._show_help()
-        else:
-            await self._unknown_command()
+        handler = commands.get(self.name, Command._unknown_command)
+        await handler(self)
 
+    @command("echo")
     async def _echo(self):
         """Echo back the command's arguments"""
         response = " ".join(self.args)
         await send_text_to_room(self.client, self.room.room_id, response)
 
+    @command("react")
     async def _react(self):
         """Make the bot react to the command message"""
         # React with a start emoji
@@ -68,23 +120,14 @@ class Command:
             self.client, self.room.room_id, self.event.event_id, reaction
         )
 
+    @command("help")
     async def _show_help(self):
         """Show the help text"""
         if not self.args:
-            text = (
-                "Hello, I am a bot made with matrix-nio! Use `help commands` to view "
-                "available commands."
-            )
-            await send_text_to_room(self.client, self.room.room_id, text)
+            await send_text_to_room(self.client, self.room.room_id, HELP_TEXT)
             return
 
-        topic = self.args[0]
-        if topic == "rules":
-            text = "These are the rules!"
-        elif topic == "commands":
-            text = "Available commands: ..."
-        else:
-            text = "Unknown help topic!"
+        text = HELP_TOPICS.get(self.args[0], UNKNOWN_HELP_TOPIC_TEXT)
         await send_text_to_room(self.client, self.room.room_id, text)
 
     async def _unknown_command(self):
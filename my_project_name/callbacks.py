@@ -1,7 +1,9 @@
 import logging
+from typing import List, Optional, Tuple, Type
 
 from nio import (
     AsyncClient,
+    Event,
     InviteMemberEvent,
     JoinError,
     MatrixRoom,
@@ -11,17 +13,39 @@ from nio import (
     UnknownEvent,
 )
 
-from my_project_name.bot_commands import Command
+from my_project_name.bot_commands import Command, commands
 from my_project_name.chat_functions import make_pill, react_to_event, send_text_to_room
 from my_project_name.config import Config
-from my_project_name.message_responses import Message
+from my_project_name.decryption_retry import DecryptionRetryQueue
+from my_project_name.dispatcher import EventHandler
+from my_project_name.join_queue import JoinQueue
+from my_project_name.message_responses import Message, triggers as message_triggers
+from my_project_name.metrics import (
+    COMMAND_SECONDS,
+    MESSAGE_SECONDS,
+    RATE_LIMITED_COMMANDS,
+)
+from my_project_name.own_events import OwnEventIndex
+from my_project_name.processed_events import ProcessedEventLedger
+from my_project_name.rate_limit import CommandRateLimiter
 from my_project_name.storage import Storage
+from my_project_name.tracing import tracer
 
 logger = logging.getLogger(__name__)
 
 
 class Callbacks:
-    def __init__(self, client: AsyncClient, store: Storage, config: Config):
+    def __init__(
+        self,
+        client: AsyncClient,
+        store: Storage,
+        config: Config,
+        own_events: Optional[OwnEventIndex] = None,
+        processed_events: Optional[ProcessedEventLedger] = None,
+        join_queue: Optional[JoinQueue] = None,
+        decryption_retry: Optional[DecryptionRetryQueue] = None,
+        rate_limiter: Optional[CommandRateLimiter] = None,
+    ):
         """
         Args:
             client: nio client used to interact with matrix.
@@ -29,12 +53,100 @@ class Callbacks:
             store: Bot storage.
 
             config: Bot configuration parameters.
+
+            own_events: An index of the events sent by the bot. If provided, it is
+                used to check whether reactions are to our own events, without
+                asking the homeserver.
+
+            processed_events: A record of the events that the bot has handled. If
+                provided, messages and reactions that have already been handled are
+                skipped.
+
+            join_queue: If provided, rooms that we are invited to are joined in the
+                background through this queue, rather than while handling the invite.
+
+            decryption_retry: If provided, events that could not be decrypted are
+                kept here and handled once their keys arrive.
+
+            rate_limiter: If provided, commands and messages that the bot would
+                respond to are ignored when their sender or room sends them too
+                quickly.
         """
         self.client = client
         self.store = store
         self.config = config
+        self.own_events = own_events
+        self.processed_events = processed_events
+        self.join_queue = join_queue
+        self.decryption_retry = decryption_retry
+        self.rate_limiter = rate_limiter
         self.command_prefix = config.command_prefix
 
+    def config_reloaded(self, options: List[str]) -> None:
+        """Pick up the new values of config options after the config is reloaded.
+
+        Args:
+            options: The options that were changed. See `RELOADABLE_OPTIONS`.
+        """
+        self.command_prefix = self.config.command_prefix
+
+        if "command_rate_limit" in options:
+            # Users and rooms start again with full buckets
+            self.rate_limiter = None
+            if self.config.command_rate_limit_enabled:
+                self.rate_limiter = CommandRateLimiter(**self.config.command_rate_limit)
+
+    def event_handlers(self) -> List[Tuple[EventHandler, Type[Event]]]:
+        """The callback to register for each class of event that the bot handles.
+
+        Returns:
+            A list of (callback, event class) tuples.
+        """
+        return [
+            (self.message, RoomMessageText),
+            (self.invite_event_filtered_callback, InviteMemberEvent),
+            (self.decryption_failure, MegolmEvent),
+            (self.unknown, UnknownEvent),
+        ]
+
+    async def _first_time(self, event: Event) -> bool:
+        """Check whether an event has not been handled before, and record that it is
+        being handled now.
+        """
+        if self.processed_events is None:
+            return True
+        return await self.processed_events.claim(self.client.user, event.event_id)
+
+    async def _allow(self, room: MatrixRoom, event: RoomMessageText) -> bool:
+        """Check whether the sender and room of a message that the bot would respond
+        to are within their rate limits. If not, the room is told to slow down, at
+        most once per notice interval.
+        """
+        if self.rate_limiter is None:
+            return True
+
+        limit = self.rate_limiter.check(event.sender, room.room_id)
+        if limit is None:
+            return True
+
+        RATE_LIMITED_COMMANDS.inc(account=self.client.user_id, limit=limit)
+        logger.debug(
+            "Ignoring message %s from %s in %s (%s rate limit)",
+            event.event_id,
+            event.sender,
+            room.room_id,
+            limit,
+        )
+        if self.rate_limiter.should_notify(room.room_id):
+            target = make_pill(event.sender) if limit == "user" else "everyone"
+            await send_text_to_room(
+                self.client,
+                room.room_id,
+                f"Slow down {target}! Some messages are being ignored.",
+                reply_to_event_id=event.event_id,
+            )
+        return False
+
     async def message(self, room: MatrixRoom, event: RoomMessageText) -> None:
         """Callback for when a message event is received
 
@@ -43,39 +155,71 @@ class Callbacks:
 
             event: The event defining the message.
         """
-        # Extract the message text
-        msg = event.body
+        with tracer.start_trace(
+            "message", room_id=room.room_id, event_id=event.event_id
+        ):
+            # Extract the message text
+            msg = event.body
+
+            # Ignore messages from ourselves
+            if event.sender == self.client.user:
+                return
 
-        # Ignore messages from ourselves
-        if event.sender == self.client.user:
-            return
+            logger.debug(
+                f"Bot message received for room {room.display_name} | "
+                f"{room.user_name(event.sender)}: {msg}"
+            )
 
-        logger.debug(
-            f"Bot message received for room {room.display_name} | "
-            f"{room.user_name(event.sender)}: {msg}"
-        )
+            # Process as message if in a public room without command prefix
+            has_command_prefix = msg.startswith(self.command_prefix)
+
+            # room.is_group is often a DM, but not always.
+            # room.is_group does not allow room aliases
+            # room.member_count > 2 ... we assume a public room
+            # room.member_count <= 2 ... we assume a DM
+            if not has_command_prefix and room.member_count > 2:
+                # Only messages that the bot responds to are recorded as handled, and
+                # count towards rate limits
+                handlers = message_triggers.match(msg)
+                if handlers:
+                    # Ignore messages we have already responded to
+                    if not await self._first_time(event):
+                        return
+                    if not await self._allow(room, event):
+                        return
+
+                # General message listener
+                message = Message(
+                    self.client,
+                    self.store,
+                    self.config,
+                    msg,
+                    room,
+                    event,
+                    handlers=handlers,
+                )
+                with MESSAGE_SECONDS.time(), tracer.span("message.process"):
+                    await message.process()
+                return
 
-        # Process as message if in a public room without command prefix
-        has_command_prefix = msg.startswith(self.command_prefix)
-
-        # room.is_group is often a DM, but not always.
-        # room.is_group does not allow room aliases
-        # room.member_count > 2 ... we assume a public room
-        # room.member_count <= 2 ... we assume a DM
-        if not has_command_prefix and room.member_count > 2:
-            # General message listener
-            message = Message(self.client, self.store, self.config, msg, room, event)
-            await message.process()
-            return
+            # Otherwise if this is in a 1-1 with the bot or features a command prefix,
+            # treat it as a command
+            if has_command_prefix:
+                # Remove the command prefix
+                msg = msg[len(self.command_prefix) :]
 
-        # Otherwise if this is in a 1-1 with the bot or features a command prefix,
-        # treat it as a command
-        if has_command_prefix:
-            # Remove the command prefix
-            msg = msg[len(self.command_prefix) :]
+            # Ignore commands we have already responded to
+            if not await self._first_time(event):
+                return
+            if not await self._allow(room, event):
+                return
 
-        command = Command(self.client, self.store, self.config, msg, room, event)
-        await command.process()
+            command = Command(self.client, self.store, self.config, msg, room, event)
+            command_label = command.name if command.name in commands else "unknown"
+            with COMMAND_SECONDS.time(command=command_label), tracer.span(
+                "command.process", command=command_label
+            ):
+                await command.process()
 
     async def invite(self, room: MatrixRoom, event: InviteMemberEvent) -> None:
         """Callback for when an invite is received. Join the room specified in the invite.
@@ -87,6 +231,10 @@ class Callbacks:
         """
         logger.debug(f"Got invite to {room.room_id} from {event.sender}.")
 
+        if self.join_queue is not None:
+            self.join_queue.add(room.room_id)
+            return
+
         # Attempt to join 3 times before giving up
         for attempt in range(3):
             result = await self.client.join(room.room_id)
@@ -97,13 +245,12 @@ class Callbacks:
                     result.message,
                 )
             else:
+                # Successfully joined room
+                logger.info(f"Joined {room.room_id}")
                 break
         else:
             logger.error("Unable to join room: %s", room.room_id)
 
-        # Successfully joined room
-        logger.info(f"Joined {room.room_id}")
-
     async def invite_event_filtered_callback(
         self, room: MatrixRoom, event: InviteMemberEvent
     ) -> None:
@@ -131,17 +278,32 @@ class Callbacks:
         """
         logger.debug(f"Got reaction to {room.room_id} from {event.sender}.")
 
-        # Get the original event that was reacted to
-        event_response = await self.client.room_get_event(room.room_id, reacted_to_id)
-        if isinstance(event_response, RoomGetEventError):
-            logger.warning(
-                "Error getting event that was reacted to (%s)", reacted_to_id
+        # Find out who sent the original event that was reacted to, asking the
+        # homeserver if we don't know
+        sender = None
+        if self.own_events:
+            sender = await self.own_events.get_sender(reacted_to_id)
+
+        if sender is None:
+            event_response = await self.client.room_get_event(
+                room.room_id, reacted_to_id
             )
-            return
-        reacted_to_event = event_response.event
+            if isinstance(event_response, RoomGetEventError):
+                logger.warning(
+                    "Error getting event that was reacted to (%s)", reacted_to_id
+                )
+                return
+            sender = event_response.event.sender
+
+            if self.own_events:
+                self.own_events.remember(reacted_to_id, sender)
 
         # Only acknowledge reactions to events that we sent
-        if reacted_to_event.sender != self.config.user_id:
+        if sender != self.client.user:
+            return
+
+        # Ignore reactions we have already acknowledged
+        if not await self._first_time(event):
             return
 
         # Send a message acknowledging the reaction
@@ -167,6 +329,19 @@ class Callbacks:
 
             event: The encrypted event that we were unable to decrypt.
         """
+        if self.decryption_retry is not None:
+            # Handle the event once we have its key
+            await self.decryption_retry.park(event)
+
+            # Only tell each room about decryption failures every so often
+            if not self.decryption_retry.should_react(room.room_id):
+                logger.debug(
+                    "Failed to decrypt event '%s' in room '%s'",
+                    event.event_id,
+                    room.room_id,
+                )
+                return
+
         logger.error(
             f"Failed to decrypt event '{event.event_id}' in room '{room.room_id}'!"
             f"\n\n"
@@ -197,15 +372,18 @@ class Callbacks:
 
             event: The event itself.
         """
-        if event.type == "m.reaction":
-            # Get the ID of the event this was a reaction to
-            relation_dict = event.source.get("content", {}).get("m.relates_to", {})
-
-            reacted_to = relation_dict.get("event_id")
-            if reacted_to and relation_dict.get("rel_type") == "m.annotation":
-                await self._reaction(room, event, reacted_to)
-                return
-
-        logger.debug(
-            f"Got unknown event with type to {event.type} from {event.sender} in {room.room_id}."
-        )
+        with tracer.start_trace(
+            "unknown", room_id=room.room_id, event_id=event.event_id
+        ):
+            if event.type == "m.reaction":
+                # Get the ID of the event this was a reaction to
+                relation_dict = event.source.get("content", {}).get("m.relates_to", {})
+
+                reacted_to = relation_dict.get("event_id")
+                if reacted_to and relation_dict.get("rel_type") == "m.annotation":
+                    await self._reaction(room, event, reacted_to)
+                    return
+
+            logger.debug(
+                f"Got unknown event with type to {event.type} from {event.sender} in {room.room_id}."
+            )
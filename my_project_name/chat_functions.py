@@ -1,7 +1,7 @@
 import logging
-from typing import Optional, Union
+from functools import lru_cache
+from typing import Any, Dict, Iterable, Optional, Union
 
-from markdown import markdown
 from nio import (
     AsyncClient,
     ErrorResponse,
@@ -12,8 +12,147 @@ from nio import (
     SendRetryError,
 )
 
+from my_project_name.metrics import ROOM_SEND_ERRORS, ROOM_SEND_SECONDS
+from my_project_name.own_events import OwnEventIndex
+from my_project_name.send_queue import (
+    PRIORITY_MESSAGE,
+    PRIORITY_REACTION,
+    OutboundQueue,
+)
+from my_project_name.session_warming import share_room_session
+from my_project_name.tracing import tracer
+
 logger = logging.getLogger(__name__)
 
+# The queue that events are sent through. If None, events are sent straight away.
+# See `set_outbound_queue`
+outbound_queue: Optional[OutboundQueue] = None
+
+
+def set_outbound_queue(queue: Optional[OutboundQueue]) -> None:
+    """Set the queue that all events sent by the bot should go through, so that the
+    bot stays within the homeserver's rate limits.
+
+    Args:
+        queue: The queue to use, or None to send events straight away.
+    """
+    global outbound_queue
+    outbound_queue = queue
+
+
+# The index that events sent by the bot are recorded in. See `set_own_event_index`
+own_event_index: Optional[OwnEventIndex] = None
+
+
+def set_own_event_index(index: Optional[OwnEventIndex]) -> None:
+    """Set the index that events sent by the bot should be recorded in.
+
+    Args:
+        index: The index to use, or None to not record sent events.
+    """
+    global own_event_index
+    own_event_index = index
+
+
+async def _room_send(
+    client: AsyncClient,
+    room_id: str,
+    message_type: str,
+    content: Dict[str, Any],
+    priority: int,
+) -> Union[Response, ErrorResponse]:
+    """Send an event to a room, through the outbound queue if one is set. The sent
+    event is recorded in the own event index if one is set.
+    """
+    try:
+        with ROOM_SEND_SECONDS.time(
+            account=client.user_id, event_type=message_type
+        ), tracer.span("room_send", event_type=message_type):
+            # Share a session with the room first if it needs one, so that the time
+            # this takes is recorded. A session warmer usually shares it beforehand
+            await share_room_session(client, room_id, "inline")
+
+            if outbound_queue is not None:
+                response = await outbound_queue.send(
+                    client, room_id, message_type, content, priority=priority
+                )
+            else:
+                response = await client.room_send(
+                    room_id,
+                    message_type,
+                    content,
+                    ignore_unverified_devices=True,
+                )
+    except Exception as e:
+        ROOM_SEND_ERRORS.inc(
+            account=client.user_id,
+            event_type=message_type,
+            error=type(e).__name__,
+        )
+        raise
+
+    if isinstance(response, ErrorResponse):
+        ROOM_SEND_ERRORS.inc(
+            account=client.user_id,
+            event_type=message_type,
+            error=response.status_code or "unknown",
+        )
+
+    if own_event_index is not None and isinstance(response, RoomSendResponse):
+        await own_event_index.add(response.event_id, room_id, client.user_id)
+
+    return response
+
+
+def _render_markdown(text: str) -> str:
+    """Render markdown text to HTML"""
+    # Imported here so that the markdown package is only loaded once it is needed
+    from markdown import markdown
+
+    return markdown(text)
+
+
+# Renders markdown text to HTML, caching the most recently rendered texts.
+# See `set_markdown_cache_size`
+render_markdown = lru_cache(maxsize=1024)(_render_markdown)
+
+
+def set_markdown_cache_size(maxsize: int) -> None:
+    """Set the maximum number of rendered markdown texts to cache. Clears the cache.
+
+    Args:
+        maxsize: The maximum number of texts to cache. 0 disables caching.
+    """
+    global render_markdown
+    render_markdown = lru_cache(maxsize=maxsize)(_render_markdown)
+
+
+def prerender_markdown(texts: Iterable[str]) -> None:
+    """Render texts that the bot often sends ahead of time, so that they are cached
+    before they are first sent.
+
+    Args:
+        texts: The markdown texts to render.
+    """
+    for text in texts:
+        render_markdown(text)
+
+
+def markdown_cache_info() -> Dict[str, int]:
+    """Get statistics about the rendered markdown cache.
+
+    Returns:
+        A dictionary with the number of cache hits and misses, and the current and
+        maximum size of the cache.
+    """
+    info = render_markdown.cache_info()
+    return {
+        "hits": info.hits,
+        "misses": info.misses,
+        "size": info.currsize,
+        "max_size": info.maxsize,
+    }
+
 
 async def send_text_to_room(
     client: AsyncClient,
@@ -54,17 +193,15 @@ async def send_text_to_room(
     }
 
     if markdown_convert:
-        content["formatted_body"] = markdown(message)
+        with tracer.span("markdown.render"):
+            content["formatted_body"] = render_markdown(message)
 
     if reply_to_event_id:
         content["m.relates_to"] = {"m.in_reply_to": {"event_id": reply_to_event_id}}
 
     try:
-        return await client.room_send(
-            room_id,
-            "m.room.message",
-            content,
-            ignore_unverified_devices=True,
+        return await _room_send(
+            client, room_id, "m.room.message", content, PRIORITY_MESSAGE
         )
     except SendRetryError:
         logger.exception(f"Unable to send message response to {room_id}")
@@ -121,12 +258,7 @@ async def react_to_event(
         }
     }
 
-    return await client.room_send(
-        room_id,
-        "m.reaction",
-        content,
-        ignore_unverified_devices=True,
-    )
+    return await _room_send(client, room_id, "m.reaction", content, PRIORITY_REACTION)
 
 
 async def decryption_failure(self, room: MatrixRoom, event: MegolmEvent) -> None:
@@ -2,11 +2,12 @@ import logging
 import os
 import re
 import sys
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import yaml
 
 from my_project_name.errors import ConfigError
+from my_project_name.session_warming import WARMING_POLICIES
 
 logger = logging.getLogger()
 logging.getLogger("peewee").setLevel(
@@ -14,10 +15,89 @@ logging.getLogger("peewee").setLevel(
 )  # Prevent debug messages from peewee lib
 
 
+# The allowed values of SQLite pragmas that take a keyword
+SQLITE_PRAGMA_CHOICES = {
+    "journal_mode": ("delete", "truncate", "persist", "memory", "wal", "off"),
+    "synchronous": ("off", "normal", "full", "extra"),
+    "temp_store": ("default", "file", "memory"),
+}
+
+# The options that can be changed while the bot is running, by their path in the config
+# file, along with the Config attributes that they set
+RELOADABLE_OPTIONS = {
+    "command_prefix": ("command_prefix",),
+    "logging.level": ("log_level",),
+    "command_rate_limit": ("command_rate_limit_enabled", "command_rate_limit"),
+}
+
+
+def _changed_options(old: Any, new: Any, path: str = "") -> List[str]:
+    """Find the options that differ between two parsed config files.
+
+    Returns:
+        The dotted paths of the changed options. Sections are compared option by
+        option, and anything else, such as a list, as a whole.
+    """
+    if isinstance(old, dict) and isinstance(new, dict):
+        changed = []
+        for key in sorted(set(old) | set(new), key=str):
+            key_path = f"{path}.{key}" if path else str(key)
+            changed += _changed_options(old.get(key), new.get(key), key_path)
+        return changed
+
+    return [] if old == new else [path]
+
+
+class AccountConfig:
+    def __init__(
+        self,
+        user_id: str,
+        user_password: Optional[str],
+        user_token: Optional[str],
+        device_id: str,
+        device_name: str,
+        homeserver_url: str,
+        store_path: str,
+    ):
+        """The options for one Matrix account that the bot runs as.
+
+        Args:
+            user_id: The Matrix user ID of the account.
+
+            user_password: The account's password, if not logging in with a token.
+
+            user_token: The account's access token, if not logging in with a password.
+
+            device_id: The device ID to log in with.
+
+            device_name: What to name the logged in device.
+
+            homeserver_url: The URL of the homeserver to connect to.
+
+            store_path: The folder to keep the account's encryption keys and sync
+                token in.
+        """
+        self.user_id = user_id
+        self.user_password = user_password
+        self.user_token = user_token
+        self.device_id = device_id
+        self.device_name = device_name
+        self.homeserver_url = homeserver_url
+        self.store_path = store_path
+
+
 class Config:
     """Creates a Config object from a YAML-encoded config file from a given filepath"""
 
-    def __init__(self, filepath: str):
+    def __init__(self, filepath: str, setup_logging: bool = True):
+        """
+        Args:
+            filepath: The path of the config file.
+
+            setup_logging: Whether to configure logging as the config file says.
+                Disabled when re-reading the config of a running bot, whose logging
+                is already set up.
+        """
         self.filepath = filepath
         if not os.path.isfile(filepath):
             raise ConfigError(f"Config file '{filepath}' does not exist")
@@ -25,50 +105,37 @@ class Config:
         # Load in the config file at the given filepath
         with open(filepath) as file_stream:
             self.config_dict = yaml.safe_load(file_stream.read())
+        if not isinstance(self.config_dict, dict):
+            raise ConfigError(f"Config file '{filepath}' must contain config options")
 
         # Parse and validate config options
         self._parse_config_values()
 
+        if setup_logging:
+            self._setup_logging()
+
     def _parse_config_values(self):
         """Read and validate each config option"""
         # Logging setup
-        formatter = logging.Formatter(
-            "%(asctime)s | %(name)s [%(levelname)s] %(message)s"
-        )
+        self.log_level = self._get_cfg(["logging", "level"], default="INFO")
+        if not isinstance(self.log_level, int) and not isinstance(
+            logging.getLevelName(self.log_level), int
+        ):
+            raise ConfigError("logging.level must be a log level, such as INFO")
 
-        log_level = self._get_cfg(["logging", "level"], default="INFO")
-        logger.setLevel(log_level)
-
-        file_logging_enabled = self._get_cfg(
+        self.file_logging_enabled = self._get_cfg(
             ["logging", "file_logging", "enabled"], default=False
         )
-        file_logging_filepath = self._get_cfg(
+        self.file_logging_filepath = self._get_cfg(
             ["logging", "file_logging", "filepath"], default="bot.log"
         )
-        if file_logging_enabled:
-            handler = logging.FileHandler(file_logging_filepath)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
-
-        console_logging_enabled = self._get_cfg(
+        self.console_logging_enabled = self._get_cfg(
             ["logging", "console_logging", "enabled"], default=True
         )
-        if console_logging_enabled:
-            handler = logging.StreamHandler(sys.stdout)
-            handler.setFormatter(formatter)
-            logger.addHandler(handler)
 
         # Storage setup
         self.store_path = self._get_cfg(["storage", "store_path"], required=True)
-
-        # Create the store folder if it doesn't exist
-        if not os.path.isdir(self.store_path):
-            if not os.path.exists(self.store_path):
-                os.mkdir(self.store_path)
-            else:
-                raise ConfigError(
-                    f"storage.store_path '{self.store_path}' is not a directory"
-                )
+        self._make_store_dir(self.store_path, "storage.store_path")
 
         # Database setup
         database_path = self._get_cfg(["storage", "database"], required=True)
@@ -81,29 +148,454 @@ class Config:
             self.database = {
                 "type": "sqlite",
                 "connection_string": database_path[len(sqlite_scheme) :],
+                "pragmas": self._parse_sqlite_pragmas(),
             }
         elif database_path.startswith(postgres_scheme):
-            self.database = {"type": "postgres", "connection_string": database_path}
+            self.database = {
+                "type": "postgres",
+                "connection_string": database_path,
+                "max_connections": self._get_cfg(
+                    ["storage", "max_connections"], default=10
+                ),
+            }
         else:
             raise ConfigError("Invalid connection string for storage.database")
 
-        # Matrix bot account setup
-        self.user_id = self._get_cfg(["matrix", "user_id"], required=True)
-        if not re.match("@.*:.*", self.user_id):
-            raise ConfigError("matrix.user_id must be in the form @name:domain")
+        # Optionally buffer writes and flush them to the database in batches
+        if self._get_cfg(
+            ["storage", "write_behind", "enabled"], default=False, required=False
+        ):
+            self.database["write_behind"] = {
+                "max_batch_size": self._get_cfg(
+                    ["storage", "write_behind", "max_batch_size"], default=500
+                ),
+                "flush_interval": self._get_cfg(
+                    ["storage", "write_behind", "flush_interval"], default=1.0
+                ),
+                "max_buffer_size": self._get_cfg(
+                    ["storage", "write_behind", "max_buffer_size"], default=5000
+                ),
+            }
+
+        # Matrix bot account setup. `matrix` is either a single account, or a list of
+        # accounts that all run in this process
+        self.accounts = self._parse_accounts()
+
+        # The first account's options, for the parts of the bot that only support one
+        account = self.accounts[0]
+        self.user_id = account.user_id
+        self.user_password = account.user_password
+        self.user_token = account.user_token
+        self.device_id = account.device_id
+        self.device_name = account.device_name
+        self.homeserver_url = account.homeserver_url
+
+        self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
+
+        self.markdown_cache_size = self._get_cfg(
+            ["markdown_cache_size"], default=1024, required=False
+        )
+
+        # Event dispatch setup
+        self.dispatch_max_workers = self._get_cfg(
+            ["event_dispatch", "max_workers"], default=8
+        )
+        self.dispatch_max_queue_size = self._get_cfg(
+            ["event_dispatch", "max_queue_size"], default=100
+        )
+        self.dispatch_handler_timeout = self._get_cfg(
+            ["event_dispatch", "handler_timeout"], default=60
+        )
+        if self.dispatch_max_workers < 1:
+            raise ConfigError("event_dispatch.max_workers must be at least 1")
+        if self.dispatch_max_queue_size < 1:
+            raise ConfigError("event_dispatch.max_queue_size must be at least 1")
+
+        # Reconnect setup
+        self.reconnect_initial_delay = self._get_cfg(
+            ["reconnect", "initial_delay"], default=1
+        )
+        self.reconnect_max_delay = self._get_cfg(
+            ["reconnect", "max_delay"], default=300
+        )
+
+        # Invite handling setup
+        self.join_queue = {
+            "max_concurrent": self._get_cfg(
+                ["invites", "max_concurrent_joins"], default=4
+            ),
+            "max_attempts": self._get_cfg(["invites", "max_attempts"], default=5),
+            "initial_delay": self._get_cfg(["invites", "initial_delay"], default=1),
+            "max_delay": self._get_cfg(["invites", "max_delay"], default=300),
+        }
+        if self.join_queue["max_concurrent"] < 1:
+            raise ConfigError("invites.max_concurrent_joins must be at least 1")
+        if self.join_queue["max_attempts"] < 1:
+            raise ConfigError("invites.max_attempts must be at least 1")
+
+        # Sync setup
+        self.sync_full_state = self._get_cfg(
+            ["sync", "full_state"], default=False, required=False
+        )
+        self.sync_lazy_load_members = self._get_cfg(
+            ["sync", "lazy_load_members"], default=True
+        )
+        self.sync_timeline_limit = self._get_cfg(
+            ["sync", "timeline_limit"], required=False
+        )
+        self.sync_rooms = self._get_cfg(["sync", "rooms"], default=[], required=False)
+        self.sync_ignored_rooms = self._get_cfg(
+            ["sync", "ignored_rooms"], default=[], required=False
+        )
+
+        # Worker process setup
+        self.worker_count = self._get_cfg(
+            ["workers", "count"], default=0, required=False
+        )
+        if not isinstance(self.worker_count, int) or self.worker_count < 0:
+            raise ConfigError("workers.count must be a non-negative integer")
+        if self.worker_count and len(self.accounts) > 1:
+            raise ConfigError("workers.count cannot be used with multiple accounts")
+        if self.worker_count and self.database["type"] != "postgres":
+            raise ConfigError(
+                "workers.count requires a Postgres database, as workers share state "
+                "through the database"
+            )
+
+        # Sync capture setup
+        self.sync_capture_enabled = self._get_cfg(
+            ["sync", "capture", "enabled"], default=False, required=False
+        )
+        self.sync_capture_path = self._get_cfg(
+            ["sync", "capture", "path"], default="sync_capture.jsonl.gz"
+        )
+
+        # Metrics setup
+        self.metrics_enabled = self._get_cfg(
+            ["metrics", "enabled"], default=False, required=False
+        )
+        self.metrics_host = self._get_cfg(["metrics", "host"], default="127.0.0.1")
+        self.metrics_port = self._get_cfg(["metrics", "port"], default=9000)
+
+        # Tracing setup
+        self.tracing_enabled = self._get_cfg(
+            ["tracing", "enabled"], default=False, required=False
+        )
+        self.tracing_sample_rate = self._get_cfg(
+            ["tracing", "sample_rate"], default=0.01, required=False
+        )
+        if not 0 <= self.tracing_sample_rate <= 1:
+            raise ConfigError("tracing.sample_rate must be between 0 and 1")
+        self.tracing_path = self._get_cfg(
+            ["tracing", "path"], default="traces.jsonl", required=False
+        )
+
+        # Outbound rate limit setup
+        self.send_rate_limit_enabled = self._get_cfg(
+            ["send_rate_limit", "enabled"], default=True
+        )
+        self.send_rate_limit = {
+            "global_rate": self._get_cfg(
+                ["send_rate_limit", "global_rate"], default=10
+            ),
+            "global_burst": self._get_cfg(
+                ["send_rate_limit", "global_burst"], default=20
+            ),
+            "room_rate": self._get_cfg(["send_rate_limit", "room_rate"], default=1),
+            "room_burst": self._get_cfg(["send_rate_limit", "room_burst"], default=5),
+            "max_retries": self._get_cfg(["send_rate_limit", "max_retries"], default=5),
+        }
+        for option in ("global_rate", "global_burst", "room_rate", "room_burst"):
+            if self.send_rate_limit[option] <= 0:
+                raise ConfigError(f"send_rate_limit.{option} must be positive")
+
+        # Command rate limit setup
+        self.command_rate_limit_enabled = self._get_cfg(
+            ["command_rate_limit", "enabled"], default=True
+        )
+        self.command_rate_limit = {
+            "user_rate": self._get_cfg(
+                ["command_rate_limit", "user_rate"], default=0.2
+            ),
+            "user_burst": self._get_cfg(
+                ["command_rate_limit", "user_burst"], default=5
+            ),
+            "room_rate": self._get_cfg(
+                ["command_rate_limit", "room_rate"], default=0.5
+            ),
+            "room_burst": self._get_cfg(
+                ["command_rate_limit", "room_burst"], default=10
+            ),
+            "notice_interval": self._get_cfg(
+                ["command_rate_limit", "notice_interval"], default=60
+            ),
+            "max_buckets": self._get_cfg(
+                ["command_rate_limit", "max_buckets"], default=10000
+            ),
+        }
+        for option in self.command_rate_limit:
+            if self.command_rate_limit[option] <= 0:
+                raise ConfigError(f"command_rate_limit.{option} must be positive")
+
+        # Config reload setup
+        self.config_reload_watch = self._get_cfg(
+            ["config_reload", "watch"], default=True
+        )
+        self.config_reload_poll_interval = self._get_cfg(
+            ["config_reload", "poll_interval"], default=5
+        )
+        if self.config_reload_poll_interval <= 0:
+            raise ConfigError("config_reload.poll_interval must be positive")
+
+        # Decryption retry setup
+        self.decryption_retry_enabled = self._get_cfg(
+            ["decryption_retry", "enabled"], default=True
+        )
+        max_age_hours = self._get_cfg(["decryption_retry", "max_age_hours"], default=24)
+        self.decryption_retry = {
+            "max_size": self._get_cfg(["decryption_retry", "max_events"], default=1000),
+            "max_age": max_age_hours * 60 * 60,
+            "key_request_delay": self._get_cfg(
+                ["decryption_retry", "key_request_delay"], default=1
+            ),
+            "reaction_interval": self._get_cfg(
+                ["decryption_retry", "reaction_interval"], default=3600
+            ),
+        }
+        if self.decryption_retry["max_size"] < 1:
+            raise ConfigError("decryption_retry.max_events must be at least 1")
+
+        # Session warming setup
+        self.session_warming = {
+            "policy": self._get_cfg(["session_warming", "policy"], default="active"),
+            "active_window": self._get_cfg(
+                ["session_warming", "active_window"], default=3600
+            ),
+            "delay": self._get_cfg(["session_warming", "delay"], default=1),
+            "max_concurrent": self._get_cfg(
+                ["session_warming", "max_concurrent"], default=2
+            ),
+        }
+        if self.session_warming["policy"] not in WARMING_POLICIES:
+            raise ConfigError(
+                f"session_warming.policy must be one of: {', '.join(WARMING_POLICIES)}"
+            )
+        if self.session_warming["max_concurrent"] < 1:
+            raise ConfigError("session_warming.max_concurrent must be at least 1")
+
+        # Processed event deduplication setup
+        self.processed_events_enabled = self._get_cfg(
+            ["processed_events", "enabled"], default=True
+        )
+        retention_days = self._get_cfg(
+            ["processed_events", "retention_days"], default=7
+        )
+        self.processed_events = {
+            "retention": retention_days * 24 * 60 * 60,
+            "bloom_capacity": self._get_cfg(
+                ["processed_events", "bloom_capacity"], default=100000
+            ),
+            "bloom_error_rate": self._get_cfg(
+                ["processed_events", "bloom_error_rate"], default=0.001
+            ),
+        }
+        if retention_days <= 0:
+            raise ConfigError("processed_events.retention_days must be positive")
+        if self.processed_events["bloom_capacity"] < 1:
+            raise ConfigError("processed_events.bloom_capacity must be at least 1")
+        if not 0 < self.processed_events["bloom_error_rate"] < 1:
+            raise ConfigError(
+                "processed_events.bloom_error_rate must be between 0 and 1"
+            )
+
+    def _setup_logging(self) -> None:
+        """Set the log level, and add the configured log handlers"""
+        formatter = logging.Formatter(
+            "%(asctime)s | %(name)s [%(levelname)s] %(message)s"
+        )
+
+        logger.setLevel(self.log_level)
+
+        if self.file_logging_enabled:
+            handler = logging.FileHandler(self.file_logging_filepath)
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+
+        if self.console_logging_enabled:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(formatter)
+            logger.addHandler(handler)
+
+    def reload(self) -> Tuple[List[str], List[str]]:
+        """Read the config file again, and apply the options that can be changed while
+        the bot is running. See `RELOADABLE_OPTIONS`.
+
+        The new options are all applied at once, so that the bot never uses a mix of
+        old and new options. Nothing is applied if the config file is invalid.
+
+        Returns:
+            The reloadable options that were changed and applied, and the paths of the
+            options that were changed but only take effect after a restart.
+
+        Raises:
+            ConfigError: If the config file is invalid.
+        """
+        try:
+            new_config = Config(self.filepath, setup_logging=False)
+        except yaml.YAMLError as e:
+            raise ConfigError(f"Config file '{self.filepath}' is not valid YAML: {e}")
+
+        applied = [
+            option
+            for option, names in RELOADABLE_OPTIONS.items()
+            if any(getattr(self, name) != getattr(new_config, name) for name in names)
+        ]
+        ignored = [
+            path
+            for path in _changed_options(self.config_dict, new_config.config_dict)
+            if not any(
+                path == option or path.startswith(option + ".")
+                for option in RELOADABLE_OPTIONS
+            )
+        ]
+
+        for option in applied:
+            for name in RELOADABLE_OPTIONS[option]:
+                setattr(self, name, getattr(new_config, name))
+        if "logging.level" in applied:
+            logger.setLevel(self.log_level)
+
+        # Report each change that needs a restart once
+        self.config_dict = new_config.config_dict
+
+        return applied, ignored
+
+    def _make_store_dir(self, path: str, option: str) -> None:
+        """Create a store folder if it doesn't exist"""
+        if not os.path.isdir(path):
+            if not os.path.exists(path):
+                os.mkdir(path)
+            else:
+                raise ConfigError(f"{option} '{path}' is not a directory")
+
+    def _parse_accounts(self) -> List["AccountConfig"]:
+        """Read and validate the matrix section, which is either the options for a
+        single account, or a list of them.
+
+        Returns:
+            The options for each account, in the order they were given.
+        """
+        matrix = self._get_cfg(["matrix"], required=True)
+        if isinstance(matrix, dict):
+            # A single account uses the store directly
+            return [self._parse_account(matrix, "matrix", self.store_path)]
+
+        if not isinstance(matrix, list) or not matrix:
+            raise ConfigError("matrix must be an account, or a list of accounts")
+
+        accounts = []
+        for index, options in enumerate(matrix):
+            if not isinstance(options, dict):
+                raise ConfigError(f"matrix[{index}] must be an account")
+
+            # Each account has its own encryption keys and sync token, so needs a
+            # store of its own
+            default_store_path = os.path.join(
+                self.store_path, str(options.get("user_id"))
+            )
+            accounts.append(
+                self._parse_account(options, f"matrix[{index}]", default_store_path)
+            )
+
+        user_ids = [account.user_id for account in accounts]
+        if len(set(user_ids)) != len(user_ids):
+            raise ConfigError("Each account in matrix must have a different user_id")
+        store_paths = [account.store_path for account in accounts]
+        if len(set(store_paths)) != len(store_paths):
+            raise ConfigError("Each account in matrix must have a different store_path")
+
+        return accounts
+
+    def _parse_account(
+        self, options: Dict[str, Any], option_path: str, default_store_path: str
+    ) -> "AccountConfig":
+        """Read and validate the options for a single Matrix account.
+
+        Args:
+            options: The account's section of the config file.
 
-        self.user_password = self._get_cfg(["matrix", "user_password"], required=False)
-        self.user_token = self._get_cfg(["matrix", "user_token"], required=False)
-        if not self.user_token and not self.user_password:
+            option_path: The path of the section, for error messages.
+
+            default_store_path: The store folder to use if the account doesn't set one.
+        """
+
+        def get(name: str, default: Optional[Any] = None, required: bool = True) -> Any:
+            value = options.get(name)
+            if value is None:
+                if required and not default:
+                    raise ConfigError(f"Config option {option_path}.{name} is required")
+                return default
+            return value
+
+        user_id = get("user_id")
+        if not re.match("@.*:.*", user_id):
+            raise ConfigError(f"{option_path}.user_id must be in the form @name:domain")
+
+        user_password = get("user_password", required=False)
+        user_token = get("user_token", required=False)
+        if not user_token and not user_password:
             raise ConfigError("Must supply either user token or password")
 
-        self.device_id = self._get_cfg(["matrix", "device_id"], required=True)
-        self.device_name = self._get_cfg(
-            ["matrix", "device_name"], default="nio-template"
+        store_path = get("store_path", default=default_store_path)
+        self._make_store_dir(store_path, f"{option_path}.store_path")
+
+        return AccountConfig(
+            user_id=user_id,
+            user_password=user_password,
+            user_token=user_token,
+            device_id=get("device_id"),
+            device_name=get("device_name", default="nio-template"),
+            homeserver_url=get("homeserver_url"),
+            store_path=store_path,
         )
-        self.homeserver_url = self._get_cfg(["matrix", "homeserver_url"], required=True)
 
-        self.command_prefix = self._get_cfg(["command_prefix"], default="!c") + " "
+    def _parse_sqlite_pragmas(self) -> Dict[str, Union[int, str]]:
+        """Read and validate the storage.sqlite options, which tune SQLite's performance.
+
+        Returns:
+            A dictionary of SQLite pragma names to the values they should be set to.
+        """
+        pragmas = {}
+
+        # journal_mode must be set first, as it affects how other pragmas behave
+        for name, default in (
+            ("journal_mode", "wal"),
+            ("synchronous", "normal"),
+            ("temp_store", "memory"),
+        ):
+            value = str(
+                self._get_cfg(["storage", "sqlite", name], default=default)
+            ).lower()
+            if value not in SQLITE_PRAGMA_CHOICES[name]:
+                raise ConfigError(
+                    f"storage.sqlite.{name} must be one of: "
+                    f"{', '.join(SQLITE_PRAGMA_CHOICES[name])}"
+                )
+            pragmas[name] = value
+
+        for name, default in (
+            ("busy_timeout", 5000),
+            ("cache_size", -2000),
+            ("mmap_size", 0),
+        ):
+            value = self._get_cfg(
+                ["storage", "sqlite", name], default=default, required=False
+            )
+            if not isinstance(value, int):
+                raise ConfigError(f"storage.sqlite.{name} must be an integer")
+            pragmas[name] = value
+
+        return pragmas
 
     def _get_cfg(
         self,
@@ -0,0 +1,134 @@
+import asyncio
+import logging
+import os
+import signal
+from typing import Callable, List, Optional, Tuple
+
+from my_project_name.config import Config
+from my_project_name.errors import ConfigError
+
+logger = logging.getLogger(__name__)
+
+# Called with the options that were applied after the config was reloaded
+ReloadListener = Callable[[List[str]], None]
+
+
+class ConfigReloader:
+    def __init__(self, config: Config, watch: bool = True, poll_interval: float = 5):
+        """Reloads the config of a running bot when the config file changes, or when
+        the bot receives SIGHUP, without restarting the sync loop.
+
+        Only some options can be changed while the bot is running. Changes to other
+        options are logged, and take effect after a restart. See `Config.reload`.
+
+        Args:
+            config: The config of the running bot, which is updated in place.
+
+            watch: Whether to watch the config file for changes.
+
+            poll_interval: How often to check whether the config file has changed, in
+                seconds.
+        """
+        self.config = config
+        self.watch = watch
+        self.poll_interval = poll_interval
+
+        self._listeners: List[ReloadListener] = []
+        self._task: Optional[asyncio.Future] = None
+        self._sighup_handled = False
+        self._file_state = self._read_file_state()
+
+    def add_listener(self, listener: ReloadListener) -> None:
+        """Call a function with the options that were applied whenever the config is
+        reloaded, so that it can pick up their new values
+        """
+        self._listeners.append(listener)
+
+    def start(self) -> None:
+        """Reload the config on SIGHUP, and when the config file changes if watching
+        it
+        """
+        try:
+            asyncio.get_event_loop().add_signal_handler(signal.SIGHUP, self._on_sighup)
+            self._sighup_handled = True
+        except (AttributeError, NotImplementedError, RuntimeError, ValueError):
+            # Signals are not supported on this platform, or outside the main thread
+            logger.debug("Not reloading the config on SIGHUP")
+
+        if self.watch:
+            self._task = asyncio.ensure_future(self._watch())
+
+    def _on_sighup(self) -> None:
+        logger.info("Received SIGHUP, reloading config")
+        self.reload()
+
+    def _read_file_state(self) -> Optional[Tuple[int, int, int]]:
+        """Read what is needed to tell whether the config file has changed"""
+        try:
+            stat = os.stat(self.config.filepath)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    async def _watch(self) -> None:
+        """Reload the config whenever the config file changes"""
+        while True:
+            await asyncio.sleep(self.poll_interval)
+
+            file_state = self._read_file_state()
+            if file_state is None or file_state == self._file_state:
+                continue
+
+            logger.info("Config file changed, reloading config")
+            self.reload()
+
+    def reload(self) -> bool:
+        """Reload the config, and tell the listeners which options were applied.
+
+        Returns:
+            Whether the config file was valid. If not, the bot keeps running with its
+            current options.
+        """
+        # Record the state before reading the file, so that a change made while we
+        # read it is picked up next time
+        self._file_state = self._read_file_state()
+
+        try:
+            applied, ignored = self.config.reload()
+        except (ConfigError, OSError) as e:
+            logger.error("Not reloading config, as it is invalid: %s", e)
+            return False
+        except Exception:
+            # e.g. an option has a value of the wrong type. Keep the current options,
+            # and keep watching the config file
+            logger.exception("Not reloading config, as it could not be parsed")
+            return False
+
+        if ignored:
+            logger.warning(
+                "These config options were changed, but can only be changed by "
+                "restarting the bot: %s",
+                ", ".join(ignored),
+            )
+        if not applied:
+            logger.info("Reloaded config, no options that can be reloaded changed")
+            return True
+
+        logger.info("Reloaded config, applied new values of: %s", ", ".join(applied))
+        for listener in self._listeners:
+            try:
+                listener(applied)
+            except Exception:
+                logger.exception("Error applying reloaded config")
+        return True
+
+    async def close(self) -> None:
+        """Stop reloading the config"""
+        if self._sighup_handled:
+            asyncio.get_event_loop().remove_signal_handler(signal.SIGHUP)
+            self._sighup_handled = False
+
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
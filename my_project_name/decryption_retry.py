@@ -0,0 +1,330 @@
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple, Type
+
+from nio import (
+    AsyncClient,
+    EncryptionError,
+    Event,
+    LocalProtocolError,
+    MegolmEvent,
+    RoomKeyEvent,
+    SyncResponse,
+)
+
+from my_project_name.dispatcher import EventHandler
+from my_project_name.storage import Storage, register_statement
+
+logger = logging.getLogger(__name__)
+
+register_statement(
+    "undecrypted_events_get",
+    "SELECT event_id, room_id, source, received_at FROM undecrypted_events "
+    "WHERE account = ? AND received_at >= ? ORDER BY received_at DESC",
+)
+register_statement(
+    "undecrypted_events_insert",
+    "INSERT INTO undecrypted_events "
+    "(account, event_id, room_id, session_id, source, received_at) "
+    "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (account, event_id) DO NOTHING",
+)
+register_statement(
+    "undecrypted_events_delete",
+    "DELETE FROM undecrypted_events WHERE account = ? AND event_id = ?",
+)
+register_statement(
+    "undecrypted_events_prune",
+    "DELETE FROM undecrypted_events WHERE account = ? AND received_at < ?",
+)
+
+
+class DecryptionRetryQueue:
+    def __init__(
+        self,
+        client: AsyncClient,
+        store: Storage,
+        max_size: int = 1000,
+        max_age: float = 24 * 60 * 60,
+        key_request_delay: float = 1,
+        reaction_interval: float = 60 * 60,
+    ):
+        """Keeps events that could not be decrypted, requests the missing room keys,
+        and handles the events as usual once their keys arrive.
+
+        Parked events are kept in memory and in the `undecrypted_events` database
+        table, so that they survive a restart. Once the queue holds `max_size` events,
+        the oldest are dropped, as are events older than `max_age` whenever another
+        event is parked or a room key arrives. Room keys are requested in batches, once per session,
+        `key_request_delay` seconds after the first event in the batch was parked.
+
+        Args:
+            client: The client that failed to decrypt the events.
+
+            store: Bot storage.
+
+            max_size: The maximum number of events to keep.
+
+            max_age: The number of seconds to keep an event for.
+
+            key_request_delay: The number of seconds to collect missing sessions for
+                before requesting their keys.
+
+            reaction_interval: The minimum number of seconds between telling a room
+                that an event could not be decrypted. See `should_react`.
+        """
+        self.client = client
+        self.store = store
+        self.max_size = max_size
+        self.max_age = max_age
+        self.key_request_delay = key_request_delay
+        self.reaction_interval = reaction_interval
+
+        # The callbacks to pass decrypted events to, as (callback, event class)
+        self._callbacks: List[Tuple[EventHandler, Type[Event]]] = []
+
+        # Parked events by event ID, oldest first, and their IDs by session ID
+        self._parked: "OrderedDict[str, MegolmEvent]" = OrderedDict()
+        self._received_at: Dict[str, float] = {}
+        self._sessions: Dict[str, Set[str]] = {}
+
+        # An event from each session whose key should be requested in the next batch
+        self._key_requests: Dict[str, MegolmEvent] = {}
+        self._key_request_handle: Optional[asyncio.TimerHandle] = None
+
+        # When we last reacted to an undecryptable event, by room ID, oldest first
+        self._reacted_at: "OrderedDict[str, float]" = OrderedDict()
+
+    @property
+    def depth(self) -> int:
+        """The number of events waiting to be decrypted"""
+        return len(self._parked)
+
+    @property
+    def account(self) -> str:
+        return self.client.user_id
+
+    def add_callback(self, callback: EventHandler, event_class: Type[Event]) -> None:
+        """Pass decrypted events of the given class to a callback, as the client
+        would have done had the event been decrypted when it arrived
+        """
+        self._callbacks.append((callback, event_class))
+
+    def start(self) -> None:
+        """Retry parked events when room keys arrive, and load the events that were
+        parked before the bot restarted once the first sync completes
+        """
+        loaded = False
+
+        async def on_sync(response: SyncResponse) -> None:
+            nonlocal loaded
+            if not loaded:
+                loaded = True
+                await self.load()
+
+        self.client.add_response_callback(on_sync, SyncResponse)
+        self.client.add_to_device_callback(self._on_room_key, (RoomKeyEvent,))
+
+    def should_react(self, room_id: str) -> bool:
+        """Whether to tell a room that an event could not be decrypted. Returns True
+        at most once every `reaction_interval` seconds per room, so that a key sharing
+        problem doesn't flood the room with reactions.
+        """
+        now = time.monotonic()
+
+        # Forget the rooms that we could react in again
+        while self._reacted_at:
+            reacted_at = next(iter(self._reacted_at.values()))
+            if now - reacted_at < self.reaction_interval:
+                break
+            self._reacted_at.popitem(last=False)
+
+        if room_id in self._reacted_at:
+            return False
+
+        self._reacted_at[room_id] = now
+        return True
+
+    async def park(self, event: MegolmEvent) -> None:
+        """Keep an event that could not be decrypted, and request its room key.
+
+        Args:
+            event: The undecryptable event. Its room_id must be set.
+        """
+        if event.event_id in self._parked:
+            return
+
+        await self._expire()
+
+        received_at = int(time.time())
+        self._add(event, received_at)
+        await self.store.write_statement(
+            "undecrypted_events_insert",
+            (
+                self.account,
+                event.event_id,
+                event.room_id,
+                event.session_id,
+                json.dumps(event.source),
+                received_at,
+            ),
+        )
+
+        # Drop the oldest events once we have too many
+        while len(self._parked) > self.max_size:
+            oldest = next(iter(self._parked.values()))
+            logger.warning("Giving up on decrypting %s", oldest.event_id)
+            await self._remove(oldest)
+
+    def _add(self, event: MegolmEvent, received_at: float) -> None:
+        self._parked[event.event_id] = event
+        self._received_at[event.event_id] = received_at
+        self._sessions.setdefault(event.session_id, set()).add(event.event_id)
+        self._request_key(event)
+
+    async def _remove(self, event: MegolmEvent) -> None:
+        del self._parked[event.event_id]
+        del self._received_at[event.event_id]
+        session = self._sessions.get(event.session_id)
+        if session is not None:
+            session.discard(event.event_id)
+            if not session:
+                del self._sessions[event.session_id]
+
+        await self.store.write_statement(
+            "undecrypted_events_delete", (self.account, event.event_id)
+        )
+
+    async def _expire(self) -> None:
+        """Give up on the events that were parked more than `max_age` seconds ago"""
+        cutoff = time.time() - self.max_age
+        while self._parked:
+            oldest = next(iter(self._parked.values()))
+            if self._received_at[oldest.event_id] >= cutoff:
+                break
+            logger.warning("Giving up on decrypting %s", oldest.event_id)
+            await self._remove(oldest)
+
+    def _request_key(self, event: MegolmEvent) -> None:
+        """Add an event's session to the next batch of key requests"""
+        self._key_requests.setdefault(event.session_id, event)
+        if self._key_request_handle is None:
+            self._key_request_handle = asyncio.get_event_loop().call_later(
+                self.key_request_delay,
+                lambda: asyncio.ensure_future(self._send_key_requests()),
+            )
+
+    async def _send_key_requests(self) -> None:
+        """Request the keys of every session in the current batch"""
+        self._key_request_handle = None
+        requests, self._key_requests = self._key_requests, {}
+
+        sent = 0
+        for session_id, event in requests.items():
+            if session_id not in self._sessions:
+                # Decrypted or dropped while the batch was being collected
+                continue
+
+            try:
+                await self.client.request_room_key(event)
+                sent += 1
+            except LocalProtocolError:
+                # We have already requested this key
+                pass
+            except Exception:
+                logger.exception("Failed to request the key for session %s", session_id)
+
+        if sent:
+            logger.info("Requested %d missing room keys", sent)
+
+    async def _on_room_key(self, event: RoomKeyEvent) -> None:
+        """Retry the events that were waiting for a room key that just arrived"""
+        await self._expire()
+
+        event_ids = list(self._sessions.get(event.session_id, ()))
+        for event_id in event_ids:
+            parked = self._parked.get(event_id)
+            if parked is not None:
+                await self.retry(parked)
+
+    async def retry(self, event: MegolmEvent) -> bool:
+        """Try to decrypt a parked event, passing it to the callbacks if that succeeds.
+
+        Args:
+            event: The parked event.
+
+        Returns:
+            Whether the event was decrypted.
+        """
+        try:
+            decrypted = self.client.decrypt_event(event)
+        except EncryptionError:
+            return False
+
+        if event.event_id not in self._parked:
+            # Already retried while we were waiting
+            return False
+
+        await self._remove(event)
+        decrypted.room_id = event.room_id
+
+        room = self.client.rooms.get(event.room_id)
+        if room is None:
+            # We've since left the room
+            return True
+
+        logger.info("Decrypted %s after retrying", event.event_id)
+        for callback, event_class in self._callbacks:
+            if isinstance(decrypted, event_class):
+                await callback(room, decrypted)
+        return True
+
+    async def load(self) -> None:
+        """Load the events that were parked before the bot restarted. Events whose
+        keys have since arrived are handled straight away
+        """
+        cutoff = int(time.time() - self.max_age)
+        await self.store.execute_statement(
+            "undecrypted_events_prune", (self.account, cutoff)
+        )
+        rows = await self.store.fetchall_statement(
+            "undecrypted_events_get", (self.account, cutoff)
+        )
+
+        # Rows are newest first. Keep the newest, and park them oldest first
+        for event_id, _, _, _ in rows[self.max_size :]:
+            await self.store.execute_statement(
+                "undecrypted_events_delete", (self.account, event_id)
+            )
+
+        # Events parked since the bot started are newer, so put these in front of
+        # them, keeping the oldest first
+        events = []
+        for event_id, room_id, source, received_at in rows[: self.max_size]:
+            if event_id in self._parked:
+                continue
+            event = MegolmEvent.from_dict(json.loads(source))
+            event.room_id = room_id
+            self._add(event, received_at)
+            self._parked.move_to_end(event_id, last=False)
+            events.append(event)
+        events.reverse()
+
+        decrypted = 0
+        for event in events:
+            decrypted += await self.retry(event)
+
+        if events:
+            logger.info(
+                "Loaded %d undecrypted events, %d of which are now decryptable",
+                len(events),
+                decrypted,
+            )
+
+    async def close(self) -> None:
+        """Stop requesting room keys"""
+        if self._key_request_handle is not None:
+            self._key_request_handle.cancel()
+            self._key_request_handle = None
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from nio import Event, MatrixRoom
+
+from my_project_name.metrics import CALLBACK_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# An event callback, as passed to `AsyncClient.add_event_callback`
+EventHandler = Callable[[MatrixRoom, Event], Awaitable[Any]]
+
+
+class EventDispatcher:
+    def __init__(
+        self,
+        max_workers: int = 8,
+        max_queue_size: int = 100,
+        handler_timeout: Optional[float] = None,
+    ):
+        """Runs event callbacks concurrently across rooms, while keeping events within
+        a single room in the order they were received.
+
+        Each room gets its own queue of pending events. A queue is drained by a single
+        task, so events in one room are never handled out of order, while the number
+        of events being handled at once across all rooms is bounded by `max_workers`.
+
+        Args:
+            max_workers: The maximum number of events that may be handled at once.
+
+            max_queue_size: The maximum number of events that may be waiting in a
+                single room's queue. Further events for that room are dropped until
+                the queue drains.
+
+            handler_timeout: The number of seconds a handler may run for before it is
+                cancelled. If None, handlers may run indefinitely.
+        """
+        self.max_workers = max_workers
+        self.max_queue_size = max_queue_size
+        self.handler_timeout = handler_timeout
+
+        self._semaphore = asyncio.Semaphore(max_workers)
+        self._queues: Dict[str, Deque[Tuple[EventHandler, MatrixRoom, Event]]] = {}
+        self._tasks: Set[asyncio.Future] = set()
+
+    @property
+    def pending(self) -> int:
+        """The number of events waiting to be handled, across all rooms"""
+        return sum(len(queue) for queue in self._queues.values())
+
+    def wrap(self, handler: EventHandler) -> EventHandler:
+        """Wrap an event callback so that calling it enqueues the event with this
+        dispatcher, instead of handling it inline in the sync loop.
+
+        Args:
+            handler: The event callback to wrap.
+
+        Returns:
+            A callback suitable for `AsyncClient.add_event_callback`.
+        """
+
+        async def callback(room: MatrixRoom, event: Event) -> None:
+            self.dispatch(handler, room, event)
+
+        return callback
+
+    def dispatch(self, handler: EventHandler, room: MatrixRoom, event: Event) -> bool:
+        """Queue an event to be handled by the given handler.
+
+        Args:
+            handler: The event callback to handle the event with.
+
+            room: The room the event came from.
+
+            event: The event itself.
+
+        Returns:
+            Whether the event was queued. False if the room's queue was full.
+        """
+        queue = self._queues.get(room.room_id)
+        if queue is None:
+            # No events are currently being handled for this room. Start a task to
+            # drain its queue
+            queue = deque()
+            self._queues[room.room_id] = queue
+
+            task = asyncio.ensure_future(self._drain_room_queue(room.room_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif len(queue) >= self.max_queue_size:
+            logger.warning(
+                "Event queue for room %s is full, dropping event %s",
+                room.room_id,
+                event.event_id,
+            )
+            return False
+
+        queue.append((handler, room, event))
+        return True
+
+    async def join(self) -> None:
+        """Wait until all queued events have been handled"""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    async def _drain_room_queue(self, room_id: str) -> None:
+        """Handle the events queued for a room one at a time, until none are left.
+
+        Args:
+            room_id: The ID of the room to handle events for.
+        """
+        queue = self._queues[room_id]
+        try:
+            while queue:
+                handler, room, event = queue.popleft()
+                async with self._semaphore:
+                    await self._run_handler(handler, room, event)
+        finally:
+            del self._queues[room_id]
+
+    async def _run_handler(
+        self, handler: EventHandler, room: MatrixRoom, event: Event
+    ) -> None:
+        """Run a single handler, making sure that a failing or slow handler does not
+        prevent the rest of the room's queue from being handled.
+        """
+        handler_name = getattr(handler, "__qualname__", repr(handler))
+        try:
+            with CALLBACK_SECONDS.time(callback=handler_name):
+                await asyncio.wait_for(handler(room, event), self.handler_timeout)
+        except asyncio.TimeoutError:
+            logger.error(
+                "Handler %s timed out after %ss handling event %s in room %s",
+                handler_name,
+                self.handler_timeout,
+                event.event_id,
+                room.room_id,
+            )
+        except Exception:
+            logger.exception(
+                "Handler %s failed handling event %s in room %s",
+                handler_name,
+                event.event_id,
+                room.room_id,
+            )
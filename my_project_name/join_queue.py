@@ -0,0 +1,172 @@
+import asyncio
+import logging
+from typing import Dict, Iterable, List
+
+from nio import AsyncClient, JoinError, SyncResponse
+
+from my_project_name.reconnect import ExponentialBackoff
+
+logger = logging.getLogger(__name__)
+
+
+class JoinQueue:
+    def __init__(
+        self,
+        client: AsyncClient,
+        max_concurrent: int = 4,
+        max_attempts: int = 5,
+        initial_delay: float = 1,
+        max_delay: float = 300,
+    ):
+        """Joins rooms that the bot has been invited to in the background, so that a
+        burst of invites does not hold up the sync loop.
+
+        At most `max_concurrent` joins are made at once. A failed join is retried with
+        exponential backoff, waiting at least as long as the homeserver asks if we were
+        rate-limited. Rooms waiting for a retry do not hold up other rooms.
+
+        Args:
+            client: The client to join rooms with.
+
+            max_concurrent: The maximum number of joins to make at once.
+
+            max_attempts: The number of times to try joining a room before giving up.
+
+            initial_delay: The maximum delay before retrying a failed join, in seconds.
+
+            max_delay: The maximum delay between attempts to join a room, in seconds.
+        """
+        self.client = client
+        self.max_concurrent = max_concurrent
+        self.max_attempts = max_attempts
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+        # Rooms that are queued, being joined or waiting to be retried, along with the
+        # backoff for their next retry
+        self._pending: Dict[str, ExponentialBackoff] = {}
+        self._retries: Dict[str, asyncio.TimerHandle] = {}
+        self._queue: "asyncio.Queue[str]" = asyncio.Queue()
+        self._tasks: List[asyncio.Future] = []
+
+    @property
+    def depth(self) -> int:
+        """The number of rooms waiting to be joined"""
+        return len(self._pending)
+
+    def add(self, room_id: str) -> bool:
+        """Queue a room to be joined, unless it already is.
+
+        Args:
+            room_id: The ID of the room to join.
+
+        Returns:
+            Whether the room was queued.
+        """
+        if room_id in self._pending:
+            return False
+
+        if not self._tasks:
+            self._tasks = [
+                asyncio.ensure_future(self._run()) for _ in range(self.max_concurrent)
+            ]
+
+        self._pending[room_id] = ExponentialBackoff(
+            initial_delay=self.initial_delay, max_delay=self.max_delay
+        )
+        self._queue.put_nowait(room_id)
+        return True
+
+    def add_many(self, room_ids: Iterable[str]) -> int:
+        """Queue several rooms to be joined.
+
+        Args:
+            room_ids: The IDs of the rooms to join.
+
+        Returns:
+            The number of rooms that were queued, excluding those already queued.
+        """
+        return sum(self.add(room_id) for room_id in room_ids)
+
+    def catch_up(self) -> None:
+        """Once the first sync completes, queue every room that the bot has a pending
+        invite to, including invites received while the bot was not running
+        """
+        caught_up = False
+
+        async def on_sync(response: SyncResponse) -> None:
+            nonlocal caught_up
+            if caught_up:
+                return
+            caught_up = True
+
+            count = self.add_many(list(self.client.invited_rooms))
+            if count:
+                logger.info("Joining %d rooms with pending invites", count)
+
+        self.client.add_response_callback(on_sync, SyncResponse)
+
+    async def _run(self) -> None:
+        """Join queued rooms, one at a time"""
+        while True:
+            room_id = await self._queue.get()
+            try:
+                await self._join(room_id)
+            except Exception:
+                logger.exception("Unexpected error joining %s", room_id)
+                self._pending.pop(room_id, None)
+
+    async def _join(self, room_id: str) -> None:
+        """Attempt to join a room, scheduling a retry if that fails"""
+        backoff = self._pending[room_id]
+
+        retry_after = 0.0
+        try:
+            response = await self.client.join(room_id)
+        except Exception as e:
+            # e.g. the connection to the homeserver dropped
+            error = str(e) or type(e).__name__
+        else:
+            if not isinstance(response, JoinError):
+                del self._pending[room_id]
+                logger.info(f"Joined {room_id}")
+                return
+
+            error = response.message
+            retry_after = (response.retry_after_ms or 0) / 1000
+
+        attempt = backoff.attempts + 1
+        if attempt >= self.max_attempts:
+            del self._pending[room_id]
+            logger.error(
+                "Unable to join room %s after %d attempts: %s", room_id, attempt, error
+            )
+            return
+
+        delay = max(backoff.next_delay(), retry_after)
+        logger.warning(
+            "Error joining room %s (attempt %d), retrying in %.1fs: %s",
+            room_id,
+            attempt,
+            delay,
+            error,
+        )
+        self._retries[room_id] = asyncio.get_event_loop().call_later(
+            delay, self._retry, room_id
+        )
+
+    def _retry(self, room_id: str) -> None:
+        del self._retries[room_id]
+        self._queue.put_nowait(room_id)
+
+    async def close(self) -> None:
+        """Stop joining rooms. Rooms that have not yet been joined are forgotten"""
+        for handle in self._retries.values():
+            handle.cancel()
+        self._retries.clear()
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
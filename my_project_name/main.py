@@ -1,44 +1,216 @@
 #!/usr/bin/env python3
 import asyncio
 import logging
+import os
 import sys
-from time import sleep
+from typing import Optional
 
 from aiohttp import ClientConnectionError, ServerDisconnectedError
 from nio import (
     AsyncClient,
     AsyncClientConfig,
-    InviteMemberEvent,
     LocalProtocolError,
     LoginError,
     MegolmEvent,
-    RoomMessageText,
-    UnknownEvent,
 )
 
+from my_project_name import bot_commands, message_responses
 from my_project_name.callbacks import Callbacks
-from my_project_name.config import Config
+from my_project_name.chat_functions import (
+    markdown_cache_info,
+    prerender_markdown,
+    set_markdown_cache_size,
+    set_outbound_queue,
+    set_own_event_index,
+)
+from my_project_name.config import AccountConfig, Config
+from my_project_name.config_reload import ConfigReloader
+from my_project_name.decryption_retry import DecryptionRetryQueue
+from my_project_name.dispatcher import EventDispatcher
+from my_project_name.join_queue import JoinQueue
+from my_project_name.metrics import (
+    DOWNTIME_SECONDS,
+    MARKDOWN_CACHE_HITS,
+    MARKDOWN_CACHE_MISSES,
+    QUEUE_DEPTH,
+    RECONNECTS,
+    MetricsServer,
+    track_sync,
+)
+from my_project_name.own_events import OwnEventIndex
+from my_project_name.processed_events import ProcessedEventLedger
+from my_project_name.rate_limit import CommandRateLimiter
+from my_project_name.reconnect import ExponentialBackoff, ReconnectSupervisor
+from my_project_name.send_queue import OutboundQueue
+from my_project_name.session_warming import SessionWarmer
 from my_project_name.storage import Storage
+from my_project_name.sync_capture import SyncCapture
+from my_project_name.sync_filter import build_sync_filter, upload_sync_filter
+from my_project_name.tracing import JsonLinesExporter, tracer
+from my_project_name.workers import WorkerPool
 
 logger = logging.getLogger(__name__)
 
 
-async def main():
-    """The first function that is run when starting the bot"""
+async def main(config_path: Optional[str] = None):
+    """The first function that is run when starting the bot
+
+    Args:
+        config_path: The path of the config file to use. If None, the path is read
+            from the first command line argument, defaulting to config.yaml.
+    """
 
     # Read user-configured options from a config file.
     # A different config file path can be specified as the first command line argument
-    if len(sys.argv) > 1:
-        config_path = sys.argv[1]
-    else:
-        config_path = "config.yaml"
+    if config_path is None:
+        if len(sys.argv) > 1:
+            config_path = sys.argv[1]
+        else:
+            config_path = "config.yaml"
 
     # Read the parsed config file and create a Config object
     config = Config(config_path)
 
-    # Configure the database
+    # Configure the database. All accounts share the same connection pool
     store = Storage(config.database)
 
+    # Send events through a queue that keeps within the homeserver's rate limits
+    outbound_queue = None
+    if config.send_rate_limit_enabled:
+        outbound_queue = OutboundQueue(**config.send_rate_limit)
+        set_outbound_queue(outbound_queue)
+
+    # Remember the events that the bot sends, so that reactions to them can be
+    # recognised without asking the homeserver
+    own_events = OwnEventIndex(store)
+    set_own_event_index(own_events)
+
+    # Remember the events that the bot has handled, so that they aren't handled again.
+    # Worker processes keep their own record
+    processed_events = None
+    if config.processed_events_enabled and not config.worker_count:
+        processed_events = ProcessedEventLedger(store, **config.processed_events)
+        await processed_events.load()
+
+    # Compile message triggers and render static responses now, rather than when the
+    # first message arrives
+    message_responses.triggers.compile()
+    set_markdown_cache_size(config.markdown_cache_size)
+    prerender_markdown(bot_commands.static_responses)
+    prerender_markdown(message_responses.static_responses)
+
+    # Expose metrics over HTTP
+    metrics_server = None
+    if config.metrics_enabled:
+        if outbound_queue is not None:
+            QUEUE_DEPTH.set_function(
+                lambda: outbound_queue.depth, queue="outbound", account=""
+            )
+        MARKDOWN_CACHE_HITS.set_function(lambda: markdown_cache_info()["hits"])
+        MARKDOWN_CACHE_MISSES.set_function(lambda: markdown_cache_info()["misses"])
+
+        metrics_server = MetricsServer(config.metrics_host, config.metrics_port)
+        await metrics_server.start()
+
+    # Record traces of a sample of events
+    if config.tracing_enabled:
+        tracer.configure(
+            JsonLinesExporter(config.tracing_path), config.tracing_sample_rate
+        )
+
+    # Pick up changes to the config file without restarting the sync loop
+    config_reloader = ConfigReloader(
+        config,
+        watch=config.config_reload_watch,
+        poll_interval=config.config_reload_poll_interval,
+    )
+    config_reloader.start()
+
+    # Run every account in this event loop
+    accounts = [
+        asyncio.ensure_future(
+            run_account(
+                config_path,
+                config,
+                account,
+                store,
+                own_events,
+                processed_events,
+                outbound_queue,
+                config_reloader,
+            )
+        )
+        for account in config.accounts
+    ]
+
+    try:
+        pending = set(accounts)
+        while pending:
+            done, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            for account_task in done:
+                # Raises if the account raised
+                if account_task.result() is False:
+                    return False
+    finally:
+        # Stop the other accounts if one of them failed, by raising or by returning
+        # False
+        for account_task in accounts:
+            account_task.cancel()
+        await asyncio.gather(*accounts, return_exceptions=True)
+
+        await config_reloader.close()
+
+        if metrics_server is not None:
+            await metrics_server.stop()
+
+        if outbound_queue is not None:
+            await outbound_queue.close()
+
+        if processed_events is not None:
+            await processed_events.close()
+
+        # Flush any buffered writes and close the database connection
+        await store.close()
+
+        tracer.configure(None)
+
+
+async def run_account(
+    config_path: str,
+    config: Config,
+    account: AccountConfig,
+    store: Storage,
+    own_events: OwnEventIndex,
+    processed_events: Optional[ProcessedEventLedger],
+    outbound_queue: Optional[OutboundQueue],
+    config_reloader: ConfigReloader,
+) -> bool:
+    """Log in to a Matrix account and handle its events until the bot stops
+
+    Args:
+        config_path: The path of the config file, which worker processes read.
+
+        config: The bot's config.
+
+        account: The options for the account to run.
+
+        store: The bot's storage, shared by all accounts.
+
+        own_events: The index of events sent by the bot, shared by all accounts.
+
+        processed_events: If provided, the record of events that the bot has handled,
+            shared by all accounts.
+
+        outbound_queue: If provided, the queue to send events through, shared by all
+            accounts.
+
+        config_reloader: Tells the account's callbacks when the config is reloaded.
+
+    Returns:
+        False if the bot was unable to log in to the account.
+    """
     # Configuration options for the AsyncClient
     client_config = AsyncClientConfig(
         max_limit_exceeded=0,
@@ -49,73 +221,232 @@ async def main():
 
     # Initialize the matrix client
     client = AsyncClient(
-        config.homeserver_url,
-        config.user_id,
-        device_id=config.device_id,
-        store_path=config.store_path,
+        account.homeserver_url,
+        account.user_id,
+        device_id=account.device_id,
+        store_path=account.store_path,
         config=client_config,
     )
 
-    if config.user_token:
-        client.access_token = config.user_token
-        client.user_id = config.user_id
+    if account.user_token:
+        client.access_token = account.user_token
+        client.user_id = account.user_id
+
+    # Join rooms that we're invited to in the background, including those we were
+    # invited to while the bot wasn't running
+    join_queue = JoinQueue(client, **config.join_queue)
+    join_queue.catch_up()
+
+    # Share encryption sessions with rooms before we need to send to them
+    session_warmer = SessionWarmer(client, **config.session_warming)
+    session_warmer.start()
+
+    # Keep events that we can't decrypt, and handle them once their keys arrive
+    decryption_retry = None
+    if config.decryption_retry_enabled:
+        decryption_retry = DecryptionRetryQueue(
+            client, store, **config.decryption_retry
+        )
+        decryption_retry.start()
 
-    # Set up event callbacks
-    callbacks = Callbacks(client, store, config)
-    client.add_event_callback(callbacks.message, (RoomMessageText,))
-    client.add_event_callback(
-        callbacks.invite_event_filtered_callback, (InviteMemberEvent,)
+    # Stop any one user or room from using up our homeserver rate limit
+    rate_limiter = None
+    if config.command_rate_limit_enabled:
+        rate_limiter = CommandRateLimiter(**config.command_rate_limit)
+
+    # Set up event callbacks. Events are handled by the dispatcher rather than inline
+    # in the sync loop, so that a slow handler in one room doesn't hold up the others
+    callbacks = Callbacks(
+        client,
+        store,
+        config,
+        own_events=own_events,
+        processed_events=processed_events,
+        join_queue=join_queue,
+        decryption_retry=decryption_retry,
+        rate_limiter=rate_limiter,
+    )
+    dispatcher = EventDispatcher(
+        max_workers=config.dispatch_max_workers,
+        max_queue_size=config.dispatch_max_queue_size,
+        handler_timeout=config.dispatch_handler_timeout,
     )
-    client.add_event_callback(callbacks.decryption_failure, (MegolmEvent,))
-    client.add_event_callback(callbacks.unknown, (UnknownEvent,))
-
-    # Keep trying to reconnect on failure (with some time in-between)
-    while True:
-        try:
-            if config.user_token:
-                # Use token to log in
-                client.load_store()
-
-                # Sync encryption keys with the server
-                if client.should_upload_keys:
-                    await client.keys_upload()
-            else:
-                # Try to login with the configured username/password
-                try:
-                    login_response = await client.login(
-                        password=config.user_password,
-                        device_name=config.device_name,
-                    )
-
-                    # Check if login failed
-                    if type(login_response) == LoginError:
-                        logger.error("Failed to login: %s", login_response.message)
+    event_handlers = callbacks.event_handlers()
+    config_reloader.add_listener(callbacks.config_reloaded)
+
+    # Optionally handle events in worker processes instead, so that the bot can use
+    # more than one CPU core
+    worker_pool = None
+    if config.worker_count:
+        worker_pool = WorkerPool(
+            config_path, config.worker_count, client, outbound_queue=outbound_queue
+        )
+        logger.info(
+            "Worker processes read the config when they start, so only pick up "
+            "reloaded config options after a restart"
+        )
+
+    for handler, event_class in event_handlers:
+        # Only this process can decrypt events, so undecryptable events are always
+        # handled here
+        if worker_pool is not None and event_class is not MegolmEvent:
+            callback = worker_pool.wrap(handler)
+        else:
+            callback = dispatcher.wrap(handler)
+        client.add_event_callback(callback, (event_class,))
+
+        # Events that are decrypted later are handled by the same callbacks
+        if decryption_retry is not None:
+            decryption_retry.add_callback(callback, event_class)
+
+    # Only sync the events that we have callbacks for
+    sync_filter = build_sync_filter(
+        [event_class for _, event_class in event_handlers],
+        lazy_load_members=config.sync_lazy_load_members,
+        timeline_limit=config.sync_timeline_limit,
+        rooms=config.sync_rooms,
+        not_rooms=config.sync_ignored_rooms,
+    )
+
+    # Reconnect with exponential backoff when the connection to the homeserver drops
+    supervisor = ReconnectSupervisor(
+        client,
+        ExponentialBackoff(
+            initial_delay=config.reconnect_initial_delay,
+            max_delay=config.reconnect_max_delay,
+        ),
+    )
+
+    if config.metrics_enabled:
+        track_sync(client)
+        QUEUE_DEPTH.set_function(
+            lambda: dispatcher.pending, queue="dispatch", account=account.user_id
+        )
+        QUEUE_DEPTH.set_function(
+            lambda: join_queue.depth, queue="join", account=account.user_id
+        )
+        if decryption_retry is not None:
+            QUEUE_DEPTH.set_function(
+                lambda: decryption_retry.depth,
+                queue="decryption_retry",
+                account=account.user_id,
+            )
+        RECONNECTS.set_function(lambda: supervisor.reconnects, account=account.user_id)
+        DOWNTIME_SECONDS.set_function(
+            lambda: supervisor.downtime, account=account.user_id
+        )
+
+    # Record sync responses, so that they can be replayed to benchmark the bot
+    sync_capture = None
+    if config.sync_capture_enabled:
+        capture_path = config.sync_capture_path
+        if len(config.accounts) > 1:
+            # Give each account a file of its own, named after the account
+            directory, filename = os.path.split(capture_path)
+            capture_path = os.path.join(directory, f"{account.user_id}.{filename}")
+        sync_capture = SyncCapture(client, capture_path)
+
+    if worker_pool is not None:
+        worker_pool.start()
+
+    try:
+        # Keep trying to reconnect on failure (with some time in-between)
+        while True:
+            try:
+                if account.user_token:
+                    if supervisor.token_invalid:
+                        logger.error(
+                            "The configured user_token for %s is invalid",
+                            account.user_id,
+                        )
                         return False
-                except LocalProtocolError as e:
-                    # There's an edge case here where the user hasn't installed the correct C
-                    # dependencies. In that case, a LocalProtocolError is raised on login.
-                    logger.fatal(
-                        "Failed to login. Have you installed the correct dependencies? "
-                        "https://github.com/poljar/matrix-nio#installation "
-                        "Error: %s",
-                        e,
-                    )
-                    return False
 
-                # Login succeeded!
+                    # Use token to log in
+                    if not client.store:
+                        client.load_store()
+
+                    # Sync encryption keys with the server
+                    if client.should_upload_keys:
+                        await client.keys_upload()
+                elif not client.access_token or supervisor.token_invalid:
+                    # Try to login with the configured username/password. We only need
+                    # to do this once, unless the homeserver rejects our access token
+                    try:
+                        login_response = await client.login(
+                            password=account.user_password,
+                            device_name=account.device_name,
+                        )
+
+                        # Check if login failed
+                        if type(login_response) == LoginError:
+                            logger.error(
+                                "Failed to login as %s: %s",
+                                account.user_id,
+                                login_response.message,
+                            )
+                            return False
+                    except LocalProtocolError as e:
+                        # There's an edge case here where the user hasn't installed the correct C
+                        # dependencies. In that case, a LocalProtocolError is raised on login.
+                        logger.fatal(
+                            "Failed to login. Have you installed the correct dependencies? "
+                            "https://github.com/poljar/matrix-nio#installation "
+                            "Error: %s",
+                            e,
+                        )
+                        return False
+
+                    # Login succeeded!
+                    supervisor.token_invalid = False
+
+                logger.info(f"Logged in as {account.user_id}")
+
+                if not isinstance(sync_filter, str):
+                    sync_filter = await upload_sync_filter(client, sync_filter)
+
+                # Sync from the last sync token we received (which is persisted in the
+                # store), so that reconnecting doesn't require a full initial sync
+                await client.sync_forever(
+                    timeout=30000,
+                    sync_filter=sync_filter,
+                    full_state=config.sync_full_state,
+                )
+
+            except (
+                ClientConnectionError,
+                ServerDisconnectedError,
+                asyncio.TimeoutError,
+            ):
+                supervisor.disconnected()
+
+                # Wait so we don't bombard the server with requests
+                await supervisor.wait()
+            finally:
+                # Make sure to close the client connection on disconnect
+                await client.close()
+    finally:
+        # Let the handlers of queued events finish while the outbound queue and
+        # storage are still open, as they are closed once every account stops
+        await dispatcher.join()
+
+        # Handlers may have reopened the client's connection to send their responses
+        await client.close()
+
+        # Workers send events through the outbound queue, so stop them before it is
+        # closed
+        if worker_pool is not None:
+            await worker_pool.close()
 
-            logger.info(f"Logged in as {config.user_id}")
-            await client.sync_forever(timeout=30000, full_state=True)
+        if sync_capture is not None:
+            await sync_capture.close()
 
-        except (ClientConnectionError, ServerDisconnectedError):
-            logger.warning("Unable to connect to homeserver, retrying in 15s...")
+        await join_queue.close()
+        await session_warmer.close()
 
-            # Sleep so we don't bombard the server with login requests
-            sleep(15)
-        finally:
-            # Make sure to close the client connection on disconnect
-            await client.close()
+        if decryption_retry is not None:
+            await decryption_retry.close()
 
 
-# Run the main function in an asyncio event loop
-asyncio.get_event_loop().run_until_complete(main())
+if __name__ == "__main__":
+    # Run the main function in an asyncio event loop
+    asyncio.get_event_loop().run_until_complete(main())
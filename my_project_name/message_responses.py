@@ -1,13 +1,23 @@
 import logging
+from typing import List, Optional
 
 from nio import AsyncClient, MatrixRoom, RoomMessageText
 
 from my_project_name.chat_functions import send_text_to_room
 from my_project_name.config import Config
 from my_project_name.storage import Storage
+from my_project_name.triggers import TriggerHandler, TriggerTable
 
 logger = logging.getLogger(__name__)
 
+# The messages that the bot responds to. Populated by decorating methods of `Message`
+triggers = TriggerTable()
+
+HELLO_WORLD_TEXT = "Hello, world!"
+
+# Responses that never change, and so can be rendered ahead of time
+static_responses = [HELLO_WORLD_TEXT]
+
 
 class Message:
     def __init__(
@@ -18,6 +28,7 @@ class Message:
         message_content: str,
         room: MatrixRoom,
         event: RoomMessageText,
+        handlers: Optional[List[TriggerHandler]] = None,
     ):
         """Initialize a new Message
 
@@ -33,6 +44,10 @@ class Message:
             room: The room the event came from.
 
             event: The event defining the message.
+
+            handlers: The handlers of the triggers that the message matches, if they
+                have already been found. If None, they are found when the message is
+                processed.
         """
         self.client = client
         self.store = store
@@ -40,13 +55,18 @@ class Message:
         self.message_content = message_content
         self.room = room
         self.event = event
+        self.handlers = handlers
 
     async def process(self) -> None:
         """Process and possibly respond to the message"""
-        if self.message_content.lower() == "hello world":
-            await self._hello_world()
+        handlers = self.handlers
+        if handlers is None:
+            handlers = triggers.match(self.message_content)
+        if handlers:
+            # Only respond with the first matching trigger
+            await handlers[0](self)
 
+    @triggers.exact("hello world")
     async def _hello_world(self) -> None:
         """Say hello"""
-        text = "Hello, world!"
-        await send_text_to_room(self.client, self.room.room_id, text)
+        await send_text_to_room(self.client, self.room.room_id, HELLO_WORLD_TEXT)
@@ -0,0 +1,322 @@
+import logging
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from aiohttp import web
+from nio import AsyncClient, SyncResponse
+
+logger = logging.getLogger(__name__)
+
+# The default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Buckets for sizes, in bytes
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7, 1e8)
+
+# All metrics, in the order they were created. See `render`
+registry: List["Metric"] = []
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(labelnames: Sequence[str], labelvalues: Sequence[str]) -> str:
+    if not labelnames:
+        return ""
+    pairs = (
+        f'{name}="{_escape(str(value))}"'
+        for name, value in zip(labelnames, labelvalues)
+    )
+    return "{" + ",".join(pairs) + "}"
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """A metric that is exported in the Prometheus text format.
+
+        Args:
+            name: The name of the metric.
+
+            documentation: A description of the metric.
+
+            labelnames: The names of the labels that each sample of this metric has.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        registry.append(self)
+
+    def _labelvalues(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        """Yields a (name suffix, formatted labels, value) tuple for each sample"""
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        """Render this metric in the Prometheus text format"""
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {value}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """A counter. As is conventional in the Prometheus text format, it is exported
+        with `_total` appended to its name, in its metadata as well as its samples, so
+        that parsers associate the two.
+        """
+        super().__init__(name + "_total", documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def inc(self, amount: float = 1, **labels: str) -> None:
+        """Increment the counter for the given labels"""
+        key = self._labelvalues(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        """Read the counter's value for the given labels from a function when the
+        metrics are collected, for counts that are kept elsewhere
+        """
+        self._functions[self._labelvalues(labels)] = function
+
+    def get(self, **labels: str) -> float:
+        key = self._labelvalues(labels)
+        function = self._functions.get(key)
+        if function is not None:
+            return function()
+        return self._values.get(key, 0)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for labelvalues, value in self._values.items():
+            yield "", _format_labels(self.labelnames, labelvalues), value
+        for labelvalues, function in self._functions.items():
+            yield "", _format_labels(self.labelnames, labelvalues), function()
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        """A gauge, whose value for each set of labels is read from a function when
+        the metrics are collected. See `set_function`.
+        """
+        super().__init__(name, documentation, labelnames)
+        self._functions: Dict[Tuple[str, ...], Callable[[], float]] = {}
+
+    def set_function(self, function: Callable[[], float], **labels: str) -> None:
+        """Set the function that provides the gauge's value for the given labels"""
+        self._functions[self._labelvalues(labels)] = function
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for labelvalues, function in self._functions.items():
+            yield "", _format_labels(self.labelnames, labelvalues), function()
+
+
+class _HistogramValues:
+    __slots__ = ("counts", "sum")
+
+    def __init__(self, bucket_count: int):
+        # The number of observations in each bucket. The last bucket is +Inf
+        self.counts = [0] * (bucket_count + 1)
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], _HistogramValues] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        """Record an observation for the given labels"""
+        key = self._labelvalues(labels)
+        values = self._values.get(key)
+        if values is None:
+            values = self._values[key] = _HistogramValues(len(self.buckets))
+
+        values.counts[bisect_left(self.buckets, value)] += 1
+        values.sum += value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        """Observe how many seconds the body of the context takes to run"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def count(self, **labels: str) -> int:
+        values = self._values.get(self._labelvalues(labels))
+        return sum(values.counts) if values else 0
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for labelvalues, values in self._values.items():
+            labelnames = self.labelnames + ("le",)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), values.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(float(bound))
+                yield "_bucket", _format_labels(
+                    labelnames, labelvalues + (le,)
+                ), cumulative
+            labels = _format_labels(self.labelnames, labelvalues)
+            yield "_sum", labels, values.sum
+            yield "_count", labels, cumulative
+
+
+def render() -> str:
+    """Render all metrics in the Prometheus text format"""
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+# Hot path metrics
+SYNC_SECONDS = Histogram(
+    "bot_sync_duration_seconds",
+    "Time between consecutive sync responses, including long-polling",
+    ["account"],
+)
+SYNC_RESPONSE_BYTES = Histogram(
+    "bot_sync_response_bytes",
+    "Size of sync response bodies",
+    ["account"],
+    buckets=SIZE_BUCKETS,
+)
+CALLBACK_SECONDS = Histogram(
+    "bot_callback_duration_seconds", "Time spent handling an event", ["callback"]
+)
+COMMAND_SECONDS = Histogram(
+    "bot_command_duration_seconds", "Time spent processing a command", ["command"]
+)
+MESSAGE_SECONDS = Histogram(
+    "bot_message_duration_seconds", "Time spent processing a non-command message"
+)
+ROOM_SEND_SECONDS = Histogram(
+    "bot_room_send_duration_seconds",
+    "Time taken to send an event, including time spent queued",
+    ["account", "event_type"],
+)
+SESSION_SHARE_SECONDS = Histogram(
+    "bot_session_share_duration_seconds",
+    "Time taken to share a Megolm session with a room, either inline before sending "
+    "an event, or ahead of time",
+    ["account", "source"],
+)
+DUPLICATE_EVENTS = Counter(
+    "bot_duplicate_events",
+    "Events that were skipped as they had already been handled",
+    ["account"],
+)
+RATE_LIMITED_COMMANDS = Counter(
+    "bot_rate_limited_commands",
+    "Commands and messages that were ignored as their sender or room was sending "
+    "them too quickly",
+    ["account", "limit"],
+)
+ROOM_SEND_ERRORS = Counter(
+    "bot_room_send_errors",
+    "Events that failed to send",
+    ["account", "event_type", "error"],
+)
+MARKDOWN_CACHE_HITS = Counter(
+    "bot_markdown_cache_hits", "Markdown texts whose rendered HTML was cached"
+)
+MARKDOWN_CACHE_MISSES = Counter(
+    "bot_markdown_cache_misses", "Markdown texts that had to be rendered to HTML"
+)
+STORAGE_QUERY_SECONDS = Histogram(
+    "bot_storage_query_duration_seconds",
+    "Time taken to run a database query, including time spent queued",
+    ["operation"],
+)
+
+# Gauges whose values are provided by other components at startup. Queues shared by
+# all accounts have an empty account label
+QUEUE_DEPTH = Gauge(
+    "bot_queue_depth", "Number of items waiting in a queue", ["queue", "account"]
+)
+RECONNECTS = Gauge(
+    "bot_reconnects", "Number of times the bot has reconnected", ["account"]
+)
+DOWNTIME_SECONDS = Gauge(
+    "bot_downtime_seconds", "Total time the bot has been disconnected for", ["account"]
+)
+
+
+def track_sync(client: AsyncClient) -> None:
+    """Record the duration and size of each sync made by a client"""
+    account = client.user_id
+    last_sync = None
+
+    async def on_sync(response: SyncResponse) -> None:
+        nonlocal last_sync
+
+        now = time.perf_counter()
+        if last_sync is not None:
+            SYNC_SECONDS.observe(now - last_sync, account=account)
+        last_sync = now
+
+        transport_response = response.transport_response
+        if transport_response is not None:
+            size = transport_response.content_length
+            if size is None:
+                # The body has already been read, so this doesn't hit the network
+                size = len(await transport_response.read())
+            SYNC_RESPONSE_BYTES.observe(size, account=account)
+
+    client.add_response_callback(on_sync, SyncResponse)
+
+
+class MetricsServer:
+    def __init__(self, host: str, port: int):
+        """An HTTP server that exposes all metrics at /metrics, in the Prometheus text
+        format.
+
+        Args:
+            host: The address to listen on.
+
+            port: The port to listen on.
+        """
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def _handle_metrics(self, request: web.Request) -> web.Response:
+        return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+    async def start(self) -> None:
+        """Start listening for requests"""
+        app = web.Application()
+        app.router.add_get("/metrics", self._handle_metrics)
+
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info("Serving metrics on http://%s:%d/metrics", self.host, self.port)
+
+    async def stop(self) -> None:
+        """Stop listening for requests"""
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,83 @@
+import logging
+from collections import OrderedDict
+from typing import Optional
+
+from my_project_name.storage import Storage, register_statement
+
+logger = logging.getLogger(__name__)
+
+register_statement(
+    "own_events_get_sender", "SELECT sender FROM own_events WHERE event_id = ?"
+)
+
+
+class OwnEventIndex:
+    def __init__(self, store: Storage, max_size: int = 10000):
+        """An index of the events sent by the bot, so that we can tell whether an event
+        was sent by us without asking the homeserver.
+
+        Recently seen events are kept in an in-memory LRU cache, in front of the
+        `own_events` database table. The cache also remembers the senders of events
+        that were not sent by us, once they have been looked up on the homeserver.
+
+        Args:
+            store: Bot storage.
+
+            max_size: The maximum number of event senders to keep in memory.
+        """
+        self.store = store
+        self.max_size = max_size
+        self._senders: "OrderedDict[str, str]" = OrderedDict()
+
+    def remember(self, event_id: str, sender: str) -> None:
+        """Cache the sender of an event in memory.
+
+        Args:
+            event_id: The ID of the event.
+
+            sender: The user ID of the event's sender.
+        """
+        self._senders[event_id] = sender
+        self._senders.move_to_end(event_id)
+        if len(self._senders) > self.max_size:
+            self._senders.popitem(last=False)
+
+    async def add(self, event_id: str, room_id: str, sender: str) -> None:
+        """Record an event that was sent by the bot.
+
+        Args:
+            event_id: The ID of the event that was sent.
+
+            room_id: The ID of the room the event was sent to.
+
+            sender: The user ID of the bot account that sent the event.
+        """
+        self.remember(event_id, sender)
+        await self.store.write(
+            "INSERT INTO own_events (event_id, room_id, sender) VALUES (?, ?, ?) "
+            "ON CONFLICT (event_id) DO NOTHING",
+            (event_id, room_id, sender),
+        )
+
+    async def get_sender(self, event_id: str) -> Optional[str]:
+        """Get the sender of an event, if it is known locally.
+
+        Args:
+            event_id: The ID of the event.
+
+        Returns:
+            The user ID of the event's sender, or None if the event is neither cached
+            nor recorded as one of our own events. The event should then be looked up
+            on the homeserver.
+        """
+        sender = self._senders.get(event_id)
+        if sender is not None:
+            self._senders.move_to_end(event_id)
+            return sender
+
+        row = await self.store.fetchone_statement("own_events_get_sender", (event_id,))
+        if row is None:
+            return None
+
+        self.remember(event_id, row[0])
+        return row[0]
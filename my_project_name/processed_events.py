@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import logging
+import math
+import time
+from collections import OrderedDict
+from typing import Iterable, Optional
+
+from my_project_name.metrics import DUPLICATE_EVENTS
+from my_project_name.storage import Storage, register_statement
+
+logger = logging.getLogger(__name__)
+
+register_statement(
+    "processed_events_get",
+    "SELECT 1 FROM processed_events "
+    "WHERE account = ? AND event_id = ? AND processed_at >= ?",
+)
+register_statement(
+    "processed_events_since",
+    "SELECT account, event_id FROM processed_events WHERE processed_at >= ?",
+)
+register_statement(
+    "processed_events_prune", "DELETE FROM processed_events WHERE processed_at < ?"
+)
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float):
+        """A set that may report false positives, but never false negatives, in a fixed
+        amount of memory. Keys cannot be removed.
+
+        Args:
+            capacity: The number of keys the filter is sized for. Adding more keys
+                raises the false positive rate above `error_rate`.
+
+            error_rate: The rate of false positives once `capacity` keys have been
+                added, between 0 and 1.
+        """
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # The optimal number of bits and hash functions for the capacity and error rate
+        self.bit_count = max(
+            8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        )
+        self.hash_count = max(1, round(self.bit_count / capacity * math.log(2)))
+        self._bits = bytearray((self.bit_count + 7) // 8)
+
+    def _positions(self, key: str) -> Iterable[int]:
+        # Derive every position from two hashes, rather than hashing the key once per
+        # position
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "big")
+        second = int.from_bytes(digest[8:], "big") | 1
+        for i in range(self.hash_count):
+            yield (first + i * second) % self.bit_count
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(key)
+        )
+
+
+class ProcessedEventLedger:
+    def __init__(
+        self,
+        store: Storage,
+        retention: float = 7 * 24 * 60 * 60,
+        bloom_capacity: int = 100000,
+        bloom_error_rate: float = 0.001,
+        max_size: int = 10000,
+    ):
+        """A record of the events that the bot has handled, so that events seen again
+        after a reconnect, a store reset or a full state sync are not handled twice.
+
+        Handled events are recorded in the `processed_events` database table for
+        `retention` seconds. An in-memory Bloom filter of the recorded events sits in
+        front of the table, so that the database is only asked about events that may
+        have been handled before, which new events almost never are. Recently handled
+        events are also kept in an in-memory LRU cache, which covers writes that are
+        still in the storage write-behind buffer.
+
+        Events are recorded per bot account, as each account handles the same event in
+        a shared room separately.
+
+        Args:
+            store: Bot storage.
+
+            retention: The number of seconds to remember a handled event for.
+
+            bloom_capacity: The number of events the Bloom filter is sized for.
+
+            bloom_error_rate: The rate at which the Bloom filter wrongly reports that an
+                event may have been handled, between 0 and 1.
+
+            max_size: The maximum number of recently handled events to keep in memory.
+        """
+        self.store = store
+        self.retention = retention
+        self.bloom_capacity = bloom_capacity
+        self.bloom_error_rate = bloom_error_rate
+        self.max_size = max_size
+
+        self._bloom = BloomFilter(bloom_capacity, bloom_error_rate)
+        self._recent: "OrderedDict[str, None]" = OrderedDict()
+        self._prune_task: Optional[asyncio.Future] = None
+
+    def _cutoff(self) -> int:
+        return int(time.time() - self.retention)
+
+    async def load(self) -> None:
+        """Forget events older than the retention window, then fill the Bloom filter
+        with the events that remain. Afterwards, do the same periodically.
+        """
+        await self.prune()
+        if self._prune_task is None:
+            self._prune_task = asyncio.ensure_future(self._prune_periodically())
+
+    async def prune(self) -> None:
+        """Delete events older than the retention window, and rebuild the Bloom filter
+        without them
+        """
+        cutoff = self._cutoff()
+        await self.store.execute_statement("processed_events_prune", (cutoff,))
+        rows = await self.store.fetchall_statement("processed_events_since", (cutoff,))
+
+        capacity = max(self.bloom_capacity, 2 * len(rows))
+        bloom = BloomFilter(capacity, self.bloom_error_rate)
+        for account, event_id in rows:
+            bloom.add(f"{account} {event_id}")
+        for key in self._recent:
+            bloom.add(key)
+        self._bloom = bloom
+
+        logger.debug("Loaded %d processed events", len(rows))
+
+    async def _prune_periodically(self) -> None:
+        """Prune the ledger a few times per retention window"""
+        while True:
+            await asyncio.sleep(self.retention / 4)
+            try:
+                await self.prune()
+            except Exception:
+                logger.exception("Failed to prune processed events")
+
+    async def claim(self, account: str, event_id: str) -> bool:
+        """Record that an event is being handled, unless it has been handled before.
+
+        Args:
+            account: The user ID of the bot account handling the event.
+
+            event_id: The ID of the event.
+
+        Returns:
+            True if the event has not been handled before, and should be handled now.
+            False if it has already been handled, and should be skipped.
+        """
+        key = f"{account} {event_id}"
+        if key in self._recent:
+            self._recent.move_to_end(key)
+            DUPLICATE_EVENTS.inc(account=account)
+            return False
+
+        # A Bloom filter miss means that the event has definitely not been handled
+        if key in self._bloom:
+            row = await self.store.fetchone_statement(
+                "processed_events_get", (account, event_id, self._cutoff())
+            )
+            if row is not None:
+                DUPLICATE_EVENTS.inc(account=account)
+                return False
+
+        self._bloom.add(key)
+        self._recent[key] = None
+        if len(self._recent) > self.max_size:
+            self._recent.popitem(last=False)
+
+        await self.store.write(
+            "INSERT INTO processed_events (account, event_id, processed_at) "
+            "VALUES (?, ?, ?) ON CONFLICT (account, event_id) DO NOTHING",
+            (account, event_id, int(time.time())),
+        )
+        return True
+
+    async def close(self) -> None:
+        """Stop pruning the ledger"""
+        if self._prune_task is not None:
+            self._prune_task.cancel()
+            self._prune_task = None
@@ -0,0 +1,162 @@
+import time
+from collections import OrderedDict
+from typing import Hashable, Optional
+
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        """A token bucket, which allows `rate` actions per second on average, with
+        bursts of up to `capacity` actions.
+
+        Args:
+            rate: The number of tokens added to the bucket per second.
+
+            capacity: The maximum number of tokens the bucket can hold. The bucket
+                starts full.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        if now <= self.updated:
+            # e.g. a bucket created after the caller read the time
+            return
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: Optional[float] = None) -> float:
+        """Get the number of seconds until a token is available, without taking it.
+
+        Returns:
+            0 if a token is available now.
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self, now: Optional[float] = None) -> bool:
+        """Take a token from the bucket, if one is available.
+
+        Returns:
+            Whether a token was taken.
+        """
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+class TokenBucketTable:
+    def __init__(self, rate: float, capacity: float, max_buckets: int = 10000):
+        """A fixed-size table of token buckets, one per key (such as a room or user ID).
+
+        Once the table holds `max_buckets` buckets, the least recently used bucket is
+        evicted to make room for a new one. An evicted key starts again with a full
+        bucket, which errs on the side of allowing actions.
+
+        Args:
+            rate: The rate of each bucket. See `TokenBucket`.
+
+            capacity: The capacity of each bucket. See `TokenBucket`.
+
+            max_buckets: The maximum number of buckets to keep.
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.max_buckets = max_buckets
+        self._buckets: "OrderedDict[Hashable, TokenBucket]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def get(self, key: Hashable) -> TokenBucket:
+        """Get the bucket for a key, creating it if it does not exist"""
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                self._buckets.popitem(last=False)
+            bucket = TokenBucket(self.rate, self.capacity)
+            self._buckets[key] = bucket
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+
+class CommandRateLimiter:
+    def __init__(
+        self,
+        user_rate: float = 0.2,
+        user_burst: float = 5,
+        room_rate: float = 0.5,
+        room_burst: float = 10,
+        notice_interval: float = 60,
+        max_buckets: int = 10000,
+    ):
+        """Limits how often each user, and each room, can make the bot respond, so that
+        a single user can't use up the bot's homeserver rate limit.
+
+        Bucket state is kept in fixed-size tables, so that a large number of users
+        cannot make the bot use an unbounded amount of memory.
+
+        Args:
+            user_rate: The average number of commands per second allowed from a user.
+
+            user_burst: The maximum number of commands in a burst from a user.
+
+            room_rate: The average number of commands per second allowed in a room.
+
+            room_burst: The maximum number of commands in a burst in a room.
+
+            notice_interval: The minimum number of seconds between telling a room
+                that commands are being ignored. See `should_notify`.
+
+            max_buckets: The maximum number of users, and of rooms, to keep buckets
+                for.
+        """
+        self._users = TokenBucketTable(user_rate, user_burst, max_buckets)
+        self._rooms = TokenBucketTable(room_rate, room_burst, max_buckets)
+
+        # A bucket holding a single token, refilled once per interval, for each room
+        self._notices = TokenBucketTable(1 / notice_interval, 1, max_buckets)
+
+    def check(
+        self, user_id: str, room_id: str, now: Optional[float] = None
+    ) -> Optional[str]:
+        """Take a token for a command from the user's and the room's buckets, if both
+        have one available.
+
+        Args:
+            user_id: The user who sent the command.
+
+            room_id: The room the command was sent in.
+
+        Returns:
+            None if the command is allowed, otherwise which limit it exceeded: either
+            "user" or "room".
+        """
+        now = time.monotonic() if now is None else now
+        user_bucket = self._users.get(user_id)
+        room_bucket = self._rooms.get(room_id)
+
+        # Check both buckets before taking a token from either, so that a command
+        # which is ignored doesn't count towards the other limit
+        if user_bucket.wait_time(now):
+            return "user"
+        if room_bucket.wait_time(now):
+            return "room"
+
+        user_bucket.consume(now)
+        room_bucket.consume(now)
+        return None
+
+    def should_notify(self, room_id: str, now: Optional[float] = None) -> bool:
+        """Whether to tell a room that commands are being ignored. Returns True at most
+        once every `notice_interval` seconds per room.
+        """
+        return self._notices.get(room_id).consume(now)
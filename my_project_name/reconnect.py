@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Optional
+
+from nio import AsyncClient, SyncError, SyncResponse
+
+logger = logging.getLogger(__name__)
+
+
+class ExponentialBackoff:
+    def __init__(
+        self,
+        initial_delay: float = 1,
+        max_delay: float = 300,
+        multiplier: float = 2,
+    ):
+        """Calculates delays between retries that grow exponentially, with jitter.
+
+        "Full jitter" is used, where each delay is picked uniformly between zero and
+        the current exponential delay. This spreads out the reconnects of many clients
+        that lost their connection at the same time.
+
+        Args:
+            initial_delay: The maximum delay before the first retry, in seconds.
+
+            max_delay: The largest delay to ever return, in seconds.
+
+            multiplier: How much the maximum delay grows after each retry.
+        """
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.multiplier = multiplier
+        self.attempts = 0
+
+    def next_delay(self) -> float:
+        """Get the number of seconds to wait before the next retry"""
+        ceiling = min(
+            self.max_delay, self.initial_delay * self.multiplier**self.attempts
+        )
+        self.attempts += 1
+        return random.uniform(0, ceiling)
+
+    def reset(self) -> None:
+        """Start again from the initial delay, e.g. after a successful retry"""
+        self.attempts = 0
+
+
+class ReconnectSupervisor:
+    def __init__(self, client: AsyncClient, backoff: ExponentialBackoff):
+        """Keeps track of the connection to the homeserver: waits between reconnect
+        attempts without blocking the event loop, and records how often and for how
+        long the bot has been disconnected.
+
+        Registers response callbacks on the client, so that a successful sync marks the
+        bot as connected, and a sync rejected due to an invalid access token stops the
+        sync loop so that the bot can log in again.
+
+        Args:
+            client: The client to supervise.
+
+            backoff: Calculates the delays between reconnect attempts.
+        """
+        self.client = client
+        self.backoff = backoff
+
+        # The number of times the bot has reconnected after losing its connection
+        self.reconnects = 0
+
+        # The total number of seconds the bot has spent disconnected, not including
+        # the current disconnection
+        self.total_downtime = 0.0
+
+        # Whether the access token was rejected, and we need to log in again
+        self.token_invalid = False
+
+        self._disconnected_at: Optional[float] = None
+
+        client.add_response_callback(self._on_sync, SyncResponse)
+        client.add_response_callback(self._on_sync_error, SyncError)
+
+    @property
+    def connected(self) -> bool:
+        return self._disconnected_at is None
+
+    @property
+    def downtime(self) -> float:
+        """The number of seconds the bot has been disconnected for, including the
+        current disconnection
+        """
+        if self._disconnected_at is None:
+            return self.total_downtime
+        return self.total_downtime + time.monotonic() - self._disconnected_at
+
+    def disconnected(self) -> None:
+        """Record that the connection to the homeserver was lost"""
+        if self._disconnected_at is None:
+            self._disconnected_at = time.monotonic()
+
+    async def wait(self) -> None:
+        """Wait before the next reconnect attempt"""
+        delay = self.backoff.next_delay()
+        logger.warning(
+            "Unable to connect to homeserver, retrying in %.1fs (down for %.0fs)...",
+            delay,
+            self.downtime,
+        )
+        await asyncio.sleep(delay)
+
+    async def _on_sync(self, response: SyncResponse) -> None:
+        if self._disconnected_at is None:
+            return
+
+        outage = time.monotonic() - self._disconnected_at
+        self.total_downtime += outage
+        self.reconnects += 1
+        self._disconnected_at = None
+        self.backoff.reset()
+
+        logger.info(
+            "Reconnected to homeserver after %.1fs (%d reconnects, %.0fs total downtime)",
+            outage,
+            self.reconnects,
+            self.total_downtime,
+        )
+
+    async def _on_sync_error(self, response: SyncError) -> None:
+        if response.status_code == "M_UNKNOWN_TOKEN":
+            logger.warning("Access token was rejected by the homeserver")
+            self.token_invalid = True
+            self.client.stop_sync_forever()
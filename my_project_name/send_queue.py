@@ -0,0 +1,274 @@
+import asyncio
+import heapq
+import logging
+import time
+from itertools import count
+from typing import Any, Dict, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from nio import AsyncClient, ErrorResponse, Response
+
+from my_project_name.rate_limit import TokenBucket, TokenBucketTable
+
+logger = logging.getLogger(__name__)
+
+# Send priorities. Lower values are sent first
+PRIORITY_MESSAGE = 0
+PRIORITY_REACTION = 10
+
+
+class _OutboundEvent:
+    __slots__ = (
+        "client",
+        "room_id",
+        "message_type",
+        "content",
+        "tx_id",
+        "future",
+        "attempts",
+    )
+
+    def __init__(
+        self,
+        client: AsyncClient,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        future: asyncio.Future,
+        tx_id: Optional[str] = None,
+    ):
+        self.client = client
+        self.room_id = room_id
+        self.message_type = message_type
+        self.content = content
+        self.future = future
+        self.attempts = 0
+
+        # Retries reuse the same transaction ID, so that the homeserver does not send
+        # the event twice if an earlier attempt did in fact succeed
+        self.tx_id = tx_id or str(uuid4())
+
+
+class OutboundQueue:
+    def __init__(
+        self,
+        global_rate: float = 10,
+        global_burst: float = 20,
+        room_rate: float = 1,
+        room_burst: float = 5,
+        max_retries: int = 5,
+    ):
+        """A queue of events to send, which throttles sends to stay within the
+        homeserver's rate limits.
+
+        Sends are limited by a global token bucket and a token bucket per account and
+        room, and are made in order of priority. When the homeserver responds with
+        M_LIMIT_EXCEEDED, sends by that account are paused for the requested
+        `retry_after_ms` and the event is queued again. Other accounts keep sending.
+
+        Args:
+            global_rate: The average number of events to send per second, across all
+                rooms.
+
+            global_burst: The maximum number of events to send at once, across all
+                rooms.
+
+            room_rate: The average number of events for one account to send per second
+                in one room.
+
+            room_burst: The maximum number of events for one account to send at once
+                in one room.
+
+            max_retries: The number of times to retry sending an event after being
+                rate-limited, before giving up.
+        """
+        self.max_retries = max_retries
+
+        self._global_bucket = TokenBucket(global_rate, global_burst)
+        self._room_buckets = TokenBucketTable(room_rate, room_burst)
+
+        # A heap of (priority, sequence number, event). The sequence number keeps
+        # events of the same priority in the order they were queued
+        self._heap: List[Tuple[int, int, _OutboundEvent]] = []
+        self._sequence = count()
+
+        # Events waiting for their room's rate limit or for their account to be
+        # unpaused, which are not in the heap, keyed by sequence number
+        self._deferred: Dict[int, Tuple[asyncio.TimerHandle, _OutboundEvent]] = {}
+
+        # The time until which the homeserver has asked each account to stop sending,
+        # by user ID
+        self._paused_until: Dict[str, float] = {}
+
+        # Sends that are waiting for the homeserver to respond
+        self._sending: Set[asyncio.Future] = set()
+
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Future] = None
+
+    @property
+    def depth(self) -> int:
+        """The number of events waiting to be sent"""
+        return len(self._heap) + len(self._deferred)
+
+    async def send(
+        self,
+        client: AsyncClient,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        priority: int = PRIORITY_MESSAGE,
+        tx_id: Optional[str] = None,
+    ) -> Response:
+        """Queue an event to be sent, and wait for it to be sent.
+
+        Args:
+            client: The client to send the event with.
+
+            room_id: The ID of the room to send the event to.
+
+            message_type: The type of the event.
+
+            content: The content of the event.
+
+            priority: The priority of the event. Events with lower values are sent
+                first. One of the PRIORITY_* constants.
+
+            tx_id: The transaction ID to send the event with. If None, a new one is
+                generated.
+
+        Returns:
+            The response from `client.room_send`.
+
+        Raises:
+            SendRetryError: If the event was unable to be sent.
+        """
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run())
+
+        future = asyncio.get_event_loop().create_future()
+        event = _OutboundEvent(client, room_id, message_type, content, future, tx_id)
+        self._push(priority, next(self._sequence), event)
+
+        return await future
+
+    async def close(self) -> None:
+        """Stop sending events. Events that have not yet been sent are cancelled,
+        including those waiting for the homeserver to respond
+        """
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        sending = list(self._sending)
+        for task in sending:
+            task.cancel()
+        await asyncio.gather(*sending, return_exceptions=True)
+
+        for _, _, event in self._heap:
+            event.future.cancel()
+        self._heap.clear()
+
+        for handle, event in self._deferred.values():
+            handle.cancel()
+            event.future.cancel()
+        self._deferred.clear()
+
+    def _push(self, priority: int, sequence: int, event: _OutboundEvent) -> None:
+        heapq.heappush(self._heap, (priority, sequence, event))
+        self._wakeup.set()
+
+    def _defer(
+        self, delay: float, priority: int, sequence: int, event: _OutboundEvent
+    ) -> None:
+        """Take an event out of the heap for `delay` seconds"""
+
+        def requeue():
+            del self._deferred[sequence]
+            self._push(priority, sequence, event)
+
+        handle = asyncio.get_event_loop().call_later(delay, requeue)
+        self._deferred[sequence] = (handle, event)
+
+    async def _run(self) -> None:
+        """Send queued events as fast as the rate limits allow"""
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            now = time.monotonic()
+            wait = self._global_bucket.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            priority, sequence, event = heapq.heappop(self._heap)
+            if event.future.done():
+                # The sender stopped waiting for this event
+                continue
+
+            account = event.client.user_id
+            paused_wait = self._paused_until.get(account, 0.0) - now
+            if paused_wait > 0:
+                # Let events from other accounts go first
+                self._defer(paused_wait, priority, sequence, event)
+                continue
+
+            room_bucket = self._room_buckets.get((account, event.room_id))
+            room_wait = room_bucket.wait_time(now)
+            if room_wait > 0:
+                # Let events in other rooms go first
+                self._defer(room_wait, priority, sequence, event)
+                continue
+
+            self._global_bucket.consume(now)
+            room_bucket.consume(now)
+            task = asyncio.ensure_future(self._send(priority, sequence, event))
+            self._sending.add(task)
+            task.add_done_callback(self._sending.discard)
+
+    async def _send(self, priority: int, sequence: int, event: _OutboundEvent) -> None:
+        """Send a single event, queueing it again if we were rate-limited"""
+        event.attempts += 1
+        try:
+            response = await event.client.room_send(
+                event.room_id,
+                event.message_type,
+                event.content,
+                tx_id=event.tx_id,
+                ignore_unverified_devices=True,
+            )
+        except asyncio.CancelledError:
+            # The queue was closed
+            event.future.cancel()
+            raise
+        except Exception as e:
+            if not event.future.done():
+                event.future.set_exception(e)
+            return
+
+        if (
+            isinstance(response, ErrorResponse)
+            and response.status_code == "M_LIMIT_EXCEEDED"
+            and event.attempts <= self.max_retries
+        ):
+            retry_after = (response.retry_after_ms or 1000) / 1000
+            account = event.client.user_id
+            logger.warning(
+                "Rate-limited by the homeserver, pausing sends by %s for %.1fs "
+                "(%d events queued)",
+                account,
+                retry_after,
+                self.depth + 1,
+            )
+            self._paused_until[account] = max(
+                self._paused_until.get(account, 0.0), time.monotonic() + retry_after
+            )
+            self._push(priority, sequence, event)
+            return
+
+        if not event.future.done():
+            event.future.set_result(response)
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Set
+
+from nio import (
+    AsyncClient,
+    LocalProtocolError,
+    MatrixRoom,
+    RoomMemberEvent,
+    RoomMessageText,
+)
+
+from my_project_name.metrics import SESSION_SHARE_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# The policies for choosing which rooms a SessionWarmer shares sessions with
+WARMING_POLICIES = ("off", "active", "all")
+
+
+async def share_room_session(client: AsyncClient, room_id: str, source: str) -> bool:
+    """Share a new Megolm session with the members of an encrypted room, if the room
+    needs one. This is the work that `AsyncClient.room_send` would otherwise do before
+    sending the event.
+
+    Args:
+        client: The client to share the session from.
+
+        room_id: The ID of the room.
+
+        source: What the session is being shared for, for metrics. Either "inline"
+            when about to send an event, or "warm" when sharing ahead of time.
+
+    Returns:
+        Whether a session was shared.
+    """
+    olm = getattr(client, "olm", None)
+    if olm is None:
+        # Encryption is disabled, or events are sent by another process
+        return False
+
+    room = client.rooms.get(room_id)
+    if room is None or not room.encrypted:
+        return False
+    if not olm.should_share_group_session(room_id):
+        return False
+
+    sharing = client.sharing_session.get(room_id)
+    if sharing is not None:
+        # Someone else is already sharing a session with this room
+        await sharing.wait()
+        return False
+
+    with SESSION_SHARE_SECONDS.time(account=client.user_id, source=source):
+        # Make sure that every member, and each of their devices, gets the session
+        if not room.members_synced:
+            await client.joined_members(room_id)
+        if client.should_query_keys:
+            try:
+                await client.keys_query()
+            except LocalProtocolError:
+                # A key query is already in flight
+                pass
+
+        try:
+            await client.share_group_session(room_id, ignore_unverified_devices=True)
+        except LocalProtocolError:
+            # Someone else started sharing a session while we were querying keys
+            return False
+
+    return True
+
+
+class SessionWarmer:
+    def __init__(
+        self,
+        client: AsyncClient,
+        policy: str = "active",
+        active_window: float = 60 * 60,
+        delay: float = 1,
+        max_concurrent: int = 2,
+    ):
+        """Shares Megolm sessions with encrypted rooms ahead of time, so that the next
+        reply in a room doesn't wait for a session to be shared first.
+
+        Sessions are replaced whenever a room's membership changes. Once a room's
+        membership has stopped changing for `delay` seconds, a new session is shared
+        in the background, if the room matches the policy.
+
+        Args:
+            client: The client to share sessions from.
+
+            policy: Which rooms to share sessions with ahead of time. One of "off",
+                "active" for rooms that have had a message in the last `active_window`
+                seconds, or "all" for every encrypted room.
+
+            active_window: How long a room is considered active for after a message,
+                in seconds.
+
+            delay: How long to wait for membership changes to settle before sharing a
+                session, in seconds.
+
+            max_concurrent: The maximum number of sessions to share at once.
+        """
+        if policy not in WARMING_POLICIES:
+            raise ValueError(f"Unknown session warming policy '{policy}'")
+
+        self.client = client
+        self.policy = policy
+        self.active_window = active_window
+        self.delay = delay
+
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._last_active: Dict[str, float] = {}
+        self._scheduled: Dict[str, asyncio.TimerHandle] = {}
+        self._tasks: Set[asyncio.Future] = set()
+
+    def start(self) -> None:
+        """Watch for membership changes, and for messages if needed by the policy"""
+        if self.policy == "off":
+            return
+
+        self.client.add_event_callback(self._on_member, (RoomMemberEvent,))
+        if self.policy == "active":
+            self.client.add_event_callback(self._on_message, (RoomMessageText,))
+
+    def is_active(self, room_id: str) -> bool:
+        """Whether a room has had a message in the last `active_window` seconds"""
+        last_active = self._last_active.get(room_id)
+        return (
+            last_active is not None
+            and time.monotonic() - last_active < self.active_window
+        )
+
+    async def _on_message(self, room: MatrixRoom, event: RoomMessageText) -> None:
+        self._last_active[room.room_id] = time.monotonic()
+
+    async def _on_member(self, room: MatrixRoom, event: RoomMemberEvent) -> None:
+        if not room.encrypted:
+            return
+        if self.policy == "active" and not self.is_active(room.room_id):
+            return
+
+        # Wait for the membership to settle, so that a burst of joins only causes one
+        # session to be shared
+        handle = self._scheduled.pop(room.room_id, None)
+        if handle is not None:
+            handle.cancel()
+        self._scheduled[room.room_id] = asyncio.get_event_loop().call_later(
+            self.delay, self._start_warming, room.room_id
+        )
+
+    def _start_warming(self, room_id: str) -> None:
+        del self._scheduled[room_id]
+        task = asyncio.ensure_future(self._warm(room_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _warm(self, room_id: str) -> None:
+        async with self._semaphore:
+            try:
+                if await share_room_session(self.client, room_id, "warm"):
+                    logger.debug("Shared a new session with %s ahead of time", room_id)
+            except Exception as e:
+                logger.warning("Unable to share a session with %s: %s", room_id, e)
+
+    async def close(self) -> None:
+        """Stop sharing sessions"""
+        for handle in self._scheduled.values():
+            handle.cancel()
+        self._scheduled.clear()
+
+        tasks = list(self._tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
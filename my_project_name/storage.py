@@ -1,5 +1,28 @@
+import asyncio
 import logging
-from typing import Any, Dict
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import lru_cache
+from itertools import groupby
+from operator import itemgetter
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Sequence,
+    Set,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+from my_project_name.metrics import STORAGE_QUERY_SECONDS
+from my_project_name.tracing import tracer
 
 # The latest migration version of the database.
 #
@@ -8,35 +31,144 @@ from typing import Any, Dict
 # the version specified here.
 #
 # When a migration is performed, the `migration_version` table should be incremented.
-latest_migration_version = 0
+latest_migration_version = 3
 
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
+# The integer values that SQLite reports for pragmas that are set with a keyword
+SQLITE_PRAGMA_VALUES = {
+    "synchronous": {"off": 0, "normal": 1, "full": 2, "extra": 3},
+    "temp_store": {"default": 0, "file": 1, "memory": 2},
+}
+
+# Named statements, mapping a statement name to its query. Queries use ? as the
+# placeholder for parameters. See `register_statement`.
+statements: Dict[str, str] = {}
+
+
+def register_statement(name: str, query: str) -> None:
+    """Declare a named query, to be run with `Storage.execute_statement` and friends.
+
+    Named statements are translated for the database backend once, and are run as
+    prepared statements on postgres, so that hot queries are not re-parsed and
+    re-planned every time they are run.
+
+    Statements are typically registered at import time by the module that uses them.
+
+    Args:
+        name: A unique name for the statement. Must be a valid SQL identifier.
+
+        query: The query, using ? as the placeholder for parameters.
+    """
+    if statements.get(name, query) != query:
+        raise ValueError(f"A different statement named '{name}' is already registered")
+    statements[name] = query
+
+
+@lru_cache(maxsize=256)
+def _to_postgres_placeholders(query: str) -> str:
+    """Transforms placeholder ?'s to %s for postgres. Cached, as the same queries are
+    run over and over again.
+    """
+    return query.replace("?", "%s")
+
+
+@lru_cache(maxsize=None)
+def _to_postgres_prepare(name: str, query: str) -> Tuple[str, str]:
+    """Translates a named statement into a postgres PREPARE query, and the EXECUTE
+    query that runs it.
+
+    Returns:
+        A tuple of (prepare query, execute query).
+    """
+    parts = query.split("?")
+    param_count = len(parts) - 1
+
+    # Number each placeholder, as required by PREPARE
+    prepared_query = parts[0]
+    for index, part in enumerate(parts[1:], start=1):
+        prepared_query += f"${index}{part}"
+
+    prepare = f"PREPARE {name} AS {prepared_query}"
+    if param_count:
+        execute = f"EXECUTE {name} ({', '.join(['%s'] * param_count)})"
+    else:
+        execute = f"EXECUTE {name}"
+    return prepare, execute
+
 
 class Storage:
-    def __init__(self, database_config: Dict[str, str]):
+    def __init__(self, database_config: Dict[str, Any]):
         """Setup the database.
 
         Runs an initial setup or migrations depending on whether a database file has already
         been created.
 
+        Queries made after setup should go through the awaitable methods (`execute`,
+        `executemany`, `fetchone` and `fetchall`), which run the query on a thread pool
+        so that database round-trips never block the event loop.
+
         Args:
             database_config: a dictionary containing the following keys:
                 * type: A string, one of "sqlite" or "postgres".
                 * connection_string: A string, featuring a connection string that
                     be fed to each respective db library's `connect` method.
+                * pragmas: (optional) A dictionary of SQLite pragma names to the values
+                    they should be set to on connection.
+                * max_connections: (optional) An int, the maximum number of connections
+                    to keep open to a postgres database. Defaults to 10.
+                * write_behind: (optional) A dictionary with keys `max_batch_size`,
+                    `flush_interval` and optionally `max_buffer_size`. If provided,
+                    writes made with `write` are buffered and committed in batches.
+                    See `write` and `flush`.
         """
-        self.conn = self._get_database_connection(
-            database_config["type"], database_config["connection_string"]
-        )
-        self.cursor = self.conn.cursor()
         self.db_type = database_config["type"]
 
+        # Write-behind buffer setup
+        self.write_behind = database_config.get("write_behind")
+        self._write_buffer: List[Tuple[str, Sequence[Any]]] = []
+        self._flush_task: Optional[asyncio.Future] = None
+
+        # Flushes run one at a time, so that batches are committed in order. Created
+        # on first use, in the event loop that uses it
+        self._flush_lock: Optional[asyncio.Lock] = None
+
+        if self.db_type == "postgres":
+            # Each thread in the pool borrows its own connection from the pool.
+            #
+            # Prepared statements only exist on the connection that prepared them, so
+            # we keep track of which statements each connection has prepared. Keyed by
+            # the connection itself, so that a connection that replaces a closed one
+            # starts with nothing prepared
+            self._prepared: "weakref.WeakKeyDictionary[Any, Set[str]]" = (
+                weakref.WeakKeyDictionary()
+            )
+
+            max_connections = database_config.get("max_connections", 10)
+            self.pool = self._get_connection_pool(
+                database_config["connection_string"], max_connections
+            )
+            self._executor = ThreadPoolExecutor(
+                max_workers=max_connections, thread_name_prefix="storage"
+            )
+        else:
+            # SQLite only allows a single writer at a time, so all queries are run on
+            # a single thread with a single connection
+            self.conn = self._get_database_connection(
+                self.db_type, database_config["connection_string"]
+            )
+            self.cursor = self.conn.cursor()
+            self._executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="storage"
+            )
+            self._apply_sqlite_pragmas(database_config.get("pragmas", {}))
+
         # Try to check the current migration version
         migration_level = 0
         try:
-            self._execute("SELECT version FROM migration_version")
-            row = self.cursor.fetchone()
+            row = self._fetchone("SELECT version FROM migration_version")
             migration_level = row[0]
         except Exception:
             self._initial_setup()
@@ -53,17 +185,53 @@ class Storage:
         if database_type == "sqlite":
             import sqlite3
 
-            # Initialize a connection to the database, with autocommit on
-            return sqlite3.connect(connection_string, isolation_level=None)
-        elif database_type == "postgres":
-            import psycopg2
+            # Initialize a connection to the database, with autocommit on.
+            #
+            # The connection is created on this thread but used from the storage
+            # thread. This is safe as only one thread uses it at a time.
+            #
+            # SQLite keeps compiled statements in a cache keyed on the query text, so
+            # that repeated queries (including named statements) are not re-compiled
+            return sqlite3.connect(
+                connection_string,
+                isolation_level=None,
+                check_same_thread=False,
+                cached_statements=256,
+            )
+
+    def _apply_sqlite_pragmas(self, pragmas: Dict[str, Union[int, str]]) -> None:
+        """Set the given pragmas on the SQLite connection, then check that they took
+        effect. SQLite silently ignores some values, such as WAL mode on an in-memory
+        database, or a mmap_size above the compile-time limit.
+
+        Args:
+            pragmas: A dictionary of pragma names to the values they should be set to.
+        """
+        for name, value in pragmas.items():
+            self.cursor.execute(f"PRAGMA {name} = {value}")
 
-            conn = psycopg2.connect(connection_string)
+        for name, value in pragmas.items():
+            self.cursor.execute(f"PRAGMA {name}")
+            row = self.cursor.fetchone()
+            actual = row[0] if row else None
+
+            # Some pragmas are set with a keyword, but read back as an integer
+            expected = SQLITE_PRAGMA_VALUES.get(name, {}).get(value, value)
+            if isinstance(actual, str):
+                actual = actual.lower()
+
+            if actual != expected:
+                logger.warning(
+                    "SQLite pragma %s was set to %s, but is %s", name, value, actual
+                )
+            else:
+                logger.debug("SQLite pragma %s is %s", name, value)
 
-            # Autocommit on
-            conn.set_isolation_level(0)
+    def _get_connection_pool(self, connection_string: str, max_connections: int) -> Any:
+        """Creates and returns a thread-safe pool of connections to a postgres database"""
+        from psycopg2.pool import ThreadedConnectionPool
 
-            return conn
+        return ThreadedConnectionPool(1, max_connections, connection_string)
 
     def _initial_setup(self) -> None:
         """Initial setup of the database"""
@@ -102,25 +270,512 @@ class Storage:
         """
         logger.debug("Checking for necessary database migrations...")
 
-        # if current_migration_version < 1:
-        #    logger.info("Migrating the database from v0 to v1...")
-        #
-        #    # Add new table, delete old ones, etc.
-        #
-        #    # Update the stored migration version
-        #    self._execute("UPDATE migration_version SET version = 1")
-        #
-        #    logger.info("Database migrated to v1")
+        if current_migration_version < 1:
+            logger.info("Migrating the database from v0 to v1...")
 
-    def _execute(self, *args) -> None:
+            # Add a table of the events that the bot has sent
+            self._execute(
+                """
+                CREATE TABLE own_events (
+                    event_id TEXT PRIMARY KEY,
+                    room_id TEXT NOT NULL,
+                    sender TEXT NOT NULL
+                )
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 1")
+
+            logger.info("Database migrated to v1")
+
+        if current_migration_version < 2:
+            logger.info("Migrating the database from v1 to v2...")
+
+            # Add a table of the events that the bot has handled
+            self._execute(
+                """
+                CREATE TABLE processed_events (
+                    account TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    processed_at BIGINT NOT NULL,
+                    PRIMARY KEY (account, event_id)
+                )
+            """
+            )
+            self._execute(
+                """
+                CREATE INDEX processed_events_processed_at
+                ON processed_events (processed_at)
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 2")
+
+            logger.info("Database migrated to v2")
+
+        if current_migration_version < 3:
+            logger.info("Migrating the database from v2 to v3...")
+
+            # Add a table of the events that are waiting to be decrypted
+            self._execute(
+                """
+                CREATE TABLE undecrypted_events (
+                    account TEXT NOT NULL,
+                    event_id TEXT NOT NULL,
+                    room_id TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    source TEXT NOT NULL,
+                    received_at BIGINT NOT NULL,
+                    PRIMARY KEY (account, event_id)
+                )
+            """
+            )
+
+            # Update the stored migration version
+            self._execute("UPDATE migration_version SET version = 3")
+
+            logger.info("Database migrated to v3")
+
+    @contextmanager
+    def _get_cursor(self) -> Iterator[Any]:
+        """Provides a cursor to run queries with, for the duration of the context.
+
+        For postgres, a connection is borrowed from the pool and returned afterwards.
+        """
+        if self.db_type == "postgres":
+            conn = self.pool.getconn()
+            if not conn.autocommit:
+                # Autocommit on
+                conn.set_isolation_level(0)
+
+            try:
+                with conn.cursor() as cursor:
+                    yield cursor
+            finally:
+                self.pool.putconn(conn)
+        else:
+            yield self.cursor
+
+    def _execute_with_cursor(self, cursor: Any, *args) -> None:
         """A wrapper around cursor.execute that transforms placeholder ?'s to %s for postgres.
 
         This allows for the support of queries that are compatible with both postgres and sqlite.
 
         Args:
+            cursor: The cursor to execute the query with.
+
             args: Arguments passed to cursor.execute.
         """
         if self.db_type == "postgres":
-            self.cursor.execute(args[0].replace("?", "%s"), *args[1:])
+            cursor.execute(_to_postgres_placeholders(args[0]), *args[1:])
+        else:
+            cursor.execute(*args)
+
+    def _execute(self, *args) -> None:
+        """Execute a query, blocking until it completes. See `_execute_with_cursor`.
+
+        This should only be used during database setup. Use `execute` otherwise.
+        """
+        with self._get_cursor() as cursor:
+            self._execute_with_cursor(cursor, *args)
+
+    def _executemany(self, query: str, seq_of_params: Iterable[Sequence[Any]]) -> None:
+        """A blocking wrapper around cursor.executemany, supporting ? placeholders"""
+        if self.db_type == "postgres":
+            query = _to_postgres_placeholders(query)
+
+        with self._get_cursor() as cursor:
+            cursor.executemany(query, seq_of_params)
+
+    def _fetchone(self, *args) -> Optional[Tuple]:
+        """Execute a query and return the first row of the result, blocking until it
+        completes.
+        """
+        with self._get_cursor() as cursor:
+            self._execute_with_cursor(cursor, *args)
+            return cursor.fetchone()
+
+    def _fetchall(self, *args) -> List[Tuple]:
+        """Execute a query and return all rows of the result, blocking until it
+        completes.
+        """
+        with self._get_cursor() as cursor:
+            self._execute_with_cursor(cursor, *args)
+            return cursor.fetchall()
+
+    async def _run_in_executor(self, func: Callable[..., T], *args) -> T:
+        """Run a blocking database function on the storage thread pool"""
+        loop = asyncio.get_event_loop()
+        operation = func.__name__.lstrip("_")
+        with STORAGE_QUERY_SECONDS.time(operation=operation), tracer.span(
+            "storage." + operation
+        ):
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    async def execute(self, query: str, params: Sequence[Any] = ()) -> None:
+        """Execute a query without blocking the event loop.
+
+        Args:
+            query: The query to execute, using ? as the placeholder for parameters.
+
+            params: Parameters to substitute into the query.
+        """
+        await self._run_in_executor(self._execute, query, params)
+
+    async def executemany(
+        self, query: str, seq_of_params: Iterable[Sequence[Any]]
+    ) -> None:
+        """Execute a query once for each set of parameters, without blocking the event
+        loop.
+
+        Args:
+            query: The query to execute, using ? as the placeholder for parameters.
+
+            seq_of_params: A set of parameters to substitute into the query for each
+                execution.
+        """
+        await self._run_in_executor(self._executemany, query, list(seq_of_params))
+
+    async def fetchone(self, query: str, params: Sequence[Any] = ()) -> Optional[Tuple]:
+        """Execute a query and return the first row of the result, without blocking the
+        event loop.
+
+        Args:
+            query: The query to execute, using ? as the placeholder for parameters.
+
+            params: Parameters to substitute into the query.
+
+        Returns:
+            The first row of the result, or None if there were no rows.
+        """
+        return await self._run_in_executor(self._fetchone, query, params)
+
+    async def fetchall(self, query: str, params: Sequence[Any] = ()) -> List[Tuple]:
+        """Execute a query and return every row of the result, without blocking the
+        event loop.
+
+        Args:
+            query: The query to execute, using ? as the placeholder for parameters.
+
+            params: Parameters to substitute into the query.
+
+        Returns:
+            The rows of the result.
+        """
+        return await self._run_in_executor(self._fetchall, query, params)
+
+    def _statement_query(self, cursor: Any, name: str) -> str:
+        """Get the query to run a named statement with on the given cursor.
+
+        On postgres, the statement is prepared on the cursor's connection if it has not
+        been already.
+
+        Args:
+            cursor: The cursor the statement will be run with.
+
+            name: The name of the statement, as passed to `register_statement`.
+
+        Returns:
+            The query to pass to cursor.execute or cursor.executemany.
+        """
+        query = statements[name]
+        if self.db_type != "postgres":
+            return query
+
+        prepare, execute = _to_postgres_prepare(name, query)
+
+        prepared = self._prepared.setdefault(cursor.connection, set())
+        if name not in prepared:
+            cursor.execute(prepare)
+            prepared.add(name)
+
+        return execute
+
+    def _execute_statement(self, name: str, params: Sequence[Any] = ()) -> None:
+        """Execute a named statement, blocking until it completes"""
+        with self._get_cursor() as cursor:
+            cursor.execute(self._statement_query(cursor, name), params)
+
+    def _executemany_statement(
+        self, name: str, seq_of_params: Iterable[Sequence[Any]]
+    ) -> None:
+        """Execute a named statement once for each set of parameters, blocking until it
+        completes
+        """
+        with self._get_cursor() as cursor:
+            cursor.executemany(self._statement_query(cursor, name), seq_of_params)
+
+    def _fetchone_statement(
+        self, name: str, params: Sequence[Any] = ()
+    ) -> Optional[Tuple]:
+        """Execute a named statement and return the first row of the result, blocking
+        until it completes
+        """
+        with self._get_cursor() as cursor:
+            cursor.execute(self._statement_query(cursor, name), params)
+            return cursor.fetchone()
+
+    def _fetchall_statement(self, name: str, params: Sequence[Any] = ()) -> List[Tuple]:
+        """Execute a named statement and return all rows of the result, blocking until
+        it completes
+        """
+        with self._get_cursor() as cursor:
+            cursor.execute(self._statement_query(cursor, name), params)
+            return cursor.fetchall()
+
+    async def execute_statement(self, name: str, params: Sequence[Any] = ()) -> None:
+        """Execute a named statement without blocking the event loop.
+
+        Args:
+            name: The name of the statement, as passed to `register_statement`.
+
+            params: Parameters to substitute into the statement.
+        """
+        await self._run_in_executor(self._execute_statement, name, params)
+
+    async def executemany_statement(
+        self, name: str, seq_of_params: Iterable[Sequence[Any]]
+    ) -> None:
+        """Execute a named statement once for each set of parameters, without blocking
+        the event loop.
+
+        Args:
+            name: The name of the statement, as passed to `register_statement`.
+
+            seq_of_params: A set of parameters to substitute into the statement for
+                each execution.
+        """
+        await self._run_in_executor(
+            self._executemany_statement, name, list(seq_of_params)
+        )
+
+    async def fetchone_statement(
+        self, name: str, params: Sequence[Any] = ()
+    ) -> Optional[Tuple]:
+        """Execute a named statement and return the first row of the result, without
+        blocking the event loop.
+
+        Args:
+            name: The name of the statement, as passed to `register_statement`.
+
+            params: Parameters to substitute into the statement.
+
+        Returns:
+            The first row of the result, or None if there were no rows.
+        """
+        return await self._run_in_executor(self._fetchone_statement, name, params)
+
+    async def fetchall_statement(
+        self, name: str, params: Sequence[Any] = ()
+    ) -> List[Tuple]:
+        """Execute a named statement and return every row of the result, without
+        blocking the event loop.
+
+        Args:
+            name: The name of the statement, as passed to `register_statement`.
+
+            params: Parameters to substitute into the statement.
+
+        Returns:
+            The rows of the result.
+        """
+        return await self._run_in_executor(self._fetchall_statement, name, params)
+
+    def _is_transient(self, error: Exception) -> bool:
+        """Whether a query failed because of the connection to the database or its
+        state, rather than because of the query itself, so that it may succeed if it
+        is run again
+        """
+        if self.db_type == "postgres":
+            import psycopg2
+
+            return isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError))
+
+        import sqlite3
+
+        # SQLite also raises OperationalError for invalid queries
+        return isinstance(error, sqlite3.OperationalError) and (
+            "locked" in str(error) or "busy" in str(error)
+        )
+
+    def _execute_batch(self, writes: List[Tuple[str, Sequence[Any]]]) -> None:
+        """Execute a list of writes in a single transaction, blocking until it is
+        committed.
+
+        Consecutive writes that use the same query are executed together with
+        cursor.executemany.
+
+        Args:
+            writes: A list of (query, params) tuples to execute, in order.
+        """
+        with self._get_cursor() as cursor:
+            cursor.execute("BEGIN")
+            try:
+                for query, group in groupby(writes, key=itemgetter(0)):
+                    if self.db_type == "postgres":
+                        query = _to_postgres_placeholders(query)
+                    cursor.executemany(query, [params for _, params in group])
+            except Exception:
+                cursor.execute("ROLLBACK")
+                raise
+            cursor.execute("COMMIT")
+
+    def _execute_each(
+        self, writes: List[Tuple[str, Sequence[Any]]]
+    ) -> List[Tuple[str, Sequence[Any]]]:
+        """Execute a list of writes one at a time, each in its own transaction, so
+        that a write that fails does not prevent the others from being committed.
+        Writes that fail are logged and dropped.
+
+        Args:
+            writes: A list of (query, params) tuples to execute, in order.
+
+        Returns:
+            The writes that were not executed because the database could not be
+            reached, to be retried later.
+        """
+        with self._get_cursor() as cursor:
+            for index, (query, params) in enumerate(writes):
+                try:
+                    self._execute_with_cursor(cursor, query, params)
+                except Exception as e:
+                    if self._is_transient(e):
+                        return writes[index:]
+                    logger.error(
+                        "Dropping buffered write that failed: %s %r: %s",
+                        query,
+                        params,
+                        e,
+                    )
+        return []
+
+    async def write(self, query: str, params: Sequence[Any] = ()) -> None:
+        """Execute a query that writes to the database.
+
+        If storage.write_behind is enabled, the write is buffered and committed
+        together with other writes once the buffer is full or the flush interval
+        has passed, and errors are logged rather than raised. See `flush`. Otherwise
+        the write is executed immediately.
+
+        Only use this for writes whose result does not need to be read back straight
+        away.
+
+        Args:
+            query: The query to execute, using ? as the placeholder for parameters.
+
+            params: Parameters to substitute into the query.
+        """
+        if not self.write_behind:
+            await self.execute(query, params)
+            return
+
+        if self._flush_task is None:
+            self._flush_task = asyncio.ensure_future(self._flush_periodically())
+
+        self._write_buffer.append((query, params))
+        if len(self._write_buffer) >= self.write_behind["max_batch_size"]:
+            await self.flush()
+
+    async def write_statement(self, name: str, params: Sequence[Any] = ()) -> None:
+        """Execute a named statement that writes to the database, buffering it if
+        storage.write_behind is enabled. See `write`.
+
+        Args:
+            name: The name of the statement, as passed to `register_statement`.
+
+            params: Parameters to substitute into the statement.
+        """
+        if not self.write_behind:
+            await self.execute_statement(name, params)
+            return
+
+        # Buffered writes are batched by query text, so buffer the query itself
+        await self.write(statements[name], params)
+
+    async def flush(self) -> None:
+        """Commit all buffered writes to the database.
+
+        If the database cannot be reached, the writes are put back at the front of the
+        buffer, to be retried by the next flush. If a write itself fails, the writes
+        are executed again one at a time, and the failing write is logged and dropped
+        so that it does not hold up the others.
+        """
+        if self._flush_lock is None:
+            self._flush_lock = asyncio.Lock()
+
+        async with self._flush_lock:
+            if not self._write_buffer:
+                return
+
+            writes, self._write_buffer = self._write_buffer, []
+            try:
+                await self._run_in_executor(self._execute_batch, writes)
+                return
+            except Exception as e:
+                if self._is_transient(e):
+                    logger.warning(
+                        "Failed to flush %d buffered writes, will retry: %s",
+                        len(writes),
+                        e,
+                    )
+                    self._requeue(writes)
+                    return
+
+                logger.warning(
+                    "Failed to flush %d buffered writes, executing them one at a "
+                    "time: %s",
+                    len(writes),
+                    e,
+                )
+
+            unexecuted = await self._run_in_executor(self._execute_each, writes)
+            if unexecuted:
+                self._requeue(unexecuted)
+
+    def _requeue(self, writes: List[Tuple[str, Sequence[Any]]]) -> None:
+        """Put writes that could not be committed back at the front of the buffer, in
+        order with any buffered since. Once the buffer holds more than
+        `max_buffer_size` writes, the oldest are dropped
+        """
+        self._write_buffer = writes + self._write_buffer
+
+        max_buffer_size = self.write_behind.get(
+            "max_buffer_size", 10 * self.write_behind["max_batch_size"]
+        )
+        excess = len(self._write_buffer) - max_buffer_size
+        if excess > 0:
+            logger.error(
+                "Write buffer is full, dropping the %d oldest buffered writes", excess
+            )
+            del self._write_buffer[:excess]
+
+    async def _flush_periodically(self) -> None:
+        """Flush buffered writes every `flush_interval` seconds"""
+        while True:
+            await asyncio.sleep(self.write_behind["flush_interval"])
+            await self.flush()
+
+    async def close(self) -> None:
+        """Flush any buffered writes and wait for any running queries to complete,
+        then close the database connection(s).
+        """
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self.flush()
+
+        if self._write_buffer:
+            logger.error(
+                "Dropping %d buffered writes that could not be committed",
+                len(self._write_buffer),
+            )
+            self._write_buffer.clear()
+
+        self._executor.shutdown(wait=True)
+
+        if self.db_type == "postgres":
+            self.pool.closeall()
         else:
-            self.cursor.execute(*args)
+            self.conn.close()
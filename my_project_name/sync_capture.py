@@ -0,0 +1,238 @@
+import asyncio
+import gzip
+import json
+import logging
+import os
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+from nio import AsyncClient, SyncResponse
+
+logger = logging.getLogger(__name__)
+
+# Tells zlib to expect a gzip header and trailer
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# How much of a capture file to read at once
+_CHUNK_SIZE = 64 * 1024
+
+
+class SyncCapture:
+    def __init__(self, client: AsyncClient, filepath: str):
+        """Records the raw body of every sync response the client receives, so that
+        the traffic can be replayed later with `replay_capture`.
+
+        Responses are appended to a gzip-compressed file, one JSON object per line.
+        Each line is compressed as a separate gzip member, so that everything written
+        before the bot is killed can be read back. An incomplete line at the end of the
+        file is removed before appending to it. Each time capturing starts, a header
+        line recording the bot's user ID is written first. Writes happen on a
+        background thread, so that compressing large sync responses does not block the
+        event loop.
+
+        Args:
+            client: The client whose sync responses should be captured.
+
+            filepath: The path of the file to append to.
+        """
+        self.client = client
+        self.filepath = filepath
+
+        _truncate_incomplete(filepath)
+        self._file = open(filepath, "ab")
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="sync-capture"
+        )
+        self._write({"header": {"user_id": client.user_id, "time": time.time()}})
+
+        client.add_response_callback(self._on_sync, SyncResponse)
+
+    def _write(self, line: Dict[str, Any]) -> "asyncio.Future":
+        data = json.dumps(line, separators=(",", ":")) + "\n"
+        return asyncio.get_event_loop().run_in_executor(
+            self._executor, self._write_sync, data
+        )
+
+    def _write_sync(self, data: str) -> None:
+        self._file.write(gzip.compress(data.encode("utf-8")))
+        # Make each response readable even if the bot is killed before closing
+        self._file.flush()
+
+    async def _on_sync(self, response: SyncResponse) -> None:
+        transport_response = response.transport_response
+        if transport_response is None:
+            return
+
+        # The body has already been read, so this doesn't hit the network
+        try:
+            body = json.loads(await transport_response.read())
+        except ValueError:
+            logger.warning("Unable to capture sync response with an invalid body")
+            return
+
+        await self._write({"time": time.time(), "response": body})
+
+    async def close(self) -> None:
+        """Finish writing captured responses and close the file"""
+        await asyncio.get_event_loop().run_in_executor(self._executor, self._file.close)
+        self._executor.shutdown()
+
+
+def _decompress_members(f: BinaryIO) -> Iterator[Tuple[bytes, int]]:
+    """Decompress a file of gzip members, stopping at an incomplete last member
+    rather than raising.
+
+    Args:
+        f: The file, opened for reading in binary mode.
+
+    Yields:
+        (data, end) for each piece of decompressed data, where end is the offset in
+        the file at which the last complete member read so far ends.
+
+    Raises:
+        zlib.error: If the file is corrupt.
+    """
+    end = 0
+    position = 0
+    decompressor = zlib.decompressobj(_GZIP_WBITS)
+    chunk = f.read(_CHUNK_SIZE)
+    while chunk:
+        data = decompressor.decompress(chunk)
+        if decompressor.eof:
+            unused = decompressor.unused_data
+            position += len(chunk) - len(unused)
+            end = position
+            decompressor = zlib.decompressobj(_GZIP_WBITS)
+            chunk = unused or f.read(_CHUNK_SIZE)
+        else:
+            position += len(chunk)
+            chunk = f.read(_CHUNK_SIZE)
+        yield data, end
+
+
+def _truncate_incomplete(filepath: str) -> None:
+    """Remove an incomplete gzip member from the end of a capture file, such as one
+    left by the bot being killed mid-write, so that the file can be appended to
+    """
+    try:
+        with open(filepath, "rb") as f:
+            end = 0
+            try:
+                for _, end in _decompress_members(f):
+                    pass
+            except zlib.error:
+                pass
+    except FileNotFoundError:
+        return
+
+    size = os.path.getsize(filepath)
+    if end < size:
+        logger.warning(
+            "Removing %d bytes of incomplete data from the end of %s",
+            size - end,
+            filepath,
+        )
+        os.truncate(filepath, end)
+
+
+def read_capture(filepath: str) -> Iterator[Tuple[str, float, Dict[str, Any]]]:
+    """Read the lines of a capture file written by `SyncCapture`.
+
+    Args:
+        filepath: The path of the capture file.
+
+    Yields:
+        ("header", time, header) for the header written each time capturing started,
+        and ("response", time, body) for each captured sync response body.
+    """
+    with open(filepath, "rb") as f:
+        line_number = 0
+        buffer = b""
+        try:
+            for data, _ in _decompress_members(f):
+                buffer += data
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    line_number += 1
+                    entry = _parse_line(filepath, line_number, line)
+                    if entry is not None:
+                        yield entry
+        except zlib.error as e:
+            logger.warning("Stopped reading %s, as it is corrupt: %s", filepath, e)
+
+        if buffer:
+            # The bot was killed mid-write
+            logger.warning("Skipping incomplete last line of %s", filepath)
+
+
+def _parse_line(
+    filepath: str, line_number: int, line: bytes
+) -> Optional[Tuple[str, float, Dict[str, Any]]]:
+    """Parse a line of a capture file. See `read_capture`"""
+    try:
+        entry = json.loads(line)
+    except ValueError:
+        logger.warning("Skipping invalid line %d of %s", line_number, filepath)
+        return None
+
+    if "header" in entry:
+        return "header", entry["header"]["time"], entry["header"]
+    return "response", entry["time"], entry["response"]
+
+
+async def replay_capture(
+    client: AsyncClient,
+    filepath: str,
+    realtime: bool = False,
+    speed: float = 1.0,
+    max_gap: Optional[float] = None,
+) -> int:
+    """Feed captured sync responses back through a client, as if they had just been
+    received from the homeserver. The client's event and response callbacks are run
+    for each response.
+
+    Args:
+        client: The client to feed the responses to. Any requests it makes in response
+            will really be made, so this should normally be a client that records
+            requests rather than sending them.
+
+        filepath: The path of a capture file written by `SyncCapture`.
+
+        realtime: Whether to wait between responses for as long as passed between them
+            when they were captured. Otherwise, responses are replayed as fast as
+            possible.
+
+        speed: When replaying in real time, how many times faster than real time to
+            replay.
+
+        max_gap: When replaying in real time, the longest to wait between two
+            responses, in seconds. Gaps such as bot restarts are shortened to this.
+
+    Returns:
+        The number of responses that were replayed.
+    """
+    replayed = 0
+    previous_time = None
+    for kind, captured_at, body in read_capture(filepath):
+        if kind != "response":
+            continue
+
+        if realtime and previous_time is not None:
+            delay = max(0.0, captured_at - previous_time) / speed
+            if max_gap is not None:
+                delay = min(delay, max_gap)
+            await asyncio.sleep(delay)
+        previous_time = captured_at
+
+        response = SyncResponse.from_dict(body)
+        if not isinstance(response, SyncResponse):
+            logger.warning("Skipping captured sync response that failed to parse")
+            continue
+
+        await client.receive_response(response)
+        await client.run_response_callbacks([response])
+        replayed += 1
+
+    return replayed
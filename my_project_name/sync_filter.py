@@ -0,0 +1,122 @@
+import logging
+from typing import Any, Dict, Iterable, List, Optional, Type, Union
+
+from nio import (
+    AsyncClient,
+    Event,
+    InviteMemberEvent,
+    MegolmEvent,
+    RoomMessageText,
+    UnknownEvent,
+    UploadFilterError,
+)
+
+logger = logging.getLogger(__name__)
+
+# The types of the events that are handled by each event class that we register a
+# callback for
+EVENT_TYPES_BY_CLASS: Dict[Type[Event], List[str]] = {
+    RoomMessageText: ["m.room.message"],
+    InviteMemberEvent: ["m.room.member"],
+    MegolmEvent: ["m.room.encrypted"],
+    # Reactions are the only unknown events that we handle
+    UnknownEvent: ["m.reaction"],
+}
+
+# State events that nio needs to see in room timelines in order to keep its view of
+# each room up to date. In particular, missing m.room.encryption would cause the bot
+# to send unencrypted messages to a room that had encryption turned on
+STATE_EVENT_TYPES = [
+    "m.room.create",
+    "m.room.member",
+    "m.room.encryption",
+    "m.room.name",
+    "m.room.canonical_alias",
+    "m.room.power_levels",
+    "m.room.tombstone",
+]
+
+
+def build_sync_filter(
+    event_classes: Iterable[Type[Event]],
+    lazy_load_members: bool = True,
+    timeline_limit: Optional[int] = None,
+    rooms: Optional[List[str]] = None,
+    not_rooms: Optional[List[str]] = None,
+) -> Dict[str, Any]:
+    """Build a sync filter that only asks the homeserver for the events that the bot
+    handles.
+
+    Args:
+        event_classes: The classes of the events that callbacks are registered for.
+
+        lazy_load_members: Whether to only receive the membership of users that sent
+            events in the timeline, rather than of every room member.
+
+        timeline_limit: The maximum number of timeline events to receive per room in
+            each sync. If None, the homeserver's default is used.
+
+        rooms: If provided, only receive events from these rooms.
+
+        not_rooms: Never receive events from these rooms.
+
+    Returns:
+        A filter, in the format expected by `AsyncClient.upload_filter`.
+    """
+    timeline_types = list(STATE_EVENT_TYPES)
+    for event_class in event_classes:
+        for event_type in EVENT_TYPES_BY_CLASS[event_class]:
+            if event_type not in timeline_types:
+                timeline_types.append(event_type)
+
+    timeline_filter: Dict[str, Any] = {
+        "types": timeline_types,
+        "lazy_load_members": lazy_load_members,
+    }
+    if timeline_limit is not None:
+        timeline_filter["limit"] = timeline_limit
+
+    room_filter: Dict[str, Any] = {
+        "timeline": timeline_filter,
+        "state": {"lazy_load_members": lazy_load_members},
+        # We don't handle typing notifications, read receipts or room account data
+        "ephemeral": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+    }
+    if rooms:
+        room_filter["rooms"] = rooms
+    if not_rooms:
+        room_filter["not_rooms"] = not_rooms
+
+    return {
+        # We don't handle presence or global account data either
+        "presence": {"not_types": ["*"]},
+        "account_data": {"not_types": ["*"]},
+        "room": room_filter,
+    }
+
+
+async def upload_sync_filter(
+    client: AsyncClient, sync_filter: Dict[str, Any]
+) -> Union[str, Dict[str, Any]]:
+    """Upload a sync filter to the homeserver, so that it doesn't need to be sent with
+    every sync request.
+
+    Args:
+        client: The client to upload the filter with. Must be logged in.
+
+        sync_filter: The filter to upload. See `build_sync_filter`.
+
+    Returns:
+        The ID of the uploaded filter, or the filter itself if uploading failed.
+        Either can be passed to `AsyncClient.sync_forever`.
+    """
+    response = await client.upload_filter(**sync_filter)
+    if isinstance(response, UploadFilterError):
+        logger.warning(
+            "Unable to upload sync filter, sending it with each sync instead: %s",
+            response.message,
+        )
+        return sync_filter
+
+    return response.filter_id
@@ -0,0 +1,247 @@
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+import weakref
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, Optional, Union
+
+logger = logging.getLogger(__name__)
+
+
+class Span:
+    __slots__ = (
+        "name",
+        "trace_id",
+        "span_id",
+        "parent_id",
+        "start",
+        "duration",
+        "attributes",
+        "error",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ):
+        """A timed operation within a trace.
+
+        Args:
+            name: What the span is timing.
+
+            trace_id: The ID of the trace the span belongs to.
+
+            parent_id: The ID of the span this span was started in, if any.
+
+            attributes: Extra information about the operation.
+        """
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.start = time.time()
+        self.duration = 0.0
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def as_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration * 1000,
+            "attributes": self.attributes,
+            "error": self.error,
+        }
+
+
+class SpanExporter:
+    """Receives finished spans. Subclass this to send spans somewhere new"""
+
+    def export(self, span: Span) -> None:
+        raise NotImplementedError()
+
+    def close(self) -> None:
+        pass
+
+
+class JsonLinesExporter(SpanExporter):
+    def __init__(self, filepath: str):
+        """Appends each finished span to a file, as a line of JSON.
+
+        Args:
+            filepath: The path of the file to write to.
+        """
+        self.filepath = filepath
+        self._file = open(filepath, "a", encoding="utf-8")
+
+    def export(self, span: Span) -> None:
+        self._file.write(json.dumps(span.as_dict()) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+# Marks that the current trace was not sampled, so child spans should not be recorded
+_NOT_SAMPLED = object()
+
+# The span that is currently running in each asyncio task, if any. Tasks are dropped
+# from this once they are garbage collected
+_task_spans: "weakref.WeakKeyDictionary[asyncio.Task, Union[Span, object]]" = (
+    weakref.WeakKeyDictionary()
+)
+
+# The span that is currently running outside of any task, if any
+_untasked_span: Union[Span, object, None] = None
+
+
+def _current_task() -> Optional["asyncio.Task"]:
+    # asyncio.current_task was added in Python 3.7
+    current_task = getattr(asyncio, "current_task", None) or asyncio.Task.current_task
+    try:
+        return current_task()
+    except RuntimeError:
+        # No event loop is running
+        return None
+
+
+def _get_current_span() -> Union[Span, object, None]:
+    task = _current_task()
+    if task is None:
+        return _untasked_span
+    return _task_spans.get(task)
+
+
+def _set_current_span(span: Union[Span, object, None]) -> Union[Span, object, None]:
+    """Set the span that is currently running in this task.
+
+    Returns:
+        The span that was running before, to restore once this span finishes.
+    """
+    global _untasked_span
+
+    task = _current_task()
+    if task is None:
+        previous, _untasked_span = _untasked_span, span
+    else:
+        previous = _task_spans.pop(task, None)
+        if span is not None:
+            _task_spans[task] = span
+    return previous
+
+
+class Tracer:
+    def __init__(
+        self, exporter: Optional[SpanExporter] = None, sample_rate: float = 0.0
+    ):
+        """Records traces of how long each stage of handling an event takes.
+
+        A trace is started with `start_trace` when an event arrives. Only a
+        `sample_rate` fraction of traces are recorded. Within a recorded trace, each
+        `span` is recorded as a child of the span it was started in. Spans started
+        outside of a recorded trace do nothing, so that the cost of tracing is only
+        paid for sampled events.
+
+        Args:
+            exporter: Where to send finished spans. If None, tracing is disabled.
+
+            sample_rate: The fraction of traces to record, between 0 and 1.
+        """
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    def configure(
+        self, exporter: Optional[SpanExporter], sample_rate: float = 0.0
+    ) -> None:
+        """Change where spans are sent, and how many traces are recorded"""
+        if self.exporter is not None and self.exporter is not exporter:
+            self.exporter.close()
+        self.exporter = exporter
+        self.sample_rate = sample_rate
+
+    @contextmanager
+    def start_trace(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        """Start a new trace, if this trace is sampled.
+
+        Args:
+            name: What the trace's root span is timing.
+
+            attributes: Extra information about the operation.
+
+        Yields:
+            The root span, or None if the trace is not being recorded.
+        """
+        if self.exporter is None or random.random() >= self.sample_rate:
+            previous = _set_current_span(_NOT_SAMPLED)
+            try:
+                yield None
+            finally:
+                _set_current_span(previous)
+            return
+
+        with self._record(name, os.urandom(16).hex(), None, attributes) as span:
+            yield span
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[Optional[Span]]:
+        """Record a span within the current trace, if the trace is being recorded.
+
+        Args:
+            name: What the span is timing.
+
+            attributes: Extra information about the operation.
+
+        Yields:
+            The span, or None if the span is not being recorded.
+        """
+        parent = _get_current_span()
+        if not isinstance(parent, Span):
+            yield None
+            return
+
+        with self._record(name, parent.trace_id, parent.span_id, attributes) as span:
+            yield span
+
+    @contextmanager
+    def _record(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: Optional[str],
+        attributes: Dict[str, Any],
+    ) -> Iterator[Span]:
+        span = Span(name, trace_id, parent_id, attributes)
+        previous = _set_current_span(span)
+        start = time.perf_counter()
+        try:
+            yield span
+        except BaseException as e:
+            span.error = type(e).__name__
+            raise
+        finally:
+            span.duration = time.perf_counter() - start
+            _set_current_span(previous)
+            self._export(span)
+
+    def _export(self, span: Span) -> None:
+        exporter = self.exporter
+        if exporter is None:
+            return
+
+        try:
+            exporter.export(span)
+        except Exception:
+            logger.exception("Unable to export span '%s'", span.name)
+
+
+# The tracer used throughout the bot. Disabled until configured
+tracer = Tracer()
@@ -0,0 +1,122 @@
+import re
+import warnings
+from typing import Any, Awaitable, Callable, List, Optional, Pattern, Tuple
+
+# A function that responds to a message that matched a trigger
+TriggerHandler = Callable[[Any], Awaitable[None]]
+
+# Inline flags at the start of a regular expression, such as (?i), which would
+# otherwise apply to the whole combined expression
+_LEADING_FLAGS = re.compile(r"\(\?([aiLmsux]+)\)")
+
+
+class TriggerTable:
+    def __init__(self):
+        """A table of message triggers, and the handlers to run when a message
+        matches them.
+
+        All triggers are compiled into a single regular expression, so that a message
+        that matches no trigger is scanned once no matter how many triggers there are.
+        Only messages that match are checked against the triggers individually, to
+        find any whose matches overlap. Triggers are one of:
+
+            * exact: The whole message equals the given text, ignoring case.
+            * literal: The message contains the given text, ignoring case.
+            * keyword: The message contains the given word, ignoring case.
+            * regex: The message matches the given regular expression. The expression
+                must not contain backreferences, as its groups are renumbered when it
+                is combined with other triggers. Inline flags at its start, such as
+                (?i), only apply to the expression itself.
+
+        Handlers are registered with the `exact`, `literal`, `keyword` and `regex`
+        decorators.
+        """
+        self._triggers: List[Tuple[str, TriggerHandler]] = []
+        self._pattern: Optional[Pattern] = None
+        self._trigger_patterns: List[Pattern] = []
+
+    def exact(self, text: str) -> Callable[[TriggerHandler], TriggerHandler]:
+        """Register a handler for messages that equal the given text"""
+        return self._register(r"(?i:\A" + re.escape(text) + r"\Z)")
+
+    def literal(self, text: str) -> Callable[[TriggerHandler], TriggerHandler]:
+        """Register a handler for messages that contain the given text"""
+        return self._register("(?i:" + re.escape(text) + ")")
+
+    def keyword(self, word: str) -> Callable[[TriggerHandler], TriggerHandler]:
+        """Register a handler for messages that contain the given word"""
+        return self._register(r"(?i:\b" + re.escape(word) + r"\b)")
+
+    def regex(self, pattern: str) -> Callable[[TriggerHandler], TriggerHandler]:
+        """Register a handler for messages that match the given regular expression"""
+        # Scope any leading flags to this expression, as flags that apply to the whole
+        # expression are only allowed at the start of the combined expression
+        flags = ""
+        match = _LEADING_FLAGS.match(pattern)
+        while match:
+            flags += match.group(1)
+            pattern = pattern[match.end() :]
+            match = _LEADING_FLAGS.match(pattern)
+        pattern = f"(?{flags}:{pattern})"
+
+        # Check the expression is valid as part of the combined expression now, rather
+        # than when the table is compiled. Before Python 3.11, flags in the middle of
+        # an expression only cause a warning, and apply to the whole expression
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", DeprecationWarning)
+            try:
+                re.compile("|" + pattern)
+            except DeprecationWarning as e:
+                raise re.error(str(e))
+
+        return self._register(pattern)
+
+    def _register(self, pattern: str) -> Callable[[TriggerHandler], TriggerHandler]:
+        def decorator(func: TriggerHandler) -> TriggerHandler:
+            self._triggers.append((pattern, func))
+            self._pattern = None
+            return func
+
+        return decorator
+
+    def compile(self) -> None:
+        """Compile all registered triggers into a single regular expression. Called
+        automatically by `match` if triggers have been added since the last compile.
+        """
+        # Each trigger is wrapped in a named group, so that we can tell which trigger
+        # a match came from
+        self._pattern = re.compile(
+            "|".join(
+                f"(?P<t{index}>{pattern})"
+                for index, (pattern, _) in enumerate(self._triggers)
+            )
+        )
+        self._trigger_patterns = [re.compile(pattern) for pattern, _ in self._triggers]
+
+    def match(self, message: str) -> List[TriggerHandler]:
+        """Find the handlers of all triggers that match a message.
+
+        Args:
+            message: The body of the message.
+
+        Returns:
+            The handlers of the matching triggers, in the order they were registered.
+        """
+        if not self._triggers:
+            return []
+        if self._pattern is None:
+            self.compile()
+
+        matched = {
+            int(match.lastgroup[1:]) for match in self._pattern.finditer(message)
+        }
+        if not matched:
+            # If any trigger matched, the combined expression would have too
+            return []
+
+        # A match of one trigger may hide an overlapping match of another
+        return [
+            handler
+            for index, (_, handler) in enumerate(self._triggers)
+            if index in matched or self._trigger_patterns[index].search(message)
+        ]
@@ -0,0 +1,684 @@
+"""Runs event callbacks in worker processes, so that the bot can use more than one
+CPU core.
+
+The sync process keeps the only `AsyncClient`: it syncs, decrypts events and holds the
+encryption keys. Instead of handling events itself, it routes each event to a worker
+chosen by a consistent hash of the event's room ID, so that all events in a room are
+handled by the same worker, in order. Workers handle events with the usual
+`Callbacks`, and send requests such as `room_send` back through the sync process, so
+that every outgoing event is encrypted by, and rate limited in, one place.
+
+Workers acknowledge each event once they have handled it. If a worker dies, it is
+restarted, and the events that it had not acknowledged are routed to it again.
+
+Workers share state through the database, which must be Postgres.
+"""
+
+import asyncio
+import hashlib
+import logging
+import multiprocessing
+import os
+import threading
+from bisect import bisect
+from itertools import count
+from typing import Any, Callable, Dict, List, Optional, Tuple, Type
+
+from nio import (
+    AsyncClient,
+    ErrorResponse,
+    Event,
+    InviteMemberEvent,
+    JoinError,
+    JoinResponse,
+    MatrixRoom,
+    MegolmEvent,
+    Response,
+    RoomGetEventError,
+    RoomGetEventResponse,
+    RoomMessageText,
+    RoomSendError,
+    RoomSendResponse,
+    UnknownEvent,
+)
+
+from my_project_name.dispatcher import EventHandler
+from my_project_name.send_queue import PRIORITY_MESSAGE, OutboundQueue
+
+logger = logging.getLogger(__name__)
+
+# The event classes that can be routed to workers, by name
+EVENT_CLASSES: Dict[str, Type[Event]] = {
+    event_class.__name__: event_class
+    for event_class in (RoomMessageText, InviteMemberEvent, MegolmEvent, UnknownEvent)
+}
+
+# The number of points each worker gets on the hash ring. More points spread rooms
+# more evenly between workers
+RING_REPLICAS = 100
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    def __init__(self, node_count: int, replicas: int = RING_REPLICAS):
+        """Maps keys to nodes by consistent hashing. When the number of nodes changes,
+        only around 1/node_count of keys move to a different node.
+
+        Args:
+            node_count: The number of nodes. Nodes are numbered from 0.
+
+            replicas: The number of points each node gets on the ring.
+        """
+        points = sorted(
+            (_hash(f"{node}:{replica}"), node)
+            for node in range(node_count)
+            for replica in range(replicas)
+        )
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def get(self, key: str) -> int:
+        """Get the node that a key maps to"""
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[index]
+
+
+class WorkerRoom:
+    __slots__ = ("room_id", "display_name", "member_count", "_names")
+
+    def __init__(
+        self,
+        room_id: str,
+        display_name: str,
+        member_count: int,
+        names: Dict[str, str],
+    ):
+        """The parts of a `MatrixRoom` that callbacks use, sent along with each event
+        routed to a worker, as workers have no client to keep track of rooms.
+
+        Args:
+            room_id: The ID of the room.
+
+            display_name: The room's display name.
+
+            member_count: The number of members in the room.
+
+            names: The display names of the users that callbacks may look up.
+        """
+        self.room_id = room_id
+        self.display_name = display_name
+        self.member_count = member_count
+        self._names = names
+
+    @classmethod
+    def from_room(cls, room: MatrixRoom, event: Event) -> "WorkerRoom":
+        return cls(
+            room.room_id,
+            room.display_name,
+            room.member_count,
+            {event.sender: room.user_name(event.sender) or event.sender},
+        )
+
+    def user_name(self, user_id: str) -> str:
+        return self._names.get(user_id, user_id)
+
+    def __reduce__(self) -> Tuple[Any, ...]:
+        return (
+            WorkerRoom,
+            (self.room_id, self.display_name, self.member_count, self._names),
+        )
+
+
+def _encode_response(response: Any) -> Tuple[str, Dict[str, Any]]:
+    """Encode the response to a request made on behalf of a worker, so that it can
+    be sent back to the worker
+    """
+    if isinstance(response, ErrorResponse):
+        return (
+            "error",
+            {
+                "message": response.message,
+                "status_code": response.status_code,
+                "retry_after_ms": response.retry_after_ms,
+            },
+        )
+    if isinstance(response, RoomSendResponse):
+        return "ok", {"event_id": response.event_id}
+    if isinstance(response, RoomGetEventResponse):
+        return "ok", {"source": response.event.source}
+    return "ok", {}
+
+
+def _decode_response(
+    method: str, args: Tuple[Any, ...], status: str, payload: Dict[str, Any]
+) -> Any:
+    """Turn an encoded response back into the nio response that `AsyncClient` would
+    have returned to the worker
+    """
+    room_id = args[0]
+    if status == "error":
+        error_class = {
+            "room_send": RoomSendError,
+            "join": JoinError,
+            "room_get_event": RoomGetEventError,
+        }[method]
+        return error_class(
+            payload["message"], payload["status_code"], payload["retry_after_ms"]
+        )
+
+    if method == "room_send":
+        return RoomSendResponse(payload["event_id"], room_id)
+    if method == "join":
+        return JoinResponse(room_id)
+    if method == "room_get_event":
+        return RoomGetEventResponse.from_dict(payload["source"])
+    raise ValueError(f"Unknown method '{method}'")
+
+
+class WorkerClient:
+    def __init__(
+        self,
+        user_id: str,
+        worker_id: int,
+        request_queue: Any,
+        reply_queue: Any,
+    ):
+        """Stands in for `AsyncClient` in a worker process, forwarding each request to
+        the sync process and waiting for the response.
+
+        Only the requests that callbacks make are supported.
+
+        Args:
+            user_id: The user ID of the bot.
+
+            worker_id: The index of this worker.
+
+            request_queue: The queue that all workers send requests to.
+
+            reply_queue: The queue that responses to this worker's requests arrive on.
+        """
+        self.user = user_id
+        self.user_id = user_id
+        self.worker_id = worker_id
+        self.request_queue = request_queue
+        self.reply_queue = reply_queue
+
+        # Request IDs start with a value unique to this process, so that responses to
+        # the requests of a worker that died are not taken for responses to the
+        # requests of the worker that replaced it
+        self._request_prefix = os.urandom(8).hex()
+        self._request_ids = count()
+        self._pending: Dict[str, Tuple[asyncio.Future, str, Tuple[Any, ...]]] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._reader: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        """Start reading responses from the sync process"""
+        self._loop = asyncio.get_event_loop()
+        self._reader = threading.Thread(
+            target=self._read_replies, name="worker-replies", daemon=True
+        )
+        self._reader.start()
+
+    def _read_replies(self) -> None:
+        while True:
+            reply = self.reply_queue.get()
+            if reply is None:
+                return
+            self._loop.call_soon_threadsafe(self._resolve, *reply)
+
+    def _resolve(self, request_id: str, status: str, payload: Dict[str, Any]) -> None:
+        pending = self._pending.pop(request_id, None)
+        if pending is None:
+            return
+        future, method, args = pending
+        if not future.done():
+            future.set_result(_decode_response(method, args, status, payload))
+
+    async def _request(self, method: str, *args: Any, **kwargs: Any) -> Any:
+        request_id = f"{self._request_prefix}:{next(self._request_ids)}"
+        future = asyncio.get_event_loop().create_future()
+        self._pending[request_id] = (future, method, args)
+        self.request_queue.put((self.worker_id, request_id, method, args, kwargs))
+        return await future
+
+    async def room_send(
+        self,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        tx_id: Optional[str] = None,
+        ignore_unverified_devices: bool = False,
+        priority: int = PRIORITY_MESSAGE,
+    ) -> Any:
+        return await self._request(
+            "room_send",
+            room_id,
+            message_type,
+            content,
+            tx_id=tx_id,
+            ignore_unverified_devices=ignore_unverified_devices,
+            priority=priority,
+        )
+
+    async def room_get_event(self, room_id: str, event_id: str) -> Any:
+        return await self._request("room_get_event", room_id, event_id)
+
+    async def join(self, room_id: str) -> Any:
+        return await self._request("join", room_id)
+
+    def ack(self, sequence: int) -> None:
+        """Tell the sync process that an event routed to this worker has been handled,
+        so that it isn't routed here again if this worker dies.
+
+        Args:
+            sequence: The sequence number that the event was routed with.
+        """
+        self.request_queue.put((self.worker_id, None, "ack", (sequence,), {}))
+
+    def close(self) -> None:
+        """Stop reading responses"""
+        self.reply_queue.put(None)
+
+
+class WorkerOutboundQueue(OutboundQueue):
+    """Stands in for the sync process's `OutboundQueue` in a worker process. Events are
+    passed to the sync process along with their priority, and queued there
+    """
+
+    async def send(
+        self,
+        client: AsyncClient,
+        room_id: str,
+        message_type: str,
+        content: Dict[str, Any],
+        priority: int = PRIORITY_MESSAGE,
+        tx_id: Optional[str] = None,
+    ) -> Response:
+        return await client.room_send(
+            room_id, message_type, content, tx_id=tx_id, priority=priority
+        )
+
+
+def _acknowledged(
+    handler: EventHandler, client: WorkerClient, sequence: int
+) -> EventHandler:
+    """Wrap an event callback so that the event is acknowledged once it is handled,
+    even if handling it failed
+    """
+
+    async def callback(room: MatrixRoom, event: Event) -> None:
+        try:
+            await handler(room, event)
+        finally:
+            client.ack(sequence)
+
+    return callback
+
+
+def run_worker(
+    config_path: str,
+    worker_id: int,
+    event_queue: Any,
+    request_queue: Any,
+    reply_queue: Any,
+) -> None:
+    """The entry point of a worker process.
+
+    Args:
+        config_path: The path of the bot's config file.
+
+        worker_id: The index of this worker.
+
+        event_queue: The queue that events routed to this worker arrive on.
+
+        request_queue: The queue that all workers send requests to.
+
+        reply_queue: The queue that responses to this worker's requests arrive on.
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(
+        _run_worker(config_path, worker_id, event_queue, request_queue, reply_queue)
+    )
+    loop.close()
+
+
+async def _run_worker(
+    config_path: str,
+    worker_id: int,
+    event_queue: Any,
+    request_queue: Any,
+    reply_queue: Any,
+) -> None:
+    # Imported here, as these modules import this one
+    from my_project_name import bot_commands, message_responses
+    from my_project_name.callbacks import Callbacks
+    from my_project_name.chat_functions import (
+        prerender_markdown,
+        set_markdown_cache_size,
+        set_outbound_queue,
+        set_own_event_index,
+    )
+    from my_project_name.config import Config
+    from my_project_name.dispatcher import EventDispatcher
+    from my_project_name.join_queue import JoinQueue
+    from my_project_name.own_events import OwnEventIndex
+    from my_project_name.processed_events import ProcessedEventLedger
+    from my_project_name.rate_limit import CommandRateLimiter
+    from my_project_name.storage import Storage
+
+    config = Config(config_path)
+    store = Storage(config.database)
+
+    client = WorkerClient(config.user_id, worker_id, request_queue, reply_queue)
+    client.start()
+
+    # Events are queued in the sync process, which needs to know their priority
+    if config.send_rate_limit_enabled:
+        set_outbound_queue(WorkerOutboundQueue())
+
+    own_events = OwnEventIndex(store)
+    set_own_event_index(own_events)
+
+    # Each room is only handled by one worker, so no other worker handles events
+    # that this worker's in-memory filter doesn't know about
+    processed_events = None
+    if config.processed_events_enabled:
+        processed_events = ProcessedEventLedger(store, **config.processed_events)
+        await processed_events.load()
+
+    # The sync process catches up on pending invites, so workers only join the rooms
+    # whose invites are routed to them
+    join_queue = JoinQueue(client, **config.join_queue)
+
+    # Rooms are sharded between workers, so each worker limits each user separately
+    rate_limiter = None
+    if config.command_rate_limit_enabled:
+        rate_limiter = CommandRateLimiter(**config.command_rate_limit)
+
+    callbacks: Any = Callbacks(
+        client,
+        store,
+        config,
+        own_events=own_events,
+        processed_events=processed_events,
+        join_queue=join_queue,
+        rate_limiter=rate_limiter,
+    )
+    dispatcher = EventDispatcher(
+        max_workers=config.dispatch_max_workers,
+        max_queue_size=config.dispatch_max_queue_size,
+        handler_timeout=config.dispatch_handler_timeout,
+    )
+
+    message_responses.triggers.compile()
+    set_markdown_cache_size(config.markdown_cache_size)
+    prerender_markdown(bot_commands.static_responses)
+    prerender_markdown(message_responses.static_responses)
+
+    logger.info("Worker %d started", worker_id)
+
+    loop = asyncio.get_event_loop()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, event_queue.get)
+            if item is None:
+                break
+
+            sequence, handler_name, room, class_name, source = item
+            event = EVENT_CLASSES[class_name].from_dict(source)
+            handler = _acknowledged(getattr(callbacks, handler_name), client, sequence)
+            if not dispatcher.dispatch(handler, room, event):
+                # Dropped, as the room's queue is full
+                client.ack(sequence)
+
+        # Finish handling the events that were routed to us before stopping
+        await dispatcher.join()
+    finally:
+        await join_queue.close()
+        client.close()
+        if processed_events is not None:
+            await processed_events.close()
+        await store.close()
+
+    logger.info("Worker %d stopped", worker_id)
+
+
+class WorkerPool:
+    def __init__(
+        self,
+        config_path: str,
+        worker_count: int,
+        client: AsyncClient,
+        outbound_queue: Optional[OutboundQueue] = None,
+    ):
+        """Starts worker processes, routes events to them, and makes requests on
+        their behalf.
+
+        Args:
+            config_path: The path of the bot's config file, which each worker reads.
+
+            worker_count: The number of worker processes to run.
+
+            client: The client to make requests from workers with.
+
+            outbound_queue: If provided, events sent by workers go through this queue,
+                so that all workers share the same rate limits.
+        """
+        self.config_path = config_path
+        self.worker_count = worker_count
+        self.client = client
+        self.outbound_queue = outbound_queue
+
+        self.ring = HashRing(worker_count)
+
+        # Workers are started fresh, rather than forked from this process, as forking
+        # would copy the event loop and the client's connections
+        self._context = multiprocessing.get_context("spawn")
+        self._event_queues = [self._context.Queue() for _ in range(worker_count)]
+        self._reply_queues = [self._context.Queue() for _ in range(worker_count)]
+        self._request_queue = self._context.Queue()
+        self._processes: List[Optional[Any]] = [None] * worker_count
+
+        # The events routed to each worker that it has not yet handled, by sequence
+        # number, in the order they were routed
+        self._sequence = count()
+        self._unacked: List[Dict[int, Tuple[Any, ...]]] = [
+            {} for _ in range(worker_count)
+        ]
+
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._request_reader: Optional[threading.Thread] = None
+        self._monitor_task: Optional[asyncio.Future] = None
+
+    def _start_worker(self, worker_id: int) -> None:
+        process = self._context.Process(
+            target=run_worker,
+            args=(
+                self.config_path,
+                worker_id,
+                self._event_queues[worker_id],
+                self._request_queue,
+                self._reply_queues[worker_id],
+            ),
+            name=f"worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        self._processes[worker_id] = process
+
+    def start(self) -> None:
+        """Start the worker processes, and start handling their requests"""
+        self._loop = asyncio.get_event_loop()
+        for worker_id in range(self.worker_count):
+            self._start_worker(worker_id)
+
+        self._request_reader = threading.Thread(
+            target=self._read_requests, name="worker-requests", daemon=True
+        )
+        self._request_reader.start()
+        self._monitor_task = asyncio.ensure_future(self._monitor())
+
+        logger.info("Started %d worker processes", self.worker_count)
+
+    def _restart_worker(self, worker_id: int) -> None:
+        """Start a worker again after it died, routing the events that it had not
+        handled to the new worker, in their original order
+        """
+        # The dead worker may have taken events from its queue that it never handled,
+        # so start again with a new queue rather than working out what is left
+        old_queue = self._event_queues[worker_id]
+        if hasattr(old_queue, "cancel_join_thread"):
+            # Don't wait at exit for events that nothing will read to be flushed
+            old_queue.cancel_join_thread()
+
+        event_queue = self._context.Queue()
+        for item in self._unacked[worker_id].values():
+            event_queue.put(item)
+        self._event_queues[worker_id] = event_queue
+
+        if self._unacked[worker_id]:
+            logger.info(
+                "Routing %d unhandled events to worker %d again",
+                len(self._unacked[worker_id]),
+                worker_id,
+            )
+        self._start_worker(worker_id)
+
+    async def _monitor(self, interval: float = 5) -> None:
+        """Restart workers that have died. Events that a dead worker had not handled
+        are routed to it again once it is restarted. Messages and reactions that it
+        handled but had not yet acknowledged are skipped by the processed event
+        ledger, if enabled
+        """
+        while True:
+            await asyncio.sleep(interval)
+            for worker_id, process in enumerate(self._processes):
+                if process is not None and not process.is_alive():
+                    logger.error(
+                        "Worker %d exited with code %s, restarting it",
+                        worker_id,
+                        process.exitcode,
+                    )
+                    self._restart_worker(worker_id)
+
+    def wrap(self, handler: EventHandler) -> EventHandler:
+        """Wrap an event callback so that calling it routes the event to a worker,
+        which handles it with its own instance of the same callback.
+
+        Args:
+            handler: A method of `Callbacks`.
+
+        Returns:
+            A callback suitable for `AsyncClient.add_event_callback`.
+        """
+        handler_name = handler.__name__
+
+        async def callback(room: MatrixRoom, event: Event) -> None:
+            self.route(handler_name, room, event)
+
+        return callback
+
+    def route(self, handler_name: str, room: MatrixRoom, event: Event) -> None:
+        """Send an event to the worker responsible for its room.
+
+        Args:
+            handler_name: The name of the `Callbacks` method to handle the event with.
+
+            room: The room the event came from.
+
+            event: The event itself.
+        """
+        class_name = type(event).__name__
+        if class_name not in EVENT_CLASSES:
+            # e.g. a subclass of RoomMessageText; route it as its base class
+            class_name = next(
+                name for name, cls in EVENT_CLASSES.items() if isinstance(event, cls)
+            )
+
+        worker_id = self.ring.get(room.room_id)
+        item = (
+            next(self._sequence),
+            handler_name,
+            WorkerRoom.from_room(room, event),
+            class_name,
+            event.source,
+        )
+        self._unacked[worker_id][item[0]] = item
+        self._event_queues[worker_id].put(item)
+
+    def _read_requests(self) -> None:
+        while True:
+            request = self._request_queue.get()
+            if request is None:
+                return
+
+            worker_id, _, method, args, _ = request
+            if method == "ack":
+                self._loop.call_soon_threadsafe(self._ack, worker_id, args[0])
+                continue
+
+            self._loop.call_soon_threadsafe(
+                lambda request=request: asyncio.ensure_future(
+                    self._handle_request(*request)
+                )
+            )
+
+    def _ack(self, worker_id: int, sequence: int) -> None:
+        self._unacked[worker_id].pop(sequence, None)
+
+    async def _handle_request(
+        self,
+        worker_id: int,
+        request_id: str,
+        method: str,
+        args: Tuple[Any, ...],
+        kwargs: Dict[str, Any],
+    ) -> None:
+        """Make a request on behalf of a worker, and send the response back to it"""
+        try:
+            # Events are queued by priority here, rather than by the client
+            priority = kwargs.pop("priority", PRIORITY_MESSAGE)
+            if method == "room_send" and self.outbound_queue is not None:
+                room_id, message_type, content = args
+                response = await self.outbound_queue.send(
+                    self.client,
+                    room_id,
+                    message_type,
+                    content,
+                    priority=priority,
+                    tx_id=kwargs.get("tx_id"),
+                )
+            else:
+                response = await self._call(method)(*args, **kwargs)
+            reply = _encode_response(response)
+        except Exception as e:
+            logger.exception("Request %s from worker %d failed", method, worker_id)
+            reply = ("error", {"message": str(e), "status_code": None})
+            reply[1]["retry_after_ms"] = None
+
+        self._reply_queues[worker_id].put((request_id,) + reply)
+
+    def _call(self, method: str) -> Callable[..., Any]:
+        if method not in ("room_send", "room_get_event", "join"):
+            raise ValueError(f"Workers may not call '{method}'")
+        return getattr(self.client, method)
+
+    async def close(self) -> None:
+        """Stop the workers once they have handled the events routed to them"""
+        if self._monitor_task is not None:
+            self._monitor_task.cancel()
+
+        loop = asyncio.get_event_loop()
+        for event_queue in self._event_queues:
+            event_queue.put(None)
+        for process in self._processes:
+            if process is not None:
+                # Keep handling the workers' requests while they finish up
+                await loop.run_in_executor(None, process.join)
+
+        self._request_queue.put(None)
@@ -0,0 +1,36 @@
+import copy
+import unittest
+
+from benchmarks.bench_callbacks import compare, make_stream, run_benchmark
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    def test_run_benchmark(self):
+        """Tests that the callback benchmark handles every kind of event"""
+        result = run_benchmark(events=200, rooms=10, measure_memory=False)
+
+        results = result["results"]
+        self.assertGreater(results["events_per_second"], 0)
+        self.assertEqual(
+            set(results["latency_by_kind"]),
+            {kind for kind, _, _ in make_stream(200, 10)},
+        )
+
+    def test_compare(self):
+        """Tests that a drop in throughput is reported as a regression"""
+        baseline = {
+            "results": {
+                "events_per_second": 1000.0,
+                "latency": {"p50_ms": 1.0, "p99_ms": 5.0},
+                "peak_memory_bytes": 1000000,
+            }
+        }
+        current = copy.deepcopy(baseline)
+        self.assertEqual(compare(baseline, current, max_regression=0.1), [])
+
+        current["results"]["events_per_second"] = 800.0
+        self.assertEqual(len(compare(baseline, current, max_regression=0.1)), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
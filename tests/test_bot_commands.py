@@ -0,0 +1,50 @@
+import unittest
+from unittest.mock import Mock, patch
+
+import nio
+
+from my_project_name.bot_commands import Command
+from my_project_name.storage import Storage
+
+from tests.utils import make_awaitable, run_coroutine
+
+
+class CommandTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_storage = Mock(spec=Storage)
+        self.fake_config = Mock()
+
+        self.fake_room = Mock(spec=nio.MatrixRoom)
+        self.fake_room.room_id = "!abcdefg:example.com"
+        self.fake_event = Mock(spec=nio.RoomMessageText)
+
+    def make_command(self, command: str) -> Command:
+        return Command(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            command,
+            self.fake_room,
+            self.fake_event,
+        )
+
+    @patch("my_project_name.bot_commands.send_text_to_room")
+    def test_echo(self, send_text_to_room):
+        """Tests that commands are routed by their exact first word"""
+        send_text_to_room.return_value = make_awaitable(None)
+
+        run_coroutine(self.make_command("echo hello  world").process())
+        send_text_to_room.assert_called_once_with(
+            self.fake_client, self.fake_room.room_id, "hello world"
+        )
+
+        # A command that only starts with the name of another command is unknown
+        send_text_to_room.reset_mock()
+        send_text_to_room.return_value = make_awaitable(None)
+        run_coroutine(self.make_command("echoes hello").process())
+        self.assertIn("Unknown command", send_text_to_room.call_args[0][2])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,11 @@
 import unittest
-from unittest.mock import Mock
+from unittest.mock import Mock, patch
 
 import nio
 
 from my_project_name.callbacks import Callbacks
+from my_project_name.own_events import OwnEventIndex
+from my_project_name.rate_limit import CommandRateLimiter
 from my_project_name.storage import Storage
 
 from tests.utils import make_awaitable, run_coroutine
@@ -14,6 +16,7 @@ class CallbacksTestCase(unittest.TestCase):
         # Create a Callbacks object and give it some Mock'd objects to use
         self.fake_client = Mock(spec=nio.AsyncClient)
         self.fake_client.user = "@fake_user:example.com"
+        self.fake_client.user_id = self.fake_client.user
 
         self.fake_storage = Mock(spec=Storage)
 
@@ -45,6 +48,130 @@ class CallbacksTestCase(unittest.TestCase):
         # Check that we attempted to join the room
         self.fake_client.join.assert_called_once_with(fake_room_id)
 
+    @patch("my_project_name.callbacks.send_text_to_room")
+    def test_reaction_to_own_event(self, send_text_to_room):
+        """Tests that reactions to events in the own event index are acknowledged
+        without fetching the event from the homeserver"""
+        self.fake_config.user_id = self.fake_client.user
+        store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        own_events = OwnEventIndex(store)
+        callbacks = Callbacks(
+            self.fake_client, store, self.fake_config, own_events=own_events
+        )
+
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+
+        fake_reaction_event = Mock(spec=nio.UnknownEvent)
+        fake_reaction_event.sender = "@some_other_fake_user:example.com"
+        fake_reaction_event.source = {"content": {"m.relates_to": {"key": "👍"}}}
+
+        send_text_to_room.return_value = make_awaitable(None)
+
+        async def run():
+            await own_events.add("$our_event", fake_room.room_id, self.fake_client.user)
+
+            # Forget the in-memory cache, so that the event is read from storage
+            own_events._senders.clear()
+
+            await callbacks._reaction(fake_room, fake_reaction_event, "$our_event")
+            await store.close()
+
+        run_coroutine(run())
+
+        self.fake_client.room_get_event.assert_not_called()
+        send_text_to_room.assert_called_once()
+
+    @patch("my_project_name.callbacks.send_text_to_room")
+    @patch("my_project_name.callbacks.Command")
+    def test_command_rate_limit(self, command, send_text_to_room):
+        """Tests that commands over the rate limit are ignored, and that the room is
+        only told to slow down once"""
+        self.fake_config.command_prefix = "!c "
+        callbacks = Callbacks(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            rate_limiter=CommandRateLimiter(user_burst=1),
+        )
+
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.member_count = 2
+
+        fake_message_event = Mock(spec=nio.RoomMessageText)
+        fake_message_event.sender = "@some_other_fake_user:example.com"
+        fake_message_event.event_id = "$message"
+        fake_message_event.body = "!c help"
+
+        command.return_value.process = lambda: make_awaitable(None)
+        send_text_to_room.side_effect = lambda *args, **kwargs: make_awaitable(None)
+
+        for _ in range(3):
+            run_coroutine(callbacks.message(fake_room, fake_message_event))
+
+        command.assert_called_once()
+        send_text_to_room.assert_called_once()
+
+    @patch("my_project_name.callbacks.Message")
+    @patch("my_project_name.callbacks.message_triggers")
+    def test_message_matched_once(self, message_triggers, message):
+        """Tests that a message is only matched against triggers once, and that the
+        matching handlers are passed on to the Message"""
+        self.fake_config.command_prefix = "!c "
+        callbacks = Callbacks(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            rate_limiter=CommandRateLimiter(),
+        )
+
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.member_count = 3
+
+        fake_message_event = Mock(spec=nio.RoomMessageText)
+        fake_message_event.sender = "@some_other_fake_user:example.com"
+        fake_message_event.event_id = "$message"
+        fake_message_event.body = "hello world"
+
+        handler = Mock()
+        message_triggers.match.return_value = [handler]
+        message.return_value.process = lambda: make_awaitable(None)
+
+        run_coroutine(callbacks.message(fake_room, fake_message_event))
+
+        message_triggers.match.assert_called_once_with("hello world")
+        self.assertEqual(message.call_args[1]["handlers"], [handler])
+
+    @patch("my_project_name.callbacks.Message")
+    def test_unanswered_message_not_recorded(self, message):
+        """Tests that messages the bot doesn't respond to are not recorded in the
+        processed event ledger"""
+        self.fake_config.command_prefix = "!c "
+        processed_events = Mock()
+        callbacks = Callbacks(
+            self.fake_client,
+            self.fake_storage,
+            self.fake_config,
+            processed_events=processed_events,
+        )
+
+        fake_room = Mock(spec=nio.MatrixRoom)
+        fake_room.room_id = "!abcdefg:example.com"
+        fake_room.member_count = 3
+
+        fake_message_event = Mock(spec=nio.RoomMessageText)
+        fake_message_event.sender = "@some_other_fake_user:example.com"
+        fake_message_event.event_id = "$message"
+        fake_message_event.body = "nothing to see here"
+
+        message.return_value.process = lambda: make_awaitable(None)
+
+        run_coroutine(callbacks.message(fake_room, fake_message_event))
+
+        processed_events.claim.assert_not_called()
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from my_project_name.chat_functions import (
+    markdown_cache_info,
+    prerender_markdown,
+    send_text_to_room,
+    set_markdown_cache_size,
+)
+
+from tests.utils import make_awaitable, run_coroutine
+
+
+class ChatFunctionsTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.fake_client = Mock(spec=nio.AsyncClient)
+        self.fake_client.user_id = "@fake_user:example.com"
+        self.fake_client.room_send.return_value = make_awaitable(None)
+
+        set_markdown_cache_size(2)
+
+    def test_markdown_cache(self):
+        """Tests that rendered markdown is cached, and pre-rendered texts are hits"""
+        prerender_markdown(["**static**"])
+        self.assertEqual(markdown_cache_info()["misses"], 1)
+
+        run_coroutine(send_text_to_room(self.fake_client, "!room:a", "**static**"))
+
+        content = self.fake_client.room_send.call_args[0][2]
+        self.assertEqual(content["formatted_body"], "<p><strong>static</strong></p>")
+        self.assertEqual(markdown_cache_info()["hits"], 1)
+        self.assertEqual(markdown_cache_info()["size"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
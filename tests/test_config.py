@@ -1,3 +1,5 @@
+import os
+import tempfile
 import unittest
 from unittest.mock import Mock
 
@@ -74,6 +76,73 @@ class ConfigTestCase(unittest.TestCase):
             "something",
         )
 
+    def test_parse_sqlite_pragmas(self):
+        """Test that Config._parse_sqlite_pragmas validates and normalises options"""
+        fake_config = Mock()
+        fake_config.config_dict = {
+            "storage": {"sqlite": {"journal_mode": "WAL", "mmap_size": 1048576}}
+        }
+        fake_config._get_cfg = lambda *args, **kwargs: Config._get_cfg(
+            fake_config, *args, **kwargs
+        )
+
+        # Options are lower-cased, and defaults are used for missing options
+        pragmas = Config._parse_sqlite_pragmas(fake_config)
+        self.assertEqual(pragmas["journal_mode"], "wal")
+        self.assertEqual(pragmas["mmap_size"], 1048576)
+        self.assertEqual(pragmas["synchronous"], "normal")
+
+        # Unknown keywords are rejected
+        fake_config.config_dict["storage"]["sqlite"]["synchronous"] = "sometimes"
+        with self.assertRaises(ConfigError):
+            Config._parse_sqlite_pragmas(fake_config)
+
+    def test_parse_accounts(self):
+        """Test that Config._parse_accounts reads one account or a list of them"""
+        with tempfile.TemporaryDirectory() as store_path:
+            account = {
+                "user_id": "@bot:example.com",
+                "user_password": "hunter2",
+                "device_id": "ABCDEFGHIJ",
+                "homeserver_url": "https://example.com",
+            }
+            fake_config = Mock()
+            fake_config.store_path = store_path
+            fake_config.config_dict = {"matrix": account}
+            fake_config._get_cfg = lambda *args, **kwargs: Config._get_cfg(
+                fake_config, *args, **kwargs
+            )
+            fake_config._parse_account = lambda *args: Config._parse_account(
+                fake_config, *args
+            )
+            fake_config._make_store_dir = lambda *args: Config._make_store_dir(
+                fake_config, *args
+            )
+
+            # A single account uses the store directly
+            accounts = Config._parse_accounts(fake_config)
+            self.assertEqual(len(accounts), 1)
+            self.assertEqual(accounts[0].store_path, store_path)
+            self.assertEqual(accounts[0].device_name, "nio-template")
+
+            # Each account in a list gets a store of its own
+            other_account = dict(account, user_id="@other:example.com")
+            fake_config.config_dict = {"matrix": [account, other_account]}
+            accounts = Config._parse_accounts(fake_config)
+            self.assertEqual(
+                [a.user_id for a in accounts],
+                ["@bot:example.com", "@other:example.com"],
+            )
+            self.assertEqual(
+                accounts[1].store_path, os.path.join(store_path, "@other:example.com")
+            )
+            self.assertTrue(os.path.isdir(accounts[1].store_path))
+
+            # Accounts must be different
+            fake_config.config_dict = {"matrix": [account, account]}
+            with self.assertRaises(ConfigError):
+                Config._parse_accounts(fake_config)
+
     # TODO: Test creating a test yaml file, passing the path to Config and _parse_config_values is called correctly
 
 
@@ -0,0 +1,115 @@
+import asyncio
+import logging
+import os
+import tempfile
+import unittest
+
+import yaml
+
+from my_project_name.config import Config
+from my_project_name.config_reload import ConfigReloader
+
+from tests.utils import run_coroutine
+
+
+class ConfigReloadTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "config.yaml")
+        self.options = {
+            "command_prefix": "!c",
+            "matrix": {
+                "user_id": "@bot:example.com",
+                "user_password": "hunter2",
+                "device_id": "ABCDEFGHIJ",
+                "homeserver_url": "https://example.com",
+            },
+            "storage": {
+                "database": "sqlite://" + os.path.join(self.directory.name, "bot.db"),
+                "store_path": os.path.join(self.directory.name, "store"),
+            },
+            "logging": {"file_logging": {"enabled": False}},
+        }
+        self.write_config()
+        self.config = Config(self.path, setup_logging=False)
+
+        # Reloading the log level sets it for the whole process
+        self.log_level = logging.getLogger().level
+
+    def tearDown(self) -> None:
+        logging.getLogger().setLevel(self.log_level)
+        self.directory.cleanup()
+
+    def write_config(self) -> None:
+        with open(self.path, "w") as f:
+            yaml.safe_dump(self.options, f)
+
+    def test_reload(self):
+        """Tests that reloadable options are applied, and that changes to other
+        options are reported but not applied"""
+        self.options["command_prefix"] = "!bot"
+        self.options["command_rate_limit"] = {"user_burst": 1}
+        self.options["matrix"]["device_id"] = "KLMNOPQRST"
+        self.write_config()
+
+        applied, ignored = self.config.reload()
+
+        self.assertEqual(applied, ["command_prefix", "command_rate_limit"])
+        self.assertEqual(ignored, ["matrix.device_id"])
+        self.assertEqual(self.config.command_prefix, "!bot ")
+        self.assertEqual(self.config.command_rate_limit["user_burst"], 1)
+        self.assertEqual(self.config.device_id, "ABCDEFGHIJ")
+
+        # Changes are only reported once
+        self.assertEqual(self.config.reload(), ([], []))
+
+    def test_reload_invalid(self):
+        """Tests that nothing is applied when the config file is invalid"""
+        self.options["command_prefix"] = "!bot"
+        self.options["event_dispatch"] = {"max_workers": 0}
+        self.write_config()
+
+        reloader = ConfigReloader(self.config, watch=False)
+        self.assertFalse(reloader.reload())
+        self.assertEqual(self.config.command_prefix, "!c ")
+
+        with open(self.path, "w") as f:
+            f.write("command_prefix: [")
+        self.assertFalse(reloader.reload())
+
+        # Options of the wrong type
+        self.options["event_dispatch"] = {"max_workers": "eight"}
+        self.write_config()
+        self.assertFalse(reloader.reload())
+
+        self.options["event_dispatch"] = {}
+        self.options["command_prefix"] = 5
+        self.write_config()
+        self.assertFalse(reloader.reload())
+        self.assertEqual(self.config.command_prefix, "!c ")
+
+    def test_watch(self):
+        """Tests that the config is reloaded when the file changes, and that listeners
+        are told which options were applied"""
+        reloads = []
+
+        async def run():
+            reloader = ConfigReloader(self.config, poll_interval=0.01)
+            reloader.add_listener(reloads.append)
+            reloader.start()
+
+            self.options["logging"]["level"] = "WARNING"
+            self.write_config()
+            os.utime(self.path, ns=(0, 0))
+            await asyncio.sleep(0.05)
+
+            await reloader.close()
+
+        run_coroutine(run())
+
+        self.assertEqual(reloads, [["logging.level"]])
+        self.assertEqual(self.config.log_level, "WARNING")
+
+
+if __name__ == "__main__":
+    unittest.main()
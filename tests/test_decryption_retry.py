@@ -0,0 +1,181 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from my_project_name.decryption_retry import DecryptionRetryQueue
+from my_project_name.storage import Storage
+
+from tests.utils import run_coroutine
+
+
+def make_megolm_event(event_id: str, session_id: str) -> nio.MegolmEvent:
+    event = nio.MegolmEvent.from_dict(
+        {
+            "type": "m.room.encrypted",
+            "event_id": event_id,
+            "sender": "@alice:example.com",
+            "origin_server_ts": 0,
+            "content": {
+                "algorithm": "m.megolm.v1.aes-sha2",
+                "ciphertext": "ciphertext",
+                "sender_key": "sender_key",
+                "device_id": "ABCDEFGHIJ",
+                "session_id": session_id,
+            },
+        }
+    )
+    event.room_id = "!room:example.com"
+    return event
+
+
+def make_room_key_event(session_id: str) -> nio.RoomKeyEvent:
+    return nio.RoomKeyEvent(
+        {},
+        "@alice:example.com",
+        "sender_key",
+        "!room:example.com",
+        session_id,
+        "m.megolm.v1.aes-sha2",
+    )
+
+
+class FakeClient:
+    """Can only decrypt events from the sessions in `keys`, and records key
+    requests"""
+
+    def __init__(self):
+        self.user_id = "@bot:example.com"
+        self.rooms = {"!room:example.com": Mock(spec=nio.MatrixRoom)}
+        self.keys = set()
+        self.key_requests = []
+
+    async def request_room_key(self, event):
+        self.key_requests.append(event.session_id)
+
+    def decrypt_event(self, event):
+        if event.session_id not in self.keys:
+            raise nio.EncryptionError("Missing session")
+        return nio.RoomMessageText.from_dict(
+            {
+                "type": "m.room.message",
+                "event_id": event.event_id,
+                "sender": event.sender,
+                "origin_server_ts": 0,
+                "content": {"msgtype": "m.text", "body": "hello"},
+            }
+        )
+
+
+class DecryptionRetryQueueTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeClient()
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+        self.handled = []
+
+    async def callback(self, room, event):
+        self.handled.append(event.event_id)
+
+    def make_queue(self) -> DecryptionRetryQueue:
+        queue = DecryptionRetryQueue(self.client, self.store, key_request_delay=0.01)
+        queue.add_callback(self.callback, nio.RoomMessageText)
+        return queue
+
+    def test_retry_when_key_arrives(self):
+        """Tests that keys are requested once per session, and that parked events
+        are handled once their key arrives"""
+
+        async def run():
+            queue = self.make_queue()
+            await queue.park(make_megolm_event("$a", "session1"))
+            await queue.park(make_megolm_event("$b", "session1"))
+            await queue.park(make_megolm_event("$c", "session2"))
+            await asyncio.sleep(0.05)
+
+            self.client.keys.add("session1")
+            await queue._on_room_key(make_room_key_event("session1"))
+
+            depth = queue.depth
+            await queue.close()
+            await self.store.close()
+            return depth
+
+        self.assertEqual(run_coroutine(run()), 1)
+        self.assertEqual(sorted(self.client.key_requests), ["session1", "session2"])
+        self.assertEqual(sorted(self.handled), ["$a", "$b"])
+
+    def test_load_after_restart(self):
+        """Tests that parked events are kept in storage, and handled on load if their
+        key arrived while the bot was not running"""
+
+        async def run():
+            queue = self.make_queue()
+            await queue.park(make_megolm_event("$a", "session1"))
+            await queue.close()
+
+            self.client.keys.add("session1")
+            queue = self.make_queue()
+            await queue.load()
+
+            depth = queue.depth
+            row = await self.store.fetchone("SELECT COUNT(*) FROM undecrypted_events")
+            await queue.close()
+            await self.store.close()
+            return depth, row[0]
+
+        self.assertEqual(run_coroutine(run()), (0, 0))
+        self.assertEqual(self.handled, ["$a"])
+
+    def test_bounded(self):
+        """Tests that the oldest events are dropped once the queue is full"""
+
+        async def run():
+            queue = DecryptionRetryQueue(self.client, self.store, max_size=2)
+            for event_id in ("$a", "$b", "$c"):
+                await queue.park(make_megolm_event(event_id, "session1"))
+
+            parked = list(queue._parked)
+            await queue.close()
+            await self.store.close()
+            return parked
+
+        self.assertEqual(run_coroutine(run()), ["$b", "$c"])
+
+    def test_expire_while_running(self):
+        """Tests that events older than max_age are dropped from memory and storage
+        when another event is parked"""
+
+        async def run():
+            queue = DecryptionRetryQueue(self.client, self.store, max_age=60)
+            await queue.park(make_megolm_event("$a", "session1"))
+            queue._received_at["$a"] -= 120
+            await queue.park(make_megolm_event("$b", "session2"))
+
+            parked = list(queue._parked)
+            row = await self.store.fetchone("SELECT COUNT(*) FROM undecrypted_events")
+            await queue.close()
+            await self.store.close()
+            return parked, row[0]
+
+        self.assertEqual(run_coroutine(run()), (["$b"], 1))
+
+    def test_should_react(self):
+        """Tests that reactions are collapsed per room"""
+        queue = DecryptionRetryQueue(self.client, self.store)
+
+        self.assertTrue(queue.should_react("!a:example.com"))
+        self.assertFalse(queue.should_react("!a:example.com"))
+        self.assertTrue(queue.should_react("!b:example.com"))
+
+    def test_should_react_forgets_rooms(self):
+        """Tests that rooms are forgotten once we could react in them again"""
+        queue = DecryptionRetryQueue(self.client, self.store, reaction_interval=0)
+
+        self.assertTrue(queue.should_react("!a:example.com"))
+        self.assertTrue(queue.should_react("!b:example.com"))
+        self.assertEqual(list(queue._reacted_at), ["!b:example.com"])
+
+
+if __name__ == "__main__":
+    unittest.main()
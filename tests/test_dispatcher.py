@@ -0,0 +1,82 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from my_project_name.dispatcher import EventDispatcher
+
+from tests.utils import run_coroutine
+
+
+def make_room(room_id: str) -> Mock:
+    room = Mock(spec=nio.MatrixRoom)
+    room.room_id = room_id
+    return room
+
+
+def make_event(event_id: str) -> Mock:
+    event = Mock(spec=nio.Event)
+    event.event_id = event_id
+    return event
+
+
+class EventDispatcherTestCase(unittest.TestCase):
+    def test_room_ordering_and_concurrency(self):
+        """Tests that events in a room are handled in order, while a slow room does not
+        hold up other rooms"""
+        handled = []
+
+        async def handler(room, event):
+            if room.room_id == "!slow:example.com":
+                await asyncio.sleep(0.05)
+            handled.append((room.room_id, event.event_id))
+
+        async def run():
+            dispatcher = EventDispatcher(max_workers=4)
+            slow_room = make_room("!slow:example.com")
+            fast_room = make_room("!fast:example.com")
+
+            dispatcher.dispatch(handler, slow_room, make_event("$1"))
+            dispatcher.dispatch(handler, slow_room, make_event("$2"))
+            dispatcher.dispatch(handler, fast_room, make_event("$3"))
+            await dispatcher.join()
+
+        run_coroutine(run())
+
+        # The fast room's event should not have waited for the slow room
+        self.assertEqual(
+            handled,
+            [
+                ("!fast:example.com", "$3"),
+                ("!slow:example.com", "$1"),
+                ("!slow:example.com", "$2"),
+            ],
+        )
+
+    def test_queue_limit_and_timeout(self):
+        """Tests that events beyond a room's queue limit are dropped, and that a handler
+        that times out does not prevent the next event from being handled"""
+        handled = []
+
+        async def handler(room, event):
+            if event.event_id == "$hangs":
+                await asyncio.sleep(10)
+            handled.append(event.event_id)
+
+        async def run():
+            dispatcher = EventDispatcher(max_queue_size=2, handler_timeout=0.01)
+            room = make_room("!room:example.com")
+
+            self.assertTrue(dispatcher.dispatch(handler, room, make_event("$hangs")))
+            self.assertTrue(dispatcher.dispatch(handler, room, make_event("$2")))
+            self.assertFalse(dispatcher.dispatch(handler, room, make_event("$3")))
+            await dispatcher.join()
+
+        run_coroutine(run())
+
+        self.assertEqual(handled, ["$2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import asyncio
+import unittest
+
+import nio
+
+from my_project_name.join_queue import JoinQueue
+
+from tests.utils import run_coroutine
+
+
+class FakeClient:
+    """Records joins, and fails the first `failures` joins of each room"""
+
+    def __init__(self, failures: int = 0):
+        self.failures = failures
+        self.attempts = {}
+        self.joined = []
+        self.concurrent = 0
+        self.max_concurrent = 0
+
+    async def join(self, room_id):
+        self.attempts[room_id] = self.attempts.get(room_id, 0) + 1
+        self.concurrent += 1
+        self.max_concurrent = max(self.max_concurrent, self.concurrent)
+        try:
+            await asyncio.sleep(0.01)
+        finally:
+            self.concurrent -= 1
+
+        if self.attempts[room_id] <= self.failures:
+            return nio.JoinError("Too many requests", "M_LIMIT_EXCEEDED", 10)
+
+        self.joined.append(room_id)
+        return nio.JoinResponse(room_id)
+
+
+async def wait_until_empty(queue: JoinQueue) -> None:
+    while queue.depth:
+        await asyncio.sleep(0.01)
+
+
+class JoinQueueTestCase(unittest.TestCase):
+    def test_bounded_concurrency(self):
+        """Tests that rooms are joined concurrently, up to the limit, and only once"""
+        client = FakeClient()
+        room_ids = [f"!room{i}:example.com" for i in range(10)]
+
+        async def run():
+            queue = JoinQueue(client, max_concurrent=3)
+            self.assertEqual(queue.add_many(room_ids + room_ids[:2]), 10)
+            await wait_until_empty(queue)
+            await queue.close()
+
+        run_coroutine(run())
+
+        self.assertEqual(sorted(client.joined), sorted(room_ids))
+        self.assertEqual(client.max_concurrent, 3)
+
+    def test_retry(self):
+        """Tests that failed joins are retried with backoff, and given up on after
+        max_attempts"""
+        client = FakeClient(failures=2)
+
+        async def run():
+            queue = JoinQueue(client, initial_delay=0.01)
+            queue.add("!a:example.com")
+            await wait_until_empty(queue)
+
+            queue.max_attempts = 2
+            queue.add("!b:example.com")
+            await wait_until_empty(queue)
+            await queue.close()
+
+        run_coroutine(run())
+
+        self.assertEqual(client.joined, ["!a:example.com"])
+        self.assertEqual(client.attempts, {"!a:example.com": 3, "!b:example.com": 2})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,22 @@
+import functools
+import unittest
+
+from benchmarks.load_test import message_flood, run_scenario
+
+from tests.utils import run_coroutine
+
+
+class LoadTestTestCase(unittest.TestCase):
+    def test_message_flood(self):
+        """Tests that the bot responds to every command sent through the fake
+        homeserver"""
+        scenario = functools.partial(message_flood, rooms=2, messages=20, burst=10)
+        results = run_coroutine(run_scenario(scenario, {}, timeout=30))
+
+        self.assertEqual(results["responses"], 20)
+        self.assertEqual(results["missing_responses"], 0)
+        self.assertEqual(results["requests"]["login"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
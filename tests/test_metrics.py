@@ -0,0 +1,58 @@
+import unittest
+
+from my_project_name.metrics import Counter, Histogram, registry
+
+
+class MetricsTestCase(unittest.TestCase):
+    def tearDown(self) -> None:
+        # Don't leave the test metrics in the global registry
+        del registry[-1]
+
+    def test_histogram(self):
+        """Tests that histograms are rendered with cumulative buckets"""
+        histogram = Histogram(
+            "test_seconds", "A test histogram", ["kind"], buckets=(0.1, 1)
+        )
+        histogram.observe(0.05, kind="a")
+        histogram.observe(0.5, kind="a")
+        histogram.observe(5, kind="a")
+
+        self.assertEqual(
+            histogram.render().split("\n"),
+            [
+                "# HELP test_seconds A test histogram",
+                "# TYPE test_seconds histogram",
+                'test_seconds_bucket{kind="a",le="0.1"} 1',
+                'test_seconds_bucket{kind="a",le="1.0"} 2',
+                'test_seconds_bucket{kind="a",le="+Inf"} 3',
+                'test_seconds_sum{kind="a"} 5.55',
+                'test_seconds_count{kind="a"} 3',
+            ],
+        )
+
+    def test_counter(self):
+        """Tests that counters are rendered per set of labels, with escaping"""
+        counter = Counter("test_errors", "A test counter", ["error"])
+        counter.inc(error='say "hi"')
+        counter.inc(2, error='say "hi"')
+
+        self.assertEqual(
+            counter.render().split("\n"),
+            [
+                "# HELP test_errors_total A test counter",
+                "# TYPE test_errors_total counter",
+                'test_errors_total{error="say \\"hi\\""} 3',
+            ],
+        )
+
+    def test_counter_function(self):
+        """Tests that a counter's value can be read from a function"""
+        counter = Counter("test_hits", "A test counter")
+        counter.set_function(lambda: 5)
+
+        self.assertEqual(counter.get(), 5)
+        self.assertEqual(counter.render().split("\n")[2], "test_hits_total 5")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,93 @@
+import time
+import unittest
+
+from my_project_name.processed_events import BloomFilter, ProcessedEventLedger
+from my_project_name.storage import Storage
+
+from tests.utils import run_coroutine
+
+
+class BloomFilterTestCase(unittest.TestCase):
+    def test_no_false_negatives(self):
+        """Tests that every added key is reported as present"""
+        bloom = BloomFilter(1000, 0.01)
+        keys = [f"$event{i}" for i in range(1000)]
+        for key in keys:
+            bloom.add(key)
+
+        self.assertTrue(all(key in bloom for key in keys))
+
+    def test_false_positive_rate(self):
+        """Tests that the false positive rate is close to the configured rate"""
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f"$event{i}")
+
+        false_positives = sum(f"$other{i}" in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+
+class ProcessedEventLedgerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+
+    def test_claim(self):
+        """Tests that an event is only claimed once per account"""
+
+        async def run():
+            ledger = ProcessedEventLedger(self.store)
+            await ledger.load()
+
+            claims = [
+                await ledger.claim("@bot:example.com", "$event"),
+                await ledger.claim("@bot:example.com", "$event"),
+                await ledger.claim("@other:example.com", "$event"),
+            ]
+            await ledger.close()
+            await self.store.close()
+            return claims
+
+        self.assertEqual(run_coroutine(run()), [True, False, True])
+
+    def test_claim_after_restart(self):
+        """Tests that events handled before a restart are read back from storage"""
+
+        async def run():
+            ledger = ProcessedEventLedger(self.store)
+            await ledger.claim("@bot:example.com", "$event")
+
+            # A new ledger has nothing in memory until it is loaded
+            ledger = ProcessedEventLedger(self.store)
+            await ledger.load()
+            claim = await ledger.claim("@bot:example.com", "$event")
+
+            await ledger.close()
+            await self.store.close()
+            return claim
+
+        self.assertFalse(run_coroutine(run()))
+
+    def test_prune(self):
+        """Tests that events older than the retention window are forgotten"""
+
+        async def run():
+            await self.store.execute(
+                "INSERT INTO processed_events VALUES (?, ?, ?)",
+                ("@bot:example.com", "$old", int(time.time()) - 120),
+            )
+
+            ledger = ProcessedEventLedger(self.store, retention=60)
+            await ledger.load()
+            claim = await ledger.claim("@bot:example.com", "$old")
+            row = await self.store.fetchone("SELECT COUNT(*) FROM processed_events")
+
+            await ledger.close()
+            await self.store.close()
+            return claim, row[0]
+
+        # The old event was deleted, then claimed again
+        self.assertEqual(run_coroutine(run()), (True, 1))
+
+
+if __name__ == "__main__":
+    unittest.main()
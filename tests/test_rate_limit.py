@@ -0,0 +1,59 @@
+import time
+import unittest
+
+from my_project_name.rate_limit import CommandRateLimiter, TokenBucketTable
+
+
+class TokenBucketTableTestCase(unittest.TestCase):
+    def test_lru_eviction(self):
+        """Tests that the least recently used bucket is evicted once the table is
+        full"""
+        table = TokenBucketTable(rate=1, capacity=1, max_buckets=2)
+        table.get("a").consume()
+        table.get("b")
+        table.get("a")
+        table.get("c")
+
+        self.assertEqual(len(table), 2)
+        self.assertEqual(list(table._buckets), ["a", "c"])
+
+
+class CommandRateLimiterTestCase(unittest.TestCase):
+    def test_user_limit(self):
+        """Tests that a user is limited separately from other users in the room"""
+        now = time.monotonic() + 10
+        limiter = CommandRateLimiter(user_rate=1, user_burst=2, room_burst=10)
+        room_id = "!room:example.com"
+
+        self.assertIsNone(limiter.check("@alice:example.com", room_id, now=now))
+        self.assertIsNone(limiter.check("@alice:example.com", room_id, now=now))
+        self.assertEqual(limiter.check("@alice:example.com", room_id, now=now), "user")
+        self.assertIsNone(limiter.check("@bob:example.com", room_id, now=now))
+
+        # Tokens are refilled over time
+        self.assertIsNone(limiter.check("@alice:example.com", room_id, now=now + 1))
+
+    def test_room_limit(self):
+        """Tests that a room is limited across users, and that a command ignored by
+        the room limit doesn't count towards the user limit"""
+        now = time.monotonic() + 10
+        limiter = CommandRateLimiter(user_burst=1, room_rate=1, room_burst=1)
+        room_id = "!room:example.com"
+
+        self.assertIsNone(limiter.check("@alice:example.com", room_id, now=now))
+        self.assertEqual(limiter.check("@bob:example.com", room_id, now=now), "room")
+        self.assertIsNone(limiter.check("@bob:example.com", room_id, now=now + 1))
+
+    def test_should_notify(self):
+        """Tests that a room is told to slow down once per interval"""
+        now = time.monotonic() + 10
+        limiter = CommandRateLimiter(notice_interval=60)
+
+        self.assertTrue(limiter.should_notify("!a:example.com", now=now))
+        self.assertFalse(limiter.should_notify("!a:example.com", now=now + 30))
+        self.assertTrue(limiter.should_notify("!b:example.com", now=now + 30))
+        self.assertTrue(limiter.should_notify("!a:example.com", now=now + 60))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from my_project_name.reconnect import ExponentialBackoff, ReconnectSupervisor
+
+from tests.utils import run_coroutine
+
+
+class ReconnectTestCase(unittest.TestCase):
+    def test_backoff(self):
+        """Tests that backoff delays grow exponentially up to the maximum, and reset"""
+        backoff = ExponentialBackoff(initial_delay=1, max_delay=5, multiplier=2)
+
+        for ceiling in (1, 2, 4, 5, 5):
+            delay = backoff.next_delay()
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, ceiling)
+
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 1)
+
+    def test_supervisor(self):
+        """Tests that the supervisor counts reconnects, and stops syncing when the
+        access token is rejected"""
+        fake_client = Mock(spec=nio.AsyncClient)
+        supervisor = ReconnectSupervisor(fake_client, ExponentialBackoff())
+
+        supervisor.disconnected()
+        self.assertFalse(supervisor.connected)
+
+        run_coroutine(supervisor._on_sync(Mock(spec=nio.SyncResponse)))
+        self.assertTrue(supervisor.connected)
+        self.assertEqual(supervisor.reconnects, 1)
+
+        sync_error = nio.SyncError("Unknown token", "M_UNKNOWN_TOKEN")
+        run_coroutine(supervisor._on_sync_error(sync_error))
+        self.assertTrue(supervisor.token_invalid)
+        fake_client.stop_sync_forever.assert_called_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import asyncio
+import unittest
+
+import nio
+
+from my_project_name.send_queue import (
+    PRIORITY_MESSAGE,
+    PRIORITY_REACTION,
+    OutboundQueue,
+)
+
+from tests.utils import run_coroutine
+
+
+class FakeClient:
+    """Records sends, and responds to the first `limit_exceeded` sends with an
+    M_LIMIT_EXCEEDED error"""
+
+    def __init__(
+        self,
+        limit_exceeded: int = 0,
+        retry_after_ms: int = 10,
+        user_id: str = "@bot:example.com",
+    ):
+        self.limit_exceeded = limit_exceeded
+        self.retry_after_ms = retry_after_ms
+        self.user_id = user_id
+        self.sent = []
+
+    async def room_send(self, room_id, message_type, content, **kwargs):
+        if self.limit_exceeded:
+            self.limit_exceeded -= 1
+            return nio.RoomSendError(
+                "Too many requests", "M_LIMIT_EXCEEDED", self.retry_after_ms
+            )
+
+        self.sent.append((room_id, message_type))
+        return nio.RoomSendResponse(f"$event{len(self.sent)}", room_id)
+
+
+class OutboundQueueTestCase(unittest.TestCase):
+    def test_priority(self):
+        """Tests that higher priority events are sent first"""
+        client = FakeClient()
+
+        async def run():
+            queue = OutboundQueue()
+            await asyncio.gather(
+                queue.send(
+                    client, "!a:example.com", "m.reaction", {}, PRIORITY_REACTION
+                ),
+                queue.send(
+                    client, "!b:example.com", "m.room.message", {}, PRIORITY_MESSAGE
+                ),
+            )
+            await queue.close()
+
+        run_coroutine(run())
+
+        self.assertEqual(
+            client.sent,
+            [("!b:example.com", "m.room.message"), ("!a:example.com", "m.reaction")],
+        )
+
+    def test_limit_exceeded(self):
+        """Tests that events are retried after being rate-limited by the homeserver,
+        and given up on after max_retries"""
+        client = FakeClient(limit_exceeded=2)
+
+        async def run():
+            queue = OutboundQueue(max_retries=2)
+            response = await queue.send(client, "!a:example.com", "m.room.message", {})
+            self.assertIsInstance(response, nio.RoomSendResponse)
+
+            client.limit_exceeded = 2
+            queue.max_retries = 1
+            response = await queue.send(client, "!a:example.com", "m.room.message", {})
+            self.assertIsInstance(response, nio.RoomSendError)
+            await queue.close()
+
+        run_coroutine(run())
+        self.assertEqual(len(client.sent), 1)
+
+    def test_room_rate_limit(self):
+        """Tests that a room over its rate limit does not hold up other rooms"""
+        client = FakeClient()
+
+        async def run():
+            queue = OutboundQueue(room_rate=20, room_burst=1)
+            await asyncio.gather(
+                queue.send(client, "!a:example.com", "m.room.message", {}),
+                queue.send(client, "!a:example.com", "m.room.message", {}),
+                queue.send(
+                    client, "!b:example.com", "m.room.message", {}, PRIORITY_MESSAGE
+                ),
+            )
+            await queue.close()
+
+        run_coroutine(run())
+
+        self.assertEqual(
+            [room_id for room_id, _ in client.sent],
+            ["!a:example.com", "!b:example.com", "!a:example.com"],
+        )
+
+    def test_limit_exceeded_per_account(self):
+        """Tests that an account being rate-limited does not pause other accounts,
+        even in the same room"""
+        limited = FakeClient(limit_exceeded=1, retry_after_ms=60000)
+        other = FakeClient(user_id="@other:example.com")
+
+        async def run():
+            queue = OutboundQueue(room_burst=1)
+            limited_send = asyncio.ensure_future(
+                queue.send(limited, "!a:example.com", "m.room.message", {})
+            )
+            await asyncio.sleep(0.01)
+            await asyncio.wait_for(
+                queue.send(other, "!a:example.com", "m.room.message", {}), 1
+            )
+            await queue.close()
+            await asyncio.gather(limited_send, return_exceptions=True)
+            return limited_send.cancelled()
+
+        self.assertTrue(run_coroutine(run()))
+        self.assertEqual(limited.sent, [])
+        self.assertEqual(other.sent, [("!a:example.com", "m.room.message")])
+
+    def test_close_cancels_sends(self):
+        """Tests that closing the queue cancels sends that are waiting for the
+        homeserver to respond"""
+        client = FakeClient()
+        responded = []
+
+        async def room_send(room_id, message_type, content, **kwargs):
+            await asyncio.sleep(60)
+            responded.append(room_id)
+
+        client.room_send = room_send
+
+        async def run():
+            queue = OutboundQueue()
+            send = asyncio.ensure_future(
+                queue.send(client, "!a:example.com", "m.room.message", {})
+            )
+            await asyncio.sleep(0.01)
+            await queue.close()
+            await asyncio.sleep(0)
+            return send.cancelled(), len(queue._sending)
+
+        self.assertEqual(run_coroutine(run()), (True, 0))
+        self.assertEqual(responded, [])
+
+
+if __name__ == "__main__":
+    unittest.main()
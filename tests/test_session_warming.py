@@ -0,0 +1,94 @@
+import asyncio
+import unittest
+from unittest.mock import Mock
+
+import nio
+
+from my_project_name.session_warming import SessionWarmer, share_room_session
+
+from tests.utils import run_coroutine
+
+
+class FakeOlm:
+    def __init__(self):
+        self.needs_session = {"!room:example.com"}
+
+    def should_share_group_session(self, room_id):
+        return room_id in self.needs_session
+
+
+class FakeClient:
+    """Has one encrypted room, and records the sessions it shares"""
+
+    def __init__(self, olm: bool = True):
+        self.user_id = "@bot:example.com"
+        self.olm = FakeOlm() if olm else None
+        self.rooms = {"!room:example.com": Mock(encrypted=True, members_synced=True)}
+        self.sharing_session = {}
+        self.should_query_keys = False
+        self.shared = []
+
+    async def share_group_session(self, room_id, ignore_unverified_devices=False):
+        self.shared.append(room_id)
+        self.olm.needs_session.discard(room_id)
+
+
+class ShareRoomSessionTestCase(unittest.TestCase):
+    def test_share(self):
+        """Tests that a session is only shared when the room needs one"""
+        client = FakeClient()
+
+        self.assertTrue(
+            run_coroutine(share_room_session(client, "!room:example.com", "inline"))
+        )
+        self.assertFalse(
+            run_coroutine(share_room_session(client, "!room:example.com", "inline"))
+        )
+        self.assertEqual(client.shared, ["!room:example.com"])
+
+    def test_no_olm(self):
+        """Tests that nothing is shared when encryption is disabled"""
+        client = FakeClient(olm=False)
+
+        self.assertFalse(
+            run_coroutine(share_room_session(client, "!room:example.com", "inline"))
+        )
+
+
+class SessionWarmerTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = FakeClient()
+        self.room = Mock(spec=nio.MatrixRoom)
+        self.room.room_id = "!room:example.com"
+        self.room.encrypted = True
+
+    def test_active_policy(self):
+        """Tests that sessions are only shared with rooms that have had a message
+        recently, once the membership has settled"""
+
+        async def run():
+            warmer = SessionWarmer(self.client, policy="active", delay=0.01)
+            await warmer._on_member(self.room, Mock())
+            await asyncio.sleep(0.05)
+            before = list(self.client.shared)
+
+            await warmer._on_message(self.room, Mock())
+            for _ in range(3):
+                # A burst of membership changes only shares one session
+                await warmer._on_member(self.room, Mock())
+                self.client.olm.needs_session.add(self.room.room_id)
+            await asyncio.sleep(0.05)
+
+            await warmer.close()
+            return before
+
+        self.assertEqual(run_coroutine(run()), [])
+        self.assertEqual(self.client.shared, ["!room:example.com"])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            SessionWarmer(self.client, policy="sometimes")
+
+
+if __name__ == "__main__":
+    unittest.main()
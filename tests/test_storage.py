@@ -0,0 +1,207 @@
+import sqlite3
+import unittest
+import weakref
+from unittest.mock import Mock, patch
+
+from my_project_name.storage import (
+    Storage,
+    _to_postgres_prepare,
+    latest_migration_version,
+    register_statement,
+)
+
+from tests.utils import run_coroutine
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.store = Storage({"type": "sqlite", "connection_string": ":memory:"})
+
+    def test_initial_setup(self):
+        """Tests that a new database is set up at the latest migration version"""
+        row = self.store._fetchone("SELECT version FROM migration_version")
+        self.assertEqual(row, (latest_migration_version,))
+
+    def test_async_queries(self):
+        """Tests that the awaitable query methods run queries against the database"""
+
+        async def run():
+            await self.store.execute("CREATE TABLE test (id INTEGER, name TEXT)")
+            await self.store.execute("INSERT INTO test VALUES (?, ?)", (1, "one"))
+            await self.store.executemany(
+                "INSERT INTO test VALUES (?, ?)", [(2, "two"), (3, "three")]
+            )
+
+            row = await self.store.fetchone("SELECT name FROM test WHERE id = ?", (2,))
+            rows = await self.store.fetchall("SELECT id FROM test ORDER BY id")
+
+            await self.store.close()
+            return row, rows
+
+        row, rows = run_coroutine(run())
+
+        self.assertEqual(row, ("two",))
+        self.assertEqual(rows, [(1,), (2,), (3,)])
+
+    def test_write_behind(self):
+        """Tests that buffered writes are only committed once the buffer is full, and
+        that closing the store flushes the rest"""
+        store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": ":memory:",
+                "write_behind": {"max_batch_size": 3, "flush_interval": 60},
+            }
+        )
+
+        async def count_rows():
+            row = await store.fetchone("SELECT COUNT(*) FROM test")
+            return row[0]
+
+        async def run():
+            await store.execute("CREATE TABLE test (id INTEGER)")
+            counts = []
+
+            await store.write("INSERT INTO test VALUES (?)", (1,))
+            await store.write("INSERT INTO test VALUES (?)", (2,))
+            counts.append(await count_rows())
+
+            # The buffer is now full and should be flushed
+            await store.write("INSERT INTO test VALUES (?)", (3,))
+            counts.append(await count_rows())
+
+            await store.write("INSERT INTO test VALUES (?)", (4,))
+            counts.append(await count_rows())
+
+            await store.flush()
+            counts.append(await count_rows())
+            await store.close()
+            return counts
+
+        self.assertEqual(run_coroutine(run()), [0, 3, 3, 4])
+
+    def test_write_behind_retry(self):
+        """Tests that buffered writes that fail to commit because the database is
+        unavailable are kept, up to max_buffer_size, and committed by the next flush"""
+        store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": ":memory:",
+                "write_behind": {
+                    "max_batch_size": 100,
+                    "flush_interval": 60,
+                    "max_buffer_size": 2,
+                },
+            }
+        )
+
+        async def run():
+            await store.execute("CREATE TABLE test (id INTEGER)")
+            for i in (1, 2, 3):
+                await store.write("INSERT INTO test VALUES (?)", (i,))
+
+            def _execute_batch(writes):
+                raise sqlite3.OperationalError("database is locked")
+
+            with patch.object(store, "_execute_batch", _execute_batch):
+                with self.assertLogs("my_project_name.storage", "WARNING"):
+                    await store.flush()
+            buffered = len(store._write_buffer)
+
+            await store.write("INSERT INTO test VALUES (?)", (4,))
+            await store.flush()
+
+            rows = await store.fetchall("SELECT id FROM test")
+            await store.close()
+            return buffered, rows
+
+        self.assertEqual(run_coroutine(run()), (2, [(2,), (3,), (4,)]))
+
+    def test_write_behind_poisoned_write(self):
+        """Tests that a buffered write that fails is dropped, and does not prevent the
+        writes around it from being committed"""
+        store = Storage(
+            {
+                "type": "sqlite",
+                "connection_string": ":memory:",
+                "write_behind": {"max_batch_size": 100, "flush_interval": 60},
+            }
+        )
+
+        async def run():
+            await store.execute("CREATE TABLE test (id INTEGER PRIMARY KEY)")
+            await store.write("INSERT INTO test VALUES (?)", (1,))
+            await store.write("INSERT INTO test VALUES (?)", (1,))
+            await store.write("INSERT INTO test VALUES (?)", (2,))
+            with self.assertLogs("my_project_name.storage", "ERROR"):
+                await store.flush()
+
+            buffered = len(store._write_buffer)
+            rows = await store.fetchall("SELECT id FROM test")
+            await store.close()
+            return buffered, rows
+
+        self.assertEqual(run_coroutine(run()), (0, [(1,), (2,)]))
+
+    def test_statements(self):
+        """Tests that named statements can be registered and run"""
+        register_statement("test_insert", "INSERT INTO test VALUES (?, ?)")
+        register_statement("test_select", "SELECT name FROM test WHERE id = ?")
+
+        async def run():
+            await self.store.execute("CREATE TABLE test (id INTEGER, name TEXT)")
+            await self.store.execute_statement("test_insert", (1, "one"))
+            await self.store.executemany_statement(
+                "test_insert", [(2, "two"), (3, "three")]
+            )
+            row = await self.store.fetchone_statement("test_select", (3,))
+            await self.store.close()
+            return row
+
+        self.assertEqual(run_coroutine(run()), ("three",))
+
+        # Registering a different query under the same name is an error
+        with self.assertRaises(ValueError):
+            register_statement("test_select", "SELECT id FROM test")
+
+    def test_postgres_prepare(self):
+        """Tests that named statements are translated to postgres PREPARE/EXECUTE"""
+        prepare, execute = _to_postgres_prepare(
+            "test_insert", "INSERT INTO test VALUES (?, ?)"
+        )
+        self.assertEqual(
+            prepare, "PREPARE test_insert AS INSERT INTO test VALUES ($1, $2)"
+        )
+        self.assertEqual(execute, "EXECUTE test_insert (%s, %s)")
+
+        prepare, execute = _to_postgres_prepare(
+            "test_count", "SELECT COUNT(*) FROM test"
+        )
+        self.assertEqual(execute, "EXECUTE test_count")
+
+    def test_postgres_prepare_per_connection(self):
+        """Tests that statements are prepared again on a connection that replaces a
+        closed one, even if the new connection reuses the old one's id()"""
+
+        class FakeConnection:
+            pass
+
+        register_statement("test_select", "SELECT name FROM test WHERE id = ?")
+        self.store.db_type = "postgres"
+        self.store._prepared = weakref.WeakKeyDictionary()
+
+        cursor = Mock()
+        cursor.connection = FakeConnection()
+        self.store._statement_query(cursor, "test_select")
+        self.store._statement_query(cursor, "test_select")
+        self.assertEqual(cursor.execute.call_count, 1)
+
+        cursor.connection = FakeConnection()
+        execute = self.store._statement_query(cursor, "test_select")
+        self.assertEqual(cursor.execute.call_count, 2)
+        self.assertEqual(execute, "EXECUTE test_select (%s)")
+        self.store.db_type = "sqlite"
+
+
+if __name__ == "__main__":
+    unittest.main()
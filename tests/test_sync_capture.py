@@ -0,0 +1,74 @@
+import functools
+import gzip
+import os
+import tempfile
+import unittest
+from unittest.mock import Mock
+
+from benchmarks.load_test import message_flood, run_scenario
+from benchmarks.replay_sync import replay
+from my_project_name.sync_capture import SyncCapture, read_capture
+
+from tests.utils import run_coroutine
+
+
+class SyncCaptureTestCase(unittest.TestCase):
+    def test_capture_and_replay(self):
+        """Tests that replaying captured sync responses makes the bot send the same
+        responses as it did when the traffic was captured"""
+        with tempfile.TemporaryDirectory() as directory:
+            capture_path = os.path.join(directory, "capture.jsonl.gz")
+
+            scenario = functools.partial(message_flood, rooms=2, messages=20, burst=10)
+            results = run_coroutine(
+                run_scenario(
+                    scenario,
+                    {"sync": {"capture": {"enabled": True, "path": capture_path}}},
+                    timeout=30,
+                )
+            )
+            self.assertEqual(results["responses"], 20)
+
+            kinds = [kind for kind, _, _ in read_capture(capture_path)]
+            self.assertEqual(kinds[0], "header")
+            self.assertIn("response", kinds)
+
+            replayed = run_coroutine(replay(capture_path))["results"]
+
+        self.assertEqual(replayed["timeline_events"], 20)
+        self.assertEqual(replayed["sent_events"], {"m.room.message": 20})
+
+    def test_capture_never_closed(self):
+        """Tests that a capture that was never closed, and whose last line was cut
+        off, can be replayed and appended to"""
+        client = Mock(user_id="@bot:example.com")
+
+        async def capture(capture_path, close):
+            sync_capture = SyncCapture(client, capture_path)
+            await sync_capture._write({"time": 1, "response": {"next_batch": "a"}})
+            if close:
+                await sync_capture.close()
+            else:
+                sync_capture._executor.shutdown()
+
+        with tempfile.TemporaryDirectory() as directory:
+            capture_path = os.path.join(directory, "capture.jsonl.gz")
+
+            run_coroutine(capture(capture_path, close=False))
+            with open(capture_path, "ab") as f:
+                # Killed part way through writing a line
+                f.write(gzip.compress(b'{"time":2,"response":{}}\n')[:-10])
+
+            with self.assertLogs("my_project_name.sync_capture", "WARNING"):
+                kinds = [kind for kind, _, _ in read_capture(capture_path)]
+            self.assertEqual(kinds, ["header", "response"])
+
+            with self.assertLogs("my_project_name.sync_capture", "WARNING"):
+                run_coroutine(capture(capture_path, close=True))
+            kinds = [kind for kind, _, _ in read_capture(capture_path)]
+
+        self.assertEqual(kinds, ["header", "response", "header", "response"])
+
+
+if __name__ == "__main__":
+    unittest.main()
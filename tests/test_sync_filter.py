@@ -0,0 +1,30 @@
+import unittest
+
+import nio
+
+from my_project_name.sync_filter import STATE_EVENT_TYPES, build_sync_filter
+
+
+class SyncFilterTestCase(unittest.TestCase):
+    def test_build_sync_filter(self):
+        """Tests that the sync filter only includes handled event types, plus the state
+        events nio needs"""
+        sync_filter = build_sync_filter(
+            [nio.RoomMessageText, nio.UnknownEvent],
+            timeline_limit=10,
+            not_rooms=["!ignored:example.com"],
+        )
+
+        room_filter = sync_filter["room"]
+        self.assertEqual(
+            room_filter["timeline"]["types"],
+            STATE_EVENT_TYPES + ["m.room.message", "m.reaction"],
+        )
+        self.assertEqual(room_filter["timeline"]["limit"], 10)
+        self.assertTrue(room_filter["state"]["lazy_load_members"])
+        self.assertEqual(room_filter["not_rooms"], ["!ignored:example.com"])
+        self.assertNotIn("rooms", room_filter)
+
+
+if __name__ == "__main__":
+    unittest.main()
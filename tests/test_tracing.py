@@ -0,0 +1,89 @@
+import asyncio
+import unittest
+
+from my_project_name.tracing import SpanExporter, Tracer
+
+from tests.utils import run_coroutine
+
+
+class ListExporter(SpanExporter):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+class TracingTestCase(unittest.TestCase):
+    def test_sampled_trace(self):
+        """Tests that spans within a sampled trace are recorded as children of the
+        span they were started in"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter, sample_rate=1)
+
+        with tracer.start_trace("message", room_id="!test:example.org") as root:
+            with tracer.span("command.process", command="echo"):
+                pass
+
+        self.assertEqual(
+            [span.name for span in exporter.spans], ["command.process", "message"]
+        )
+        child = exporter.spans[0]
+        self.assertEqual(child.trace_id, root.trace_id)
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertIsNone(root.parent_id)
+        self.assertEqual(root.attributes, {"room_id": "!test:example.org"})
+
+    def test_unsampled_trace(self):
+        """Tests that nothing is recorded for traces that are not sampled, or for spans
+        started outside of a trace"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter, sample_rate=0)
+
+        with tracer.span("storage.execute") as span:
+            self.assertIsNone(span)
+
+        with tracer.start_trace("message") as root:
+            self.assertIsNone(root)
+            with tracer.span("command.process") as span:
+                self.assertIsNone(span)
+
+        self.assertEqual(exporter.spans, [])
+
+    def test_error(self):
+        """Tests that spans record exceptions raised within them"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter, sample_rate=1)
+
+        with self.assertRaises(ValueError):
+            with tracer.start_trace("message"):
+                raise ValueError()
+
+        self.assertEqual(exporter.spans[0].error, "ValueError")
+
+    def test_concurrent_tasks(self):
+        """Tests that each asyncio task has its own current span"""
+        exporter = ListExporter()
+        tracer = Tracer(exporter, sample_rate=1)
+
+        async def handle(name):
+            with tracer.start_trace(name) as root:
+                await asyncio.sleep(0.01)
+                with tracer.span("command.process"):
+                    pass
+            return root
+
+        async def run():
+            return await asyncio.gather(handle("first"), handle("second"))
+
+        roots = run_coroutine(run())
+
+        children = [span for span in exporter.spans if span.name == "command.process"]
+        self.assertEqual(
+            sorted(child.parent_id for child in children),
+            sorted(root.span_id for root in roots),
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,81 @@
+import re
+import unittest
+
+from my_project_name.triggers import TriggerTable
+
+
+class TriggerTableTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.triggers = TriggerTable()
+
+        @self.triggers.exact("hello world")
+        async def hello_world(message):
+            pass
+
+        @self.triggers.literal("c++")
+        async def cpp(message):
+            pass
+
+        @self.triggers.keyword("bot")
+        async def bot(message):
+            pass
+
+        @self.triggers.regex(r"#\d+")
+        async def issue(message):
+            pass
+
+        self.hello_world = hello_world
+        self.cpp = cpp
+        self.bot = bot
+        self.issue = issue
+
+    def test_match(self):
+        """Tests that each kind of trigger matches, and that all matching triggers are
+        returned in the order they were registered"""
+        self.assertEqual(self.triggers.match("Hello World"), [self.hello_world])
+        self.assertEqual(self.triggers.match("hello world!"), [])
+
+        self.assertEqual(self.triggers.match("I like C++"), [self.cpp])
+
+        self.assertEqual(self.triggers.match("is this a BOT?"), [self.bot])
+        self.assertEqual(self.triggers.match("robots"), [])
+
+        self.assertEqual(
+            self.triggers.match("bot, see #123 about c++"),
+            [self.cpp, self.bot, self.issue],
+        )
+
+    def test_overlapping_matches(self):
+        """Tests that triggers whose matches overlap all match"""
+
+        @self.triggers.literal("bot help")
+        async def bot_help(message):
+            pass
+
+        self.assertEqual(self.triggers.match("bot help"), [self.bot, bot_help])
+
+    def test_regex_flags(self):
+        """Tests that inline flags at the start of a regex only apply to that trigger,
+        and that invalid flags are rejected when the trigger is registered"""
+
+        @self.triggers.regex(r"(?i)deploy \w+")
+        async def deploy(message):
+            pass
+
+        @self.triggers.regex(r"Case")
+        async def case(message):
+            pass
+
+        self.assertEqual(self.triggers.match("DEPLOY prod"), [deploy])
+        self.assertEqual(self.triggers.match("case"), [])
+
+        with self.assertRaises(re.error):
+            self.triggers.regex(r"deploy (?i)\w+")
+
+    def test_empty_table(self):
+        """Tests that a table without triggers matches nothing"""
+        self.assertEqual(TriggerTable().match("hello world"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,238 @@
+import asyncio
+import pickle
+import queue
+import unittest
+from collections import Counter
+from unittest.mock import Mock
+
+import nio
+
+from my_project_name.send_queue import PRIORITY_REACTION, OutboundQueue
+from my_project_name.workers import (
+    HashRing,
+    WorkerClient,
+    WorkerPool,
+    WorkerRoom,
+    _decode_response,
+    _encode_response,
+)
+
+from tests.utils import make_awaitable, run_coroutine
+
+
+class HashRingTestCase(unittest.TestCase):
+    def test_get_is_stable(self):
+        """Tests that a key always maps to the same node"""
+        ring = HashRing(4)
+        self.assertEqual(ring.get("!room:example.com"), ring.get("!room:example.com"))
+        self.assertEqual(
+            HashRing(4).get("!room:example.com"), ring.get("!room:example.com")
+        )
+
+    def test_keys_are_spread_between_nodes(self):
+        """Tests that every node gets a reasonable share of keys"""
+        ring = HashRing(4)
+        counts = Counter(ring.get(f"!room{i}:example.com") for i in range(4000))
+        self.assertEqual(set(counts), {0, 1, 2, 3})
+        for node_count in counts.values():
+            self.assertGreater(node_count, 500)
+
+    def test_adding_a_node_moves_few_keys(self):
+        """Tests that adding a node only moves keys onto the new node"""
+        keys = [f"!room{i}:example.com" for i in range(4000)]
+        before = HashRing(4)
+        after = HashRing(5)
+
+        moved = [key for key in keys if before.get(key) != after.get(key)]
+        self.assertLess(len(moved), len(keys) / 3)
+        for key in moved:
+            self.assertEqual(after.get(key), 4)
+
+
+class WorkerRoomTestCase(unittest.TestCase):
+    def test_from_room(self):
+        """Tests that a WorkerRoom keeps what callbacks need and can be pickled"""
+        room = nio.MatrixRoom("!room:example.com", "@bot:example.com")
+        room.add_member("@alice:example.com", "Alice", None)
+        event = Mock(sender="@alice:example.com")
+
+        worker_room = pickle.loads(pickle.dumps(WorkerRoom.from_room(room, event)))
+
+        self.assertEqual(worker_room.room_id, "!room:example.com")
+        self.assertEqual(worker_room.member_count, room.member_count)
+        self.assertEqual(worker_room.user_name("@alice:example.com"), "Alice")
+        self.assertEqual(worker_room.user_name("@bob:example.com"), "@bob:example.com")
+
+
+class ResponseEncodingTestCase(unittest.TestCase):
+    def test_room_send_response(self):
+        """Tests that a successful room_send response survives the round trip"""
+        status, payload = _encode_response(
+            nio.RoomSendResponse("$event:example.com", "!room:example.com")
+        )
+        response = _decode_response(
+            "room_send", ("!room:example.com",), status, payload
+        )
+
+        self.assertIsInstance(response, nio.RoomSendResponse)
+        self.assertEqual(response.event_id, "$event:example.com")
+        self.assertEqual(response.room_id, "!room:example.com")
+
+    def test_error_response(self):
+        """Tests that rate limit errors keep their retry delay"""
+        status, payload = _encode_response(
+            nio.RoomSendError("Too many requests", "M_LIMIT_EXCEEDED", 2000)
+        )
+        response = _decode_response(
+            "room_send", ("!room:example.com",), status, payload
+        )
+
+        self.assertIsInstance(response, nio.RoomSendError)
+        self.assertEqual(response.retry_after_ms, 2000)
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self) -> None:
+        self.client = Mock(spec=nio.AsyncClient)
+        self.pool = WorkerPool("config.yaml", 2, self.client)
+        self.pool._event_queues = [queue.Queue(), queue.Queue()]
+        self.pool._reply_queues = [queue.Queue(), queue.Queue()]
+
+    def test_route_sends_room_events_to_one_worker(self):
+        """Tests that all events in a room are routed to the same worker"""
+        room = nio.MatrixRoom("!room:example.com", "@bot:example.com")
+        event = nio.RoomMessageText.from_dict(
+            {
+                "type": "m.room.message",
+                "event_id": "$event:example.com",
+                "sender": "@alice:example.com",
+                "origin_server_ts": 0,
+                "content": {"msgtype": "m.text", "body": "hello"},
+            }
+        )
+
+        for _ in range(3):
+            self.pool.route("message", room, event)
+
+        worker_id = self.pool.ring.get(room.room_id)
+        self.assertEqual(self.pool._event_queues[worker_id].qsize(), 3)
+        self.assertEqual(self.pool._event_queues[1 - worker_id].qsize(), 0)
+
+        item = self.pool._event_queues[worker_id].get()
+        sequence, handler_name, _, class_name, source = item
+        self.assertEqual(sequence, 0)
+        self.assertEqual(handler_name, "message")
+        self.assertEqual(class_name, "RoomMessageText")
+        self.assertEqual(source, event.source)
+
+    def test_handle_request(self):
+        """Tests that requests from workers are made with the client, and the response
+        is sent back to the worker that asked"""
+        self.client.join.return_value = make_awaitable(
+            nio.JoinResponse("!room:example.com")
+        )
+
+        run_coroutine(
+            self.pool._handle_request(1, 7, "join", ("!room:example.com",), {})
+        )
+
+        self.client.join.assert_called_once_with("!room:example.com")
+        self.assertEqual(self.pool._reply_queues[1].get_nowait(), (7, "ok", {}))
+
+    def test_restart_routes_unhandled_events_again(self):
+        """Tests that events a dead worker had not acknowledged are routed to the
+        restarted worker, in order"""
+        room = nio.MatrixRoom("!room:example.com", "@bot:example.com")
+        event = Mock(spec=nio.RoomMessageText, sender="@alice:example.com")
+        event.source = {}
+        worker_id = self.pool.ring.get(room.room_id)
+
+        for _ in range(3):
+            self.pool.route("message", room, event)
+        self.pool._ack(worker_id, 1)
+
+        self.pool._context = Mock(Queue=queue.Queue)
+        self.pool._start_worker = Mock()
+        self.pool._restart_worker(worker_id)
+
+        event_queue = self.pool._event_queues[worker_id]
+        self.assertEqual([event_queue.get_nowait()[0] for _ in range(2)], [0, 2])
+        self.assertTrue(event_queue.empty())
+        self.pool._start_worker.assert_called_once_with(worker_id)
+
+    def test_handle_request_sends_with_priority(self):
+        """Tests that events sent by workers are queued with their priority"""
+        outbound_queue = Mock(spec=OutboundQueue)
+        outbound_queue.send.return_value = make_awaitable(
+            nio.RoomSendResponse("$event:example.com", "!room:example.com")
+        )
+        self.pool.outbound_queue = outbound_queue
+
+        run_coroutine(
+            self.pool._handle_request(
+                0,
+                "request",
+                "room_send",
+                ("!room:example.com", "m.reaction", {}),
+                {"tx_id": "txn", "priority": PRIORITY_REACTION},
+            )
+        )
+
+        outbound_queue.send.assert_called_once_with(
+            self.client,
+            "!room:example.com",
+            "m.reaction",
+            {},
+            priority=PRIORITY_REACTION,
+            tx_id="txn",
+        )
+
+    def test_handle_request_rejects_other_methods(self):
+        """Tests that workers may only make the requests that callbacks need"""
+        run_coroutine(self.pool._handle_request(0, 1, "logout", (), {}))
+
+        self.client.logout.assert_not_called()
+        request_id, status, _ = self.pool._reply_queues[0].get_nowait()
+        self.assertEqual((request_id, status), (1, "error"))
+
+
+class WorkerClientTestCase(unittest.TestCase):
+    def test_resolve(self):
+        """Tests that a response from the sync process completes the right request"""
+
+        async def request_and_reply():
+            client = WorkerClient("@bot:example.com", 0, queue.Queue(), queue.Queue())
+            task = asyncio.ensure_future(client.join("!room:example.com"))
+            await asyncio.sleep(0)
+
+            worker_id, request_id, method, args, _ = client.request_queue.get_nowait()
+            self.assertEqual(
+                (worker_id, method, args), (0, "join", ("!room:example.com",))
+            )
+
+            client._resolve(request_id, "ok", {})
+            return await task
+
+        response = run_coroutine(request_and_reply())
+        self.assertIsInstance(response, nio.JoinResponse)
+        self.assertEqual(response.room_id, "!room:example.com")
+
+    def test_request_ids_are_unique_per_process(self):
+        """Tests that a restarted worker's requests can't be completed by responses
+        to the requests of the worker it replaced"""
+
+        async def request(client):
+            task = asyncio.ensure_future(client.join("!room:example.com"))
+            await asyncio.sleep(0)
+            task.cancel()
+            return client.request_queue.get_nowait()[1]
+
+        first = WorkerClient("@bot:example.com", 0, queue.Queue(), queue.Queue())
+        second = WorkerClient("@bot:example.com", 0, queue.Queue(), queue.Queue())
+        self.assertNotEqual(
+            run_coroutine(request(first)), run_coroutine(request(second))
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()